@@ -0,0 +1,315 @@
+"""
+Bulk (re)computation of fingerprint columns, replaces `update_hashes_script` of test_search.py.
+
+Rows `(id, text)` are streamed with a server-side cursor ordered by id, fingerprints are computed
+in a pool of processes and written back by batches with one `UPDATE ... FROM (VALUES ...)` per batch.
+Halves and bands of banded columns (see `bill.BANDED_COLUMNS`) are updated together with the fingerprint,
+and new fingerprints are appended to the log of the column's fingerprint store if it exists (see fingerprint_store.py).
+Sections stored without text in versions mode (`linked_section_id`, see `main_tests.link_unchanged_sections`)
+get the fingerprints of the rows they are linked to. The hasher should give values of the type of the column
+(`HASHER_TYPES`), it's checked before the start.
+
+Every batch is committed, so the job can be stopped at any moment and continued from the last committed id:
+    python backfill.py sections simhash_text --workers 8
+    python backfill.py sections simhash_text --workers 8 --start-id 1200001
+    python backfill.py xml_bills simhash_title --source title --missing
+    python backfill.py sections simhash_text64 --hasher fingerprint64 --missing
+With `--state file.json` the last committed id is stored in the file and the next run starts after it.
+"""
+import argparse
+import json
+import os
+import re
+from collections import deque
+from contextlib import nullcontext
+from multiprocessing import Pool
+from time import time
+
+from sqlalchemy import text as text_to_query
+
+from config import CONFIG
+from fingerprint_store import find_store
+from metrics import WorkerJob, increment, merge_result, span
+from utils import build_128_simhash, build_sim_hash, text_cleaning, fingerprint_columns, create_session, simhash_to_int
+from utils import split_simhash
+
+SIMHASH_BANDS = CONFIG.get('SIMHASH_BANDS', 8)
+BIT_STRING = re.compile(r'^[01]+$')
+
+
+def simhash128(text):
+    """
+    Fingerprint of section texts, as `main_tests.section_row_from_dict` computes `simhash_text`
+    """
+    return build_128_simhash(text_cleaning(text))
+
+
+def words128(text):
+    return build_128_simhash(text_cleaning(text), words=True)
+
+
+def single_words128(text):
+    return build_128_simhash(text_cleaning(text), words=True, n=1)
+
+
+def simhash64(text):
+    """
+    64 bit fingerprint of bills and titles, as `main_tests.create_bill_from_dict` computes it
+    """
+    return build_sim_hash(text)
+
+
+def fingerprint64(text):
+    """
+    64 bit simhash of the cleaned text as signed integer, for `simhash_text64` columns
+    """
+    return simhash_to_int(build_sim_hash(text_cleaning(text)))
+
+
+HASHERS = {'simhash128': simhash128, 'words128': words128, 'single_words128': single_words128,
+           'simhash64': simhash64, 'fingerprint64': fingerprint64}
+# type of columns every hasher fills
+HASHER_TYPES = {'simhash128': 'BIT(128)', 'words128': 'BIT(128)', 'single_words128': 'BIT(128)',
+                'simhash64': 'BIT(64)', 'fingerprint64': 'BIGINT'}
+
+
+def hash_batch(args):
+    """
+    Worker: fingerprints of a batch of rows
+    :param args: tuple (hasher name, list of (id, text))
+    :return: list of (id, bit string, integer or None)
+    """
+    hasher_name, rows = args
+    hasher = HASHERS[hasher_name]
+    with span('backfill.hash', hasher=hasher_name, rows=len(rows)):
+        hashes = [(row_id, hasher(text) if text else None) for row_id, text in rows]
+    increment('backfill.rows', len(rows))
+    return hashes
+
+
+def is_banded(table, column):
+    from bill import BANDED_COLUMNS
+    return any(model.__tablename__ == table and name == column for model, name in BANDED_COLUMNS)
+
+
+def column_types(session, table):
+    """
+    :return: dict column name -> sql type of the column in DB, e.g. 'BIT(128)'
+    """
+    from sqlalchemy import inspect
+    return {c['name']: c['type'].compile(session.get_bind().dialect).upper()
+            for c in inspect(session.get_bind()).get_columns(table)}
+
+
+def check_hasher(types, table, column, hasher):
+    """
+    Raise ValueError if the hasher doesn't give values of the type of the column
+    (e.g. 64 bit fingerprints for banded bit(128) column)
+    :param types: types of columns of the table, see `column_types`
+    """
+    if column not in types:
+        raise ValueError('{} has no column {}'.format(table, column))
+    if types[column] != HASHER_TYPES[hasher]:
+        raise ValueError('{}.{} is {}, hasher {} gives {}, choose one of: {}'.format(
+            table, column, types[column], hasher, HASHER_TYPES[hasher],
+            ', '.join(name for name, kind in HASHER_TYPES.items() if kind == types[column]) or 'none'))
+
+
+def update_query(table, column, hashes, banded=False, bands=SIMHASH_BANDS):
+    """
+    One UPDATE of all rows of the batch
+    :param hashes: list of (id, bit string or None), or (id, integer or None) for bigint columns
+    :param banded: update `<column>_hi`, `<column>_lo` and bands too
+    :return: sql string
+    """
+    names = [column]
+    if banded:
+        names += list(fingerprint_columns(column, None, bands))
+    first = next((bits for _, bits in hashes if bits is not None), None)
+    rows = list()
+    for row_id, bits in hashes:
+        if isinstance(bits, int):
+            rows.append([str(int(row_id)), str(bits)])
+            continue
+        if bits is not None and not BIT_STRING.match(bits):
+            raise ValueError('fingerprint of row {} is not a bit string: {!r}'.format(row_id, bits))
+        row = [str(int(row_id)), "B'{}'".format(bits) if bits else 'NULL']
+        if banded:
+            row += ['NULL' if v is None else str(int(v)) for v in fingerprint_columns(column, bits, bands).values()]
+        rows.append(row)
+    # types of VALUES columns are given by the first row
+    if isinstance(first, int):
+        fingerprint_type = '::bigint'
+    else:
+        fingerprint_type = '::bit({})'.format(len(first) if first else 128)
+    casts = ['::integer', fingerprint_type] + ['::bigint'] * (len(names) - 1)
+    rows[0] = [value + cast for value, cast in zip(rows[0], casts)]
+    values = ['({})'.format(', '.join(row)) for row in rows]
+    assignments = ', '.join('{0} = v.{0}'.format(name) for name in names)
+    return 'UPDATE {table} AS t SET {assignments} FROM (VALUES {values}) AS v(id, {names}) WHERE t.id = v.id'.format(
+        table=table, assignments=assignments, values=', '.join(values), names=', '.join(names))
+
+
+def copy_to_linked(session, table, column, banded=False, ids=None, bands=SIMHASH_BANDS):
+    """
+    Copy the fingerprint (with halves and bands) to rows stored without text which are linked to the rows
+    :param ids: ids of the rows linked to, by default all rows which fingerprint differs from the linked one
+    :return: list of (id of updated row, its new fingerprint)
+    """
+    names = [column] + (list(fingerprint_columns(column, None, bands)) if banded else [])
+    condition = 's.id = ANY(:ids)' if ids is not None else 'l.{0} IS DISTINCT FROM s.{0}'.format(column)
+    query = """UPDATE {table} AS l SET {assignments} FROM {table} AS s
+        WHERE l.linked_section_id = s.id AND {condition} RETURNING l.id, s.{column}""".format(
+        table=table, column=column, condition=condition,
+        assignments=', '.join('{0} = s.{0}'.format(name) for name in names))
+    rows = session.execute(text_to_query(query), dict(ids=list(ids or []))).all()
+    return [(row_id, value if isinstance(value, int) or value is None else str(value)) for row_id, value in rows]
+
+
+def log_to_store(store, hashes):
+    """
+    Append recomputed fingerprints of banded column to its FingerprintStore, rows without fingerprint are removed
+    :param hashes: list of (id, bit string or None)
+    """
+    changed = [(row_id, split_simhash(bits)) for row_id, bits in hashes if bits]
+    store.append([row_id for row_id, _ in changed], [halves[0] for _, halves in changed],
+                 [halves[1] for _, halves in changed])
+    store.remove([row_id for row_id, bits in hashes if not bits])
+
+
+def _read_state(state_file):
+    if state_file and os.path.isfile(state_file):
+        with open(state_file) as state:
+            return json.load(state)
+    return dict()
+
+
+def _write_state(state_file, **values):
+    if state_file:
+        with open(state_file + '.tmp', 'w') as state:
+            json.dump(values, state)
+        os.replace(state_file + '.tmp', state_file)
+
+
+def backfill(table, column, source='text', hasher='simhash128', workers=1, batch_size=1000, start_id=None,
+             end_id=None, missing=False, state_file=None, session=None):
+    """
+    Recompute fingerprint `column` of the table from the `source` column
+    :param table: table name, e.g. 'sections'
+    :param column: bit fingerprint column
+    :param source: text column to hash
+    :param hasher: key of HASHERS
+    :param workers: number of processes computing fingerprints
+    :param batch_size: rows in one UPDATE (and one task of a worker)
+    :param start_id: first id (inclusive), default - after the id in `state_file` or the first row
+    :param end_id: last id (inclusive)
+    :param missing: only rows where the fingerprint is NULL
+    :param state_file: json file to store the last committed id
+    :return: dict with numbers of rows, last id and rows per second
+    """
+    if hasher not in HASHERS:
+        raise ValueError('hasher should be one of {}, got {}'.format(tuple(HASHERS), hasher))
+    session = session or create_session(CONFIG['DB_connection'])
+    types = column_types(session, table)
+    check_hasher(types, table, column, hasher)
+    # sections of versions stored without text, see `copy_to_linked`
+    linked = 'linked_section_id' in types
+    if start_id is None:
+        last_id = _read_state(state_file).get('last_id')
+        start_id = last_id + 1 if last_id is not None else None
+    conditions = ['{} IS NOT NULL'.format(source)]
+    params = dict()
+    if start_id is not None:
+        conditions.append('id >= :start_id')
+        params['start_id'] = start_id
+    if end_id is not None:
+        conditions.append('id <= :end_id')
+        params['end_id'] = end_id
+    if missing:
+        conditions.append('{} IS NULL'.format(column))
+    query = 'SELECT id, {source} FROM {table} WHERE {conditions} ORDER BY id'.format(
+        source=source, table=table, conditions=' AND '.join(conditions))
+    banded = is_banded(table, column)
+    store = find_store(table, column) if banded else None
+
+    # reading connection keeps the server-side cursor, updates go through the session
+    reader = session.get_bind().connect()
+    result = reader.execution_options(stream_results=True).execute(text_to_query(query), params)
+    tasks = ((hasher, [tuple(row) for row in partition]) for partition in result.partitions(batch_size))
+    rows = updated = 0
+    last_id = None
+    t0 = time()
+    print('backfill {}.{} from {} with {}, {} workers, rows from id {}'.format(
+        table, column, source, hasher, workers, start_id or 'first'))
+
+    def write(hashes):
+        nonlocal rows, updated, last_id
+        session.execute(text_to_query(update_query(table, column, hashes, banded)))
+        copied = copy_to_linked(session, table, column, banded, [row_id for row_id, _ in hashes]) if linked else []
+        session.commit()
+        if store is not None:
+            log_to_store(store, hashes + copied)
+        rows += len(hashes)
+        updated += sum(bits is not None for _, bits in hashes)
+        last_id = hashes[-1][0]
+        _write_state(state_file, table=table, column=column, last_id=last_id)
+        elapsed = time() - t0
+        print('{} rows, last id {}, {:.0f} rows/sec'.format(rows, last_id, rows / elapsed if elapsed else 0))
+
+    try:
+        with Pool(workers) if workers > 1 else nullcontext() as pool:
+            # batches are written in order of ids: when a batch is committed, all rows before it are committed too.
+            # Only a few batches are in flight, the cursor is not read ahead of the writes
+            pending = deque()
+            for task in tasks:
+                if pool is None:
+                    write(hash_batch(task))
+                    continue
+                # spans and counters of workers come with their results
+                pending.append(pool.apply_async(WorkerJob(hash_batch), (task,)))
+                if len(pending) >= 2 * workers:
+                    write(merge_result(pending.popleft().get()))
+            while pending:
+                write(merge_result(pending.popleft().get()))
+    finally:
+        result.close()
+        reader.close()
+    if linked:
+        # rows linked to rows which were not in this run (e.g. with `missing`)
+        copied = copy_to_linked(session, table, column, banded)
+        session.commit()
+        if store is not None:
+            log_to_store(store, copied)
+        print('copied fingerprints to {} linked rows'.format(len(copied)))
+    elapsed = time() - t0
+    stats = dict(rows=rows, updated=updated, last_id=last_id, seconds=round(elapsed, 3),
+                 rows_per_sec=round(rows / elapsed, 1) if elapsed else 0)
+    print('done: {rows} rows ({updated} hashed) in {seconds} sec, {rows_per_sec} rows/sec, last id {last_id}'.format(
+        **stats))
+    return stats
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Recompute fingerprint column of a table in parallel')
+    parser.add_argument('table', help='table name, e.g. sections or xml_bills')
+    parser.add_argument('column', help='fingerprint column, e.g. simhash_text')
+    parser.add_argument('--source', default='text', help='text column to hash')
+    parser.add_argument('--hasher', choices=tuple(HASHERS), default='simhash128')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--start-id', type=int, help='first id, inclusive')
+    parser.add_argument('--end-id', type=int, help='last id, inclusive')
+    parser.add_argument('--missing', action='store_true', help='only rows without fingerprint')
+    parser.add_argument('--state', help='json file with the last committed id to resume from')
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    backfill(args.table, args.column, source=args.source, hasher=args.hasher, workers=args.workers,
+             batch_size=args.batch_size, start_id=args.start_id, end_id=args.end_id, missing=args.missing,
+             state_file=args.state)
+
+
+if __name__ == '__main__':
+    main()
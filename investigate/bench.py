@@ -0,0 +1,309 @@
+"""
+Benchmark suite for text processing, hashing, xml parsing, comparison and search.
+
+Bills are generated offline with `synthetic.py`, so the results don't depend on local copy of congress data.
+Results are written to json file, to compare them between commits run with `--compare`:
+
+    python bench.py --bills 100 --out bench_new.json --compare bench_old.json
+
+Only the group `search` needs config.yaml, it runs read-only queries
+against DB specified in config (enable it with `--search`), `sqlite` runs the same kind of searches
+without server, over synthetic bills loaded to in-memory `search_backend.SqliteBackend`.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from synthetic import DEFAULT_ROOT
+from synthetic import generate_corpus
+
+GROUPS = ('text', 'hash', 'parse', 'paragraph', 'vectorize', 'sqlite', 'search')
+
+
+def measure(func, items, repeat=3):
+    """
+    Call `func` for every item `repeat` times and collect statistics of the time per call
+    :param func: function of one argument
+    :param items: list of arguments
+    :param repeat: number of passes over items
+    :return: dict with statistics, times in seconds
+    """
+    timings = list()
+    for _ in range(repeat):
+        for item in items:
+            t0 = perf_counter()
+            func(item)
+            timings.append(perf_counter() - t0)
+    if not timings:
+        return dict(calls=0)
+    timings.sort()
+    total = sum(timings)
+    return dict(calls=len(timings),
+                total=round(total, 6),
+                mean=total / len(timings),
+                median=timings[len(timings) // 2],
+                p95=timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+                min=timings[0],
+                max=timings[-1],
+                per_sec=round(len(timings) / total, 3) if total else None)
+
+
+def _section_texts(paths):
+    from lxml import etree
+    from utils import get_xml_sections
+    texts = list()
+    for xml_path in paths:
+        for section in get_xml_sections(xml_path):
+            texts.append(etree.tostring(section, method='text', encoding='unicode'))
+    return texts
+
+
+def bench_text(paths, repeat):
+    from utils import text_cleaning
+    texts = _section_texts(paths)
+    return {'text_cleaning': measure(text_cleaning, texts, repeat)}
+
+
+def bench_hash(paths, repeat):
+    from utils import text_cleaning
+    from utils import build_sim_hash
+    from utils import build_128_simhash
+    cleaned = [text_cleaning(text) for text in _section_texts(paths)]
+    return {'build_sim_hash': measure(build_sim_hash, cleaned, repeat),
+            'build_128_simhash': measure(build_128_simhash, cleaned, repeat),
+            'build_128_simhash_words': measure(lambda t: build_128_simhash(t, words=True), cleaned, repeat)}
+
+
+def bench_parse(paths, repeat):
+    from bs4 import BeautifulSoup
+    from utils import get_xml_sections
+    from utils import parse_xml_section
+    from utils import parse_soup_section
+    from utils import clean_bill_text
+
+    def lxml_sections(xml_path):
+        return [parse_xml_section(section) for section in get_xml_sections(xml_path)]
+
+    def soup_sections(xml_path):
+        with open(xml_path) as xml:
+            soup = BeautifulSoup(xml, features='xml')
+        return [parse_soup_section(section) for section in soup.find_all('section')]
+
+    def soup_bill_text(xml_path):
+        with open(xml_path) as xml:
+            soup = BeautifulSoup(xml, features='xml')
+        return clean_bill_text(soup)
+
+    return {'lxml_parse_xml_section': measure(lxml_sections, paths, repeat),
+            'soup_parse_soup_section': measure(soup_sections, paths, repeat),
+            'soup_clean_bill_text': measure(soup_bill_text, paths, repeat)}
+
+
+def bench_paragraph(paths, repeat):
+    from itertools import combinations
+    from paragraph import Paragraph
+    from utils import get_xml_sections
+    from utils import parse_xml_section
+
+    sections = {xml_path: [parse_xml_section(section)['text'] for section in get_xml_sections(xml_path)]
+                for xml_path in paths}
+
+    def to_tree(xml_path):
+        nested = [{'text': text} for text in sections[xml_path]]
+        return Paragraph.from_dict({'tag': os.path.basename(xml_path), 'nested': nested})
+
+    trees = [to_tree(xml_path) for xml_path in paths]
+    Paragraph.compute_hashes_many(trees)
+    dumped = [tree.to_dict() for tree in trees]
+    pairs = list(combinations(trees, 2))[:len(trees) * 5]
+    return {'paragraph_compute_hashes': measure(lambda xml_path: to_tree(xml_path).compute_hashes(), paths, repeat),
+            'paragraph_from_dict_hashed': measure(Paragraph.from_dict, dumped, repeat),
+            'paragraph_compare': measure(lambda pair: pair[0].compare(pair[1]), pairs, repeat)}
+
+
+def bench_vectorize(paths, repeat):
+    from nltk.tokenize import RegexpTokenizer
+    from sklearn.feature_extraction.text import CountVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    from vectorize import xml_to_sections
+    from vectorize import get_document_and_section_from_xml_file
+
+    documents = [get_document_and_section_from_xml_file(xml_path) for xml_path in paths]
+    docs = [doc for doc, _ in documents]
+    sections = [sec for _, secs in documents for sec in secs]
+    results = {'xml_to_sections': measure(xml_to_sections, paths, repeat),
+               'get_document_and_section': measure(get_document_and_section_from_xml_file, paths, repeat)}
+
+    def fit(corpus):
+        vectorizer = CountVectorizer(ngram_range=(4, 4), tokenizer=RegexpTokenizer(r"\w+").tokenize,
+                                     lowercase=True)
+        vectorizer.fit(corpus)
+        return vectorizer
+
+    results['count_vectorizer_fit_docs'] = measure(fit, [docs], repeat)
+    results['count_vectorizer_fit_sections'] = measure(fit, [sections], repeat)
+    doc_vectorizer = fit(docs)
+    results['count_vectorizer_transform_doc'] = measure(lambda d: doc_vectorizer.transform([d]), docs, repeat)
+    matrix = doc_vectorizer.transform(docs)
+    results['cosine_similarity_doc_vs_corpus'] = measure(lambda i: cosine_similarity(matrix[i], matrix),
+                                                         list(range(matrix.shape[0])), repeat)
+    return results
+
+
+def _search_queries(paths):
+    """
+    Fingerprints of texts and titles of the bills: list of tuples (text hash, title hash)
+    """
+    from bs4 import BeautifulSoup
+    from utils import clean_bill_text
+    from utils import text_cleaning
+    from utils import build_128_simhash
+    queries = list()
+    for xml_path in paths:
+        with open(xml_path) as xml:
+            soup = BeautifulSoup(xml, features='xml')
+        title = soup.find('dc:title')
+        queries.append((build_128_simhash(text_cleaning(clean_bill_text(soup))),
+                        build_128_simhash(title.text if title else '')))
+    return queries
+
+
+def bench_search(paths, repeat):
+    from config import CONFIG
+    from utils import create_session
+    from test_search import search_similar_by_text
+    from test_search import search_similar_by_title
+    from main_tests import search_grouped_origins
+
+    session = create_session(CONFIG['DB_connection'])
+    queries = _search_queries(paths)
+    return {'search_similar_by_text': measure(lambda q: search_similar_by_text(session, text_hash=q[0], n=14),
+                                              queries, repeat),
+            'search_similar_by_title': measure(lambda q: search_similar_by_title(session, title_hash=q[1], n=8),
+                                               queries, repeat),
+            'search_grouped_origins': measure(lambda q: search_grouped_origins(session, hsh=q[0], n=14),
+                                              queries, repeat)}
+
+
+def bench_sqlite(paths, repeat):
+    from search_backend import SqliteBackend
+
+    backend = SqliteBackend()
+    load = measure(lambda xml_path: backend.load_files([xml_path], sections=True, bills=True), paths, repeat=1)
+    queries = _search_queries(paths)
+    return {'load_files': load,
+            'search_bills_by_text': measure(lambda q: backend.search('bills', q[0], 14), queries, repeat),
+            'search_bills_by_title': measure(lambda q: backend.search('bills', q[1], 8, column='simhash_title'),
+                                             queries, repeat),
+            'top_k_sections': measure(lambda q: backend.top_k('sections', q[0], k=10), queries, repeat)}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    paths = generate_corpus(root=args.root, bills=args.bills, sections=tuple(args.sections),
+                            subsections=args.subsections, words=args.words, seed=args.seed)
+    uslm_paths = generate_corpus(root=args.root + '_uslm', bills=args.bills, sections=tuple(args.sections),
+                                 subsections=args.subsections, words=args.words, seed=args.seed, uslm=True)
+    print('Generated {} synthetic bills in {}'.format(len(paths), args.root))
+    benchmarks = {'text': (bench_text, paths),
+                  'hash': (bench_hash, paths),
+                  'parse': (bench_parse, paths),
+                  'paragraph': (bench_paragraph, paths),
+                  'vectorize': (bench_vectorize, uslm_paths),
+                  'sqlite': (bench_sqlite, paths),
+                  'search': (bench_search, paths)}
+    groups = args.only or [g for g in GROUPS if g != 'search' or args.search]
+    results = dict()
+    skipped = dict()
+    for group in groups:
+        func, group_paths = benchmarks[group]
+        print('- {} ...'.format(group))
+        try:
+            group_results = func(group_paths, args.repeat)
+        except Exception as e:
+            # missing config.yaml, DB is not available etc.
+            skipped[group] = '{}: {}'.format(type(e).__name__, e)
+            print('  skipped: {}'.format(skipped[group]))
+            continue
+        for name, stats in group_results.items():
+            results['{}.{}'.format(group, name)] = stats
+    return {'meta': {'commit': _git_commit(),
+                     'created': datetime.now().isoformat(timespec='seconds'),
+                     'python': sys.version.split()[0],
+                     'platform': platform.platform(),
+                     'params': {'bills': args.bills, 'sections': args.sections, 'subsections': args.subsections,
+                                'words': args.words, 'seed': args.seed, 'repeat': args.repeat},
+                     'skipped': skipped},
+            'results': results}
+
+
+def compare_results(old, new, tolerance=0.1):
+    """
+    Print comparison of mean times of two benchmark runs
+    :param old: results loaded from json of previous run
+    :param new: results of the current run
+    :param tolerance: relative change which is treated as noise
+    :return: list of names of benchmarks that became slower
+    """
+    slower = list()
+    print('{:<55} {:>12} {:>12} {:>8}'.format('benchmark', 'old, ms', 'new, ms', 'ratio'))
+    for name, stats in new['results'].items():
+        old_stats = old['results'].get(name)
+        if not old_stats or not old_stats.get('mean') or not stats.get('mean'):
+            continue
+        ratio = stats['mean'] / old_stats['mean']
+        mark = ''
+        if ratio > 1 + tolerance:
+            mark = 'SLOWER'
+            slower.append(name)
+        elif ratio < 1 - tolerance:
+            mark = 'faster'
+        print('{:<55} {:>12.3f} {:>12.3f} {:>8.2f} {}'.format(name, old_stats['mean'] * 1000,
+                                                           stats['mean'] * 1000, ratio, mark))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks on synthetic bills')
+    parser.add_argument('--bills', type=int, default=50, help='number of synthetic bills')
+    parser.add_argument('--sections', type=int, nargs=2, default=(3, 20), metavar=('MIN', 'MAX'),
+                        help='number of sections per bill')
+    parser.add_argument('--subsections', type=int, default=3, help='maximum subsections per section')
+    parser.add_argument('--words', type=int, default=120, help='approximate words per section')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--root', default=DEFAULT_ROOT, help='folder for synthetic bills')
+    parser.add_argument('--only', nargs='+', choices=GROUPS, help='run only these groups')
+    parser.add_argument('--search', action='store_true', help='run search benchmarks against DB from config')
+    parser.add_argument('--out', default='bench_results.json', help='json file to write results')
+    parser.add_argument('--compare', help='json file with results of previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    with open(args.out, 'w') as out:
+        json.dump(report, out, indent=2)
+    print('Results saved to {}'.format(args.out))
+    if args.compare:
+        with open(args.compare) as previous:
+            slower = compare_results(json.load(previous), report, tolerance=args.tolerance)
+        if slower:
+            print('{} benchmarks became slower'.format(len(slower)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,28 +2,46 @@
 ORM model for bill stored in DB
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy import BigInteger, Boolean, Column, Index, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import BIT, JSON, TIMESTAMP
+from sqlalchemy.orm import deferred
+from sqlalchemy.dialects.postgresql import ARRAY, BIT, JSON, TIMESTAMP
 from config import CONFIG
 
 
 Base = declarative_base()
 
+# number of bands each 128 bit fingerprint is split to for index lookups, see `add_band_columns`
+SIMHASH_BANDS = CONFIG.get('SIMHASH_BANDS', 8)
+
+
+def table_name(key, default):
+    """
+    Name of the table from `DB_connection` of config, the default if it's not set (or there is no config file)
+    """
+    return (CONFIG.get('DB_connection') or dict()).get(key, default)
+
 
 class Bill(Base):
-    __tablename__ = CONFIG['DB_connection']['bills_table_name']
+    __tablename__ = table_name('bills_table_name', 'xml_bills')
     id = Column(Integer, primary_key=True)
     title = Column(Text)
-    bill_text = Column(Text, name='text')
+    # large columns are deferred: loaded on access, see `test_search.load_texts` to load them for many rows at once
+    bill_text = deferred(Column(Text, name='text'), group='text')
     simhash_text = Column(BIT(128))
+    # 64 bit simhash of char 4-grams as signed integer, the first stage of `fingerprint_index.CascadeIndex`
+    simhash_text64 = Column(BigInteger, nullable=True)
     simhash_title = Column(BIT(128))
     origin = Column(String(255))
     pagenum = Column(Integer)
     label = Column(String(100))
     xml_id = Column(String(50))
     parent_bill_id = Column(Integer, nullable=True)
-    meta_info = Column(JSON)
+    meta_info = deferred(Column(JSON))
+    # unique word 4-grams of the text, for similarity scores with `smlar`
+    text_query_index_col = deferred(Column(ARRAY(Text), nullable=True))
+    # cluster of near-duplicate fingerprints, see `clusters.py`
+    cluster_id = Column(Integer, index=True, nullable=True)
 
     created = Column(TIMESTAMP, default=datetime.now())
 
@@ -32,26 +50,114 @@ class Bill(Base):
 
 
 class Section(Base):
-    __tablename__ = CONFIG['DB_connection']['sections_table_name']
+    __tablename__ = table_name('sections_table_name', 'sections')
     id = Column(Integer, primary_key=True)
     bill_id = Column(Integer, nullable=True)
     bill_origin = Column(String(255))
-    text = Column(Text)
+    text = deferred(Column(Text), group='text')
     section_id = Column(String(50))
     parent_id = Column(String(50))
     label = Column(String(200))
     header = Column(String(225))
     simhash_text = Column(BIT(128))
+    simhash_text64 = Column(BigInteger, nullable=True)
     hash_ngrams = Column(BIT(128))
     hash_words = Column(BIT(128))
     pagenum = Column(Integer)
     length = Column(Integer, nullable=True)
+    # unique word 4-grams of the text, filled for top level sections only
+    text_query_index_col = deferred(Column(ARRAY(Text), nullable=True))
+    # text version of the bill (ih, rh, eh, enr ...)
+    version = Column(String(20), nullable=True)
+    # sha1 of the cleaned text, the same for unchanged sections of different versions, see `main_tests.text_digest`
+    digest = Column(String(40), index=True, nullable=True)
+    # unchanged section is stored without text (but with fingerprints), linked to the section with the same text
+    linked_section_id = Column(Integer, index=True, nullable=True)
+    # cluster of near-duplicate fingerprints, see `clusters.py`
+    cluster_id = Column(Integer, index=True, nullable=True)
 
     created = Column(TIMESTAMP, onupdate=datetime.now(), default=datetime.now())
 
 
+class SectionContent(Base):
+    """
+    Unique text of the section, stored and fingerprinted once.
+    Sections of bills refer to it with `SectionRef`.
+    """
+    __tablename__ = table_name('section_contents_table_name', 'section_contents')
+    id = Column(Integer, primary_key=True)
+    # sha1 of the cleaned text
+    digest = Column(String(40), unique=True, nullable=False)
+    text = Column(Text)
+    simhash_text = Column(BIT(128))
+    simhash_text64 = Column(BigInteger, nullable=True)
+    text_query_index_col = Column(ARRAY(Text), nullable=True)
+    length = Column(Integer, nullable=True)
+
+    created = Column(TIMESTAMP, default=datetime.now())
+
+
+class SectionRef(Base):
+    """
+    Section of the bill: (bill origin, section_id) --> unique content
+    """
+    __tablename__ = table_name('section_refs_table_name', 'section_refs')
+    id = Column(Integer, primary_key=True)
+    content_id = Column(Integer, index=True, nullable=False)
+    bill_origin = Column(String(255), index=True)
+    section_id = Column(String(50))
+    parent_id = Column(String(50))
+    header = Column(String(225))
+    version = Column(String(20), nullable=True)
+
+    created = Column(TIMESTAMP, default=datetime.now())
+
+
+class SimhashCluster(Base):
+    """
+    Group of rows of `table_name` with near-duplicate fingerprints, see `clusters.py`.
+    Clusters used in many bills are boilerplate (short titles, authorizations of appropriations etc.)
+    """
+    __tablename__ = table_name('simhash_clusters_table_name', 'simhash_clusters')
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(100), index=True)
+    representative_id = Column(Integer)
+    size = Column(Integer)
+    # number of distinct bills the rows belong to
+    origins = Column(Integer)
+    boilerplate = Column(Boolean, default=False)
+
+    created = Column(TIMESTAMP, default=datetime.now())
+
+
 class BillPath(Base):
-    __tablename__ = CONFIG['DB_connection']['bill_path_table_name']
+    __tablename__ = table_name('bill_path_table_name', 'bill_path')
     id = Column(Integer, primary_key=True)
     origin = Column(String(255))
     full_path = Column(String(255))
+
+
+def add_band_columns(model, column_name, bands=SIMHASH_BANDS):
+    """
+    Add to the model integer columns derived from bit(128) fingerprint `column_name`:
+    `<column_name>_hi`, `<column_name>_lo` - two 64 bit halves,
+    `<column_name>_b0` ... `<column_name>_b<bands-1>` - bands of 128/bands bits with B-tree indexes,
+    bit j of the fingerprint goes to band j % bands (see `utils.band_bits`).
+    Search by Hamming distance lower than `bands` can use equality on bands, see `utils.hamming_condition`.
+    """
+    width = 128 // bands
+    setattr(model, column_name + '_hi', Column(BigInteger, nullable=True))
+    setattr(model, column_name + '_lo', Column(BigInteger, nullable=True))
+    table = model.__table__
+    for i in range(bands):
+        name = '{}_b{}'.format(column_name, i)
+        setattr(model, name, Column(BigInteger if width > 31 else Integer, nullable=True))
+        Index('ix_{}_{}'.format(table.name, name), table.c[name])
+
+
+# fingerprints stored with bands: (model, column name)
+BANDED_COLUMNS = ((Bill, 'simhash_text'), (Bill, 'simhash_title'), (Section, 'simhash_text'),
+                  (SectionContent, 'simhash_text'))
+
+for _model, _column_name in BANDED_COLUMNS:
+    add_band_columns(_model, _column_name)
@@ -0,0 +1,294 @@
+"""
+Single command line entry point with subcommands:
+
+    python cli.py ingest --sections --workers 4
+    python cli.py watch --sections --pattern document.xml
+    python cli.py search --text "To amend title 38..." -n 8
+    python cli.py search --text "To amend title 38..." --sections --sqlite search.sqlite
+    python cli.py rank path/to/document.xml --top-k 10
+    python cli.py cluster --table sections
+    python cli.py build-models
+    python cli.py compare BILLS-116s1790enr.xml BILLS-116hjres31enr.xml
+    python cli.py bench --bills 20
+
+Heavy dependencies (SQLAlchemy, bs4, sklearn, nltk...) are imported only inside the subcommand which needs them
+and config.yaml is read on the first access, so `python cli.py --help` starts in milliseconds.
+Add `--timing` to print the startup time (interpreter + cli) and the time of importing modules of the subcommand.
+"""
+from time import perf_counter
+
+_T0 = perf_counter()
+
+import argparse
+import os
+import sys
+
+import config
+
+
+def ingest(args):
+    import main_tests
+    if args.create_db:
+        main_tests.create_db()
+    if args.migrate:
+        main_tests.migrate_db()
+    if args.sections or args.bills or args.all:
+        main_tests.parse_and_load(sections=args.sections, bills=args.bills, full=args.all, workers=args.workers,
+                                  versions=args.versions, dedup=args.dedup)
+
+
+def watch(args):
+    import watch as watch_module
+    watch_module.watch(root=args.root, pattern=args.pattern, sections=args.sections or args.all,
+                       bills=args.bills or args.all, versions=args.versions, dedup=args.dedup, workers=args.workers,
+                       settle=args.settle, batch_size=args.batch_size, max_delay=args.max_delay,
+                       polling=args.polling, catch_up=args.catch_up)
+
+
+def search(args):
+    from config import CONFIG
+    from utils import create_session
+    from bill import Bill, Section
+    import test_search
+    if args.sqlite:
+        return search_sqlite(args)
+    session = create_session(CONFIG['DB_connection'])
+    if args.contents:
+        rows = test_search.search_similar_contents(session, text=args.text, text_hash=args.hash, n=args.n)
+        for row in rows:
+            print(f'ID: {row.id}  distance: {row.distance}  used in {len(row.refs)} sections: {", ".join(row.refs[:5])}')
+            print(f' "{row.text[:155]}..."\n')
+        return
+    if args.top_k:
+        model = 'sections' if args.sections else 'bills'
+        column = 'simhash_title' if args.title else 'simhash_text'
+        found = test_search.search_top_k(session, k=args.top_k, text=args.text or args.title, text_hash=args.hash,
+                                         model=model, column=column, max_distance=args.max_distance,
+                                         boilerplate=args.boilerplate)
+        for hit in found:
+            print(f'ID: {hit.id}  distance: {hit.distance}  origin: {hit.origin}  "{hit.title or ""}"')
+        return
+    if args.title:
+        found = test_search.search_similar_by_title(session, title=args.title, n=args.n)
+    else:
+        found = test_search.search_similar_by_text(session, text=args.text, text_hash=args.hash, bill_id=args.bill_id,
+                                                   n=args.n, boilerplate=args.boilerplate)
+    print(f'found {len(found)} similar entities')
+    for bill in found:
+        print(f'ID: {bill.id}  origin: {bill.origin}\n "{bill.title}" \n')
+
+
+def search_sqlite(args):
+    from utils import build_128_simhash, text_cleaning
+    from search_backend import SqliteBackend
+    if not (args.text or args.title or args.hash):
+        print('ERROR, --sqlite searches by --text, --title or --hash')
+        return 1
+    model = 'sections' if args.sections else 'bills'
+    column = 'simhash_title' if args.title else 'simhash_text'
+    bits = args.hash or build_128_simhash(text_cleaning(args.text or args.title))
+    with SqliteBackend(args.sqlite) as backend:
+        if args.top_k:
+            found = backend.top_k(model, bits, k=args.top_k, column=column, max_distance=args.max_distance)
+        else:
+            found = backend.search(model, bits, args.n, column=column)
+        print(f'found {len(found)} similar entities')
+        for hit in found:
+            print(f'ID: {hit.id}  distance: {hit.distance}  origin: {hit.origin}  "{hit.title or ""}"')
+
+
+def rank(args):
+    from config import CONFIG
+    from utils import create_session
+    import test_search
+    session = create_session(CONFIG['DB_connection'])
+    if args.index:
+        index, origins = test_search.load_sections_index(session)
+        related = test_search.rank_related_bills_in_index(index, origins, xml_path=args.xml_path, n=args.n,
+                                                          top_k=args.top_k)
+    else:
+        related = test_search.rank_related_bills(session, xml_path=args.xml_path, n=args.n, top_k=args.top_k,
+                                                 boilerplate=args.boilerplate)
+    for bill in related:
+        print('{origin}: {matched_sections} sections matched ({coverage:.0%}), score {score}'.format(**bill))
+        if args.evidence:
+            for evidence in bill['evidence']:
+                print('    section #{section} ~ section id {id}, distance {distance}'.format(**evidence))
+
+
+def cluster(args):
+    from config import CONFIG
+    from utils import create_session
+    from bill import Bill, Section
+    import clusters
+    session = create_session(CONFIG['DB_connection'])
+    for model in (Section, Bill) if args.table == 'all' else (Section if args.table == 'sections' else Bill,):
+        clusters.cluster_table(session, model, distance=args.distance, min_origins=args.min_origins)
+
+
+def build_models(args):
+    import vectorize
+    if args.pickle:
+        vectorize.create_models()
+    else:
+        vectorize.update_vocabularies()
+    if args.matrices:
+        vectorize.build_corpus_matrices(args.matrices_folder or vectorize.MATRICES_FOLDER)
+
+
+def compare(args):
+    import vectorize
+    from utils import get_all_file_paths
+    models = vectorize.load_models(args.doc_model, args.sections_model)
+    paths = [p for path in args.path_b for p in (get_all_file_paths(path, ext='xml') if os.path.isdir(path) else [path])]
+    if len(paths) == 1 and not args.corpus:
+        response = vectorize.compare_files(args.path_a, paths[0], *models)
+        if response:
+            print(response)
+        return
+    if args.corpus:
+        candidates = vectorize.CandidateMatrices.load(args.corpus)
+    elif paths:
+        candidates = vectorize.CandidateMatrices.from_files(paths, *models)
+    else:
+        print('ERROR, give bills to compare with or --corpus')
+        return 1
+    for match in vectorize.compare_many(args.path_a, candidates, *models, top_k=args.top_k, workers=args.workers):
+        section_scores = match['section_scores']
+        best = section_scores.max(axis=1) if section_scores.size else section_scores
+        print('{}: score {:.4f}, {} of {} sections matched'.format(
+            match['origin'] or match['key'], match['score'], int((best > 10 ** -2).sum()), len(best)))
+
+
+def bench(args):
+    import bench as bench_module
+    return bench_module.main(args.bench_args)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Similar bills: ingestion, search and comparison')
+    parser.add_argument('--config', help='path to config.yaml, by default env BILLSIM_CONFIG or ./config.yaml')
+    parser.add_argument('--timing', action='store_true', help='print startup and import times')
+    parser.add_argument('--metrics', action='store_true', help='enable metrics, see metrics.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='parse xml bills and load them to DB')
+    ingest_parser.add_argument('--create-db', action='store_true', help='create tables')
+    ingest_parser.add_argument('--migrate', action='store_true', help='add new columns and indexes to tables')
+    ingest_parser.add_argument('--sections', action='store_true', help='load sections')
+    ingest_parser.add_argument('--bills', action='store_true', help='load bills as a whole')
+    ingest_parser.add_argument('--all', action='store_true', help='load bills and sections')
+    ingest_parser.add_argument('--workers', type=int, default=1, help='number of parsing processes')
+    ingest_parser.add_argument('--versions', action='store_true', help='link sections unchanged between versions')
+    ingest_parser.add_argument('--dedup', action='store_true', help='store unique section texts once')
+    ingest_parser.set_defaults(func=ingest)
+
+    watch_parser = subparsers.add_parser('watch', help='load new and changed xml bills as they arrive')
+    watch_parser.add_argument('--root', help='folder to watch, by default CONGRESS_ROOT_FOLDER')
+    watch_parser.add_argument('--pattern', default='*.xml', help='file names to load, e.g. document.xml')
+    for flag in ('sections', 'bills', 'all', 'versions', 'dedup'):
+        watch_parser.add_argument('--' + flag, action='store_true', help='as in ingest')
+    watch_parser.add_argument('--workers', type=int, default=1)
+    watch_parser.add_argument('--settle', type=float, default=2.0, help='seconds a file must stay unchanged')
+    watch_parser.add_argument('--batch-size', type=int, default=20, help='files in one micro-batch')
+    watch_parser.add_argument('--max-delay', type=float, default=5.0, help='seconds a ready file waits for batch')
+    watch_parser.add_argument('--polling', action='store_true', help='scan the folder instead of inotify')
+    watch_parser.add_argument('--catch-up', action='store_true', help='load files of bills not in DB at start')
+    watch_parser.set_defaults(func=watch)
+
+    search_parser = subparsers.add_parser('search', help='search similar bills or sections in DB')
+    query = search_parser.add_mutually_exclusive_group(required=True)
+    query.add_argument('--text', help='text to search')
+    query.add_argument('--title', help='title to search')
+    query.add_argument('--hash', help='128 bit simhash as bit string')
+    query.add_argument('--bill-id', type=int, help='search bills similar to the bill with this id')
+    search_parser.add_argument('-n', type=int, default=6, help='Hamming distance threshold')
+    search_parser.add_argument('--contents', action='store_true', help='search unique section texts')
+    search_parser.add_argument('--top-k', type=int, help='k closest rows with distances, radius is widened as needed')
+    search_parser.add_argument('--max-distance', type=int, help='the largest radius of --top-k')
+    search_parser.add_argument('--sections', action='store_true', help='search sections instead of bills')
+    search_parser.add_argument('--sqlite', help='search in SQLite file of search_backend.py instead of DB')
+    search_parser.add_argument('--boilerplate', choices=('include', 'exclude', 'collapse'), default='include',
+                               help='rows of boilerplate clusters, see clusters.py')
+    search_parser.set_defaults(func=search)
+
+    rank_parser = subparsers.add_parser('rank', help='rank bills related to the bill by all its sections')
+    rank_parser.add_argument('xml_path')
+    rank_parser.add_argument('-n', type=int, default=4, help='Hamming distance threshold of sections')
+    rank_parser.add_argument('--top-k', type=int, default=10)
+    rank_parser.add_argument('--boilerplate', choices=('include', 'exclude'), default='include')
+    rank_parser.add_argument('--index', action='store_true', help='rank over in-memory index instead of sql')
+    rank_parser.add_argument('--evidence', action='store_true', help='print matched sections')
+    rank_parser.set_defaults(func=rank)
+
+    cluster_parser = subparsers.add_parser('cluster', help='cluster near-duplicate fingerprints, flag boilerplate')
+    cluster_parser.add_argument('--table', choices=('sections', 'bills', 'all'), default='sections')
+    cluster_parser.add_argument('--distance', type=int, help='Hamming distance threshold')
+    cluster_parser.add_argument('--min-origins', type=int, help='minimal number of bills of boilerplate cluster')
+    cluster_parser.set_defaults(func=cluster)
+
+    models_parser = subparsers.add_parser('build-models', help='add new bills to n-gram vocabularies')
+    models_parser.add_argument('--pickle', action='store_true', help='refit count-vectorizers and pickle them instead')
+    models_parser.add_argument('--matrices', action='store_true', help='vectorize all bills of DB to .npy matrices')
+    models_parser.add_argument('--matrices-folder', help='by default MATRICES_FOLDER of config')
+    models_parser.set_defaults(func=build_models)
+
+    compare_parser = subparsers.add_parser('compare', help='compare xml bill with other bills with saved models')
+    compare_parser.add_argument('path_a')
+    compare_parser.add_argument('path_b', nargs='*', help='xml bill, several bills or folders to rank top matches')
+    compare_parser.add_argument('--corpus', help='folder of matrices built by `build-models --matrices` to rank')
+    compare_parser.add_argument('--top-k', type=int, default=10, help='number of matches of several bills')
+    compare_parser.add_argument('--workers', type=int, default=4, help='threads of sparse products')
+    compare_parser.add_argument('--doc-model', default='CV_model.pkl')
+    compare_parser.add_argument('--sections-model', default='CV_sections_model.pkl')
+    compare_parser.set_defaults(func=compare)
+
+    bench_parser = subparsers.add_parser('bench', help='run benchmarks, other arguments are passed to bench.py',
+                                         add_help=False)
+    bench_parser.set_defaults(func=bench)
+    return parser
+
+
+def _process_uptime():
+    """
+    Seconds since start of the process (includes interpreter startup), None if unknown
+    """
+    try:
+        with open('/proc/self/stat') as stat:
+            start_ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime:
+            system_uptime = float(uptime.read().split()[0])
+        return system_uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def main(argv=None):
+    parser = create_parser()
+    args, extra = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        args.bench_args = extra
+    elif extra:
+        parser.error('unrecognized arguments: {}'.format(' '.join(extra)))
+    if args.config:
+        config.set_config_file(args.config)
+    if args.timing:
+        uptime = _process_uptime()
+        process = ', process {:.0f} ms'.format(uptime * 1000) if uptime is not None else ''
+        print('startup: cli {:.1f} ms{}'.format((perf_counter() - _T0) * 1000, process), file=sys.stderr)
+    if args.metrics:
+        import metrics
+        metrics.configure(enabled=True)
+    before = set(sys.modules)
+    t0 = perf_counter()
+    try:
+        return args.func(args)
+    finally:
+        if args.timing:
+            loaded = len(set(sys.modules) - before)
+            print('{}: {:.3f} sec, {} modules imported'.format(args.command, perf_counter() - t0, loaded),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
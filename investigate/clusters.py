@@ -0,0 +1,279 @@
+"""
+Offline clustering of near-duplicate fingerprints.
+
+Rows which fingerprints have Hamming distance lower than `distance` are joined to one cluster (union-find),
+so the cluster is a connected component of the "near duplicate" graph.
+Candidate pairs are rows with an equal band of the fingerprint (pigeonhole principle, as in `utils.hamming_condition`),
+exact distance is counted only for them. Equal fingerprints are collapsed to one node before that, and in large groups
+of equal band values every row is paired only with its `window` neighbours in order of fingerprints,
+so thousands of copies of boilerplate don't produce billions of pairs.
+Clusters which rows belong to at least `min_origins` different bills are flagged as boilerplate.
+
+Run after loading new bills (new rows have no cluster until the next run):
+    python clusters.py sections
+    python clusters.py xml_bills
+
+Searches take `boilerplate` argument:
+    'include' - as before, all rows,
+    'exclude' - skip rows of boilerplate clusters,
+    'collapse' - only the closest row of every boilerplate cluster.
+"""
+import sys
+from time import time
+
+import numpy as np
+
+from config import CONFIG
+from fingerprint_index import popcount64
+
+BOILERPLATE_MODES = ('include', 'exclude', 'collapse')
+
+
+class UnionFind:
+    """
+    Disjoint sets of integers 0..size-1 with path compression and union by size
+    """
+    def __init__(self, size):
+        self.parent = np.arange(size)
+        self.size = np.ones(size, dtype=np.int64)
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def find_all(self, items):
+        """
+        Roots of all items, vectorized
+        """
+        roots = self.parent[items]
+        while True:
+            parents = self.parent[roots]
+            if (parents == roots).all():
+                return roots
+            roots = parents
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+    def union_pairs(self, left, right):
+        """
+        Union of every pair (left[i], right[i]); pairs already in one set are skipped without python loop
+        :return: number of merges
+        """
+        different = self.find_all(left) != self.find_all(right)
+        return sum(self.union(a, b) for a, b in zip(left[different].tolist(), right[different].tolist()))
+
+
+def band_values(hi, lo, bands=8):
+    """
+    Bands of fingerprints given as uint64 halves, the same values as `utils.split_simhash` gives:
+    bit j of the fingerprint (from the highest bit of `hi`) goes to band j % bands
+    :return: list of `bands` arrays
+    """
+    if 128 % bands:
+        raise ValueError('128 should be divisible by the number of bands, got {} bands'.format(bands))
+    one = np.uint64(1)
+    values = list()
+    for i in range(bands):
+        value = np.zeros(len(hi), dtype=np.uint64)
+        for j in range(i, 128, bands):
+            half, position = (hi, j) if j < 64 else (lo, j - 64)
+            value = (value << one) | ((half >> np.uint64(63 - position)) & one)
+        values.append(value)
+    return values
+
+
+def _equal_band_pairs(band, hi, lo, window=None):
+    """
+    Pairs (i, j) of rows with equal band value, yielded in chunks by offset in sorted order.
+    Rows are sorted by band, then by fingerprint, so close offsets pair the most similar rows of the group.
+    :param window: maximal offset, a group of k rows gives at most k * window pairs instead of k * (k - 1) / 2
+    """
+    order = np.lexsort((lo, hi, band))
+    sorted_band = band[order]
+    starts = np.arange(len(order))
+    offset = 1
+    while window is None or offset <= window:
+        starts = starts[starts + offset < len(order)]
+        # sorted: if band at p equals band at p+offset, it also equals all between them
+        starts = starts[sorted_band[starts] == sorted_band[starts + offset]]
+        if not len(starts):
+            return
+        yield order[starts], order[starts + offset]
+        offset += 1
+
+
+def cluster_fingerprints(hi, lo, distance=4, bands=8, window=256):
+    """
+    Connected components of fingerprints with Hamming distance lower than `distance`
+    :param hi: high 64 bit halves of fingerprints, int64 or uint64 array
+    :param lo: low halves
+    :param distance: Hamming distance threshold, should be <= bands
+    :param bands: number of bands to find candidate pairs
+    :param window: in groups of more than `window` fingerprints with an equal band, compare every fingerprint
+        only with `window` neighbours (None - all pairs). Near duplicates out of the window are still joined
+        if they have other equal bands or a chain of near rows between them.
+    :return: array of cluster labels, equal for rows of one cluster
+    """
+    if distance > bands:
+        raise ValueError('distance {} is too large for {} bands'.format(distance, bands))
+    hi = np.asarray(hi, dtype=np.int64).view(np.uint64)
+    lo = np.asarray(lo, dtype=np.int64).view(np.uint64)
+    # equal fingerprints are one node of the graph: duplicates get the label of their node, without pairs
+    unique, inverse = np.unique(np.stack([hi, lo], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique_hi, unique_lo = unique[:, 0].copy(), unique[:, 1].copy()
+    union_find = UnionFind(len(unique))
+    for band in band_values(unique_hi, unique_lo, bands):
+        for left, right in _equal_band_pairs(band, unique_hi, unique_lo, window):
+            near = (popcount64(unique_hi[left] ^ unique_hi[right]) +
+                    popcount64(unique_lo[left] ^ unique_lo[right])) < distance
+            union_find.union_pairs(left[near], right[near])
+    return union_find.find_all(np.arange(len(unique)))[inverse]
+
+
+def _load_fingerprints(session, table, column, origin_column):
+    from sqlalchemy import text as text_to_query
+    query = 'SELECT id, {col}_hi, {col}_lo, {origin} FROM {table} WHERE {col}_hi IS NOT NULL ORDER BY id'.format(
+        col=column, origin=origin_column, table=table)
+    rows = session.execute(text_to_query(query)).all()
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    hi = np.array([r[1] for r in rows], dtype=np.int64)
+    lo = np.array([r[2] for r in rows], dtype=np.int64)
+    _, origins = np.unique(np.array([r[3] or '' for r in rows], dtype=object), return_inverse=True)
+    return ids, hi, lo, origins.reshape(-1)
+
+
+def cluster_table(session, model, column='simhash_text', distance=None, min_origins=None, bands=None, window=None):
+    """
+    Cluster fingerprints of the table and store clusters (`bill.SimhashCluster`) and `cluster_id` of rows.
+    Previous clusters of the table are replaced, rows not similar to any other row have no cluster.
+    :param session: db_session
+    :param model: Bill or Section
+    :param column: fingerprint column with bands, see `bill.add_band_columns`
+    :param distance: Hamming distance threshold, default `BOILERPLATE.distance` of config
+    :param min_origins: minimal number of bills for boilerplate cluster, default `BOILERPLATE.min_origins`
+    :param window: neighbours compared in large groups of equal bands, default `BOILERPLATE.window`,
+        see `cluster_fingerprints`
+    :return: dict with numbers of rows, clusters and boilerplate clusters
+    """
+    from sqlalchemy import delete, insert, update
+    from sqlalchemy import text as text_to_query
+    from bill import SimhashCluster, SIMHASH_BANDS
+    settings = CONFIG.get('BOILERPLATE') or dict()
+    distance = distance or settings.get('distance', 4)
+    min_origins = min_origins or settings.get('min_origins', 20)
+    window = window or settings.get('window', 256)
+    bands = bands or SIMHASH_BANDS
+    table = model.__tablename__
+    origin_column = 'bill_origin' if 'bill_origin' in model.__table__.c else 'origin'
+
+    t0 = time()
+    ids, hi, lo, origins = _load_fingerprints(session, table, column, origin_column)
+    print('loaded {} fingerprints of {} in {:.3f} sec'.format(len(ids), table, time() - t0))
+    t0 = time()
+    labels = cluster_fingerprints(hi, lo, distance=distance, bands=bands, window=window) if len(ids) \
+        else np.array([], dtype=np.int64)
+    print('clustered in {:.3f} sec'.format(time() - t0))
+
+    _, cluster_index, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    cluster_index = cluster_index.reshape(-1)
+    # rows are ordered by id, so the first row of the cluster is its oldest row
+    order = np.argsort(cluster_index, kind='stable')
+    starts = np.r_[0, np.flatnonzero(np.diff(cluster_index[order])) + 1] if len(order) else np.array([], dtype=int)
+    origin_pairs = np.unique(np.stack([cluster_index, origins], axis=1), axis=0) if len(ids) else np.zeros((0, 2))
+    origin_counts = np.bincount(origin_pairs[:, 0].astype(np.int64), minlength=len(sizes))
+
+    clusters = [dict(table_name=table,
+                     representative_id=int(ids[order[start]]),
+                     size=int(sizes[k]),
+                     origins=int(origin_counts[k]),
+                     boilerplate=bool(origin_counts[k] >= min_origins))
+                for k, start in enumerate(starts) if sizes[k] > 1]
+
+    session.execute(update(model).where(model.cluster_id.isnot(None)).values(cluster_id=None))
+    session.execute(delete(SimhashCluster).where(SimhashCluster.table_name == table))
+    cluster_ids = dict()
+    for batch_start in range(0, len(clusters), 10000):
+        batch = clusters[batch_start:batch_start + 10000]
+        result = session.execute(insert(SimhashCluster).values(batch)
+                                 .returning(SimhashCluster.representative_id, SimhashCluster.id))
+        cluster_ids.update(dict(result.all()))
+    # cluster id of every row in clusters of more than one row
+    row_cluster = {k: cluster_ids[int(ids[order[start]])] for k, start in enumerate(starts) if sizes[k] > 1}
+    members = [(int(row_id), row_cluster[k]) for row_id, k in zip(ids, cluster_index.tolist()) if k in row_cluster]
+    for batch_start in range(0, len(members), 10000):
+        values = ', '.join('({}, {})'.format(*member) for member in members[batch_start:batch_start + 10000])
+        session.execute(text_to_query('UPDATE {table} AS t SET cluster_id = v.cluster_id '
+                                      'FROM (VALUES {values}) AS v(id, cluster_id) WHERE t.id = v.id'
+                                      .format(table=table, values=values)))
+    session.commit()
+    stats = dict(rows=len(ids), clustered_rows=len(members), clusters=len(clusters),
+                 boilerplate=sum(c['boilerplate'] for c in clusters),
+                 boilerplate_rows=sum(c['size'] for c in clusters if c['boilerplate']))
+    print('{table}: {clusters} clusters of {clustered_rows} rows, '
+          '{boilerplate} boilerplate clusters of {boilerplate_rows} rows'.format(table=table, **stats))
+    return stats
+
+
+def _clusters_table():
+    return CONFIG['DB_connection'].get('simhash_clusters_table_name', 'simhash_clusters')
+
+
+def boilerplate_condition(alias=''):
+    """
+    SQL condition: the row doesn't belong to a boilerplate cluster
+    """
+    prefix = '{}.'.format(alias) if alias else ''
+    return '({p}cluster_id IS NULL OR {p}cluster_id NOT IN (SELECT id FROM {clusters} WHERE boilerplate))'.format(
+        p=prefix, clusters=_clusters_table())
+
+
+def collapse_key(alias=''):
+    """
+    SQL expression equal for rows of one boilerplate cluster and unique for other rows
+    """
+    prefix = '{}.'.format(alias) if alias else ''
+    return ('CASE WHEN {p}cluster_id IN (SELECT id FROM {clusters} WHERE boilerplate) '
+            'THEN -{p}cluster_id ELSE {p}id END'.format(p=prefix, clusters=_clusters_table()))
+
+
+def apply_boilerplate(table, condition, boilerplate='include', order_by=None):
+    """
+    FROM clause source: rows of the table matching the condition, with boilerplate clusters excluded or collapsed
+    :param table: table name
+    :param condition: SQL condition of the search
+    :param boilerplate: 'include', 'exclude' or 'collapse', see module docs
+    :param order_by: SQL expression to choose the row of collapsed cluster (the lowest), e.g. distance
+    :return: string to use as `SELECT ... FROM <result>`
+    """
+    if boilerplate not in BOILERPLATE_MODES:
+        raise ValueError('boilerplate should be one of {}, got {}'.format(BOILERPLATE_MODES, boilerplate))
+    if boilerplate == 'include':
+        return '(SELECT * FROM {} WHERE {}) AS found'.format(table, condition)
+    if boilerplate == 'exclude':
+        return '(SELECT * FROM {} WHERE {} AND {}) AS found'.format(table, condition, boilerplate_condition())
+    key = collapse_key()
+    return ('(SELECT DISTINCT ON ({key}) * FROM {table} WHERE {condition} ORDER BY {key}{order}) AS found'
+            .format(key=key, table=table, condition=condition, order=', ' + order_by if order_by else ''))
+
+
+if __name__ == '__main__':
+    from bill import Bill, Section
+    from utils import create_session
+    models = {Bill.__tablename__: Bill, Section.__tablename__: Section}
+    names = sys.argv[1:] or [Section.__tablename__]
+    db_session = create_session(CONFIG['DB_connection'])
+    for name in names:
+        cluster_table(db_session, models[name])
@@ -1,18 +1,66 @@
 """
 Just to simplify functionality, we will create config as a dictionary and keep it here
 
-CONFIG is read from 'config.yaml' as a dict
+CONFIG is read from 'config.yaml' as a dict.
+The file is read lazily, on the first access to CONFIG, so importing modules doesn't require it;
+`CONFIG.get(key, default)` returns the default when there is no file.
+Path of the file: env variable `BILLSIM_CONFIG`, `set_config_file(path)` or 'config.yaml' in the current folder.
 
 """
 
 import os
-import yaml
+from collections.abc import Mapping
 
-CONFIG_FILE_NAME = os.path.join(os.getcwd(), 'config.yaml')
+CONFIG_FILE_NAME = os.environ.get('BILLSIM_CONFIG', os.path.join(os.getcwd(), 'config.yaml'))
 
-try:
-    with open(CONFIG_FILE_NAME, 'r') as cfg_file:
-        CONFIG = yaml.safe_load(cfg_file)
-except FileNotFoundError:
-    print('ERROR READING CONFIG, HAVE YOU CREATED config.yaml FROM A TEMPLATE??')
-    raise
+
+class LazyConfig(Mapping):
+    """
+    Read-only dict of the config, loaded from yaml file on the first access
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            import yaml
+            try:
+                with open(self.file_name, 'r') as cfg_file:
+                    self._data = yaml.safe_load(cfg_file) or dict()
+            except FileNotFoundError:
+                print('ERROR READING CONFIG, HAVE YOU CREATED config.yaml FROM A TEMPLATE??')
+                raise
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def get(self, key, default=None):
+        """
+        Optional setting: default if the key is missing, or if there is no config file at all
+        (modules which read only optional settings on import can be used without config.yaml)
+        """
+        if self._data is None and not os.path.isfile(self.file_name):
+            return default
+        return super().get(key, default)
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return 'LazyConfig({!r}, loaded={})'.format(self.file_name, self._data is not None)
+
+
+CONFIG = LazyConfig(CONFIG_FILE_NAME)
+
+
+def set_config_file(file_name):
+    """
+    Read config from another file, must be called before the first access to CONFIG
+    """
+    CONFIG.file_name = os.path.abspath(file_name)
+    CONFIG._data = None
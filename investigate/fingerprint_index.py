@@ -0,0 +1,647 @@
+"""
+In-memory index of 128 bit simhash fingerprints and its sharded version.
+
+`FingerprintIndex` keeps ids and two 64 bit halves of fingerprints in numpy arrays
+and finds rows within Hamming distance by xor + popcount over the whole array.
+`CascadeIndex` scans compact 64 bit fingerprints (`simhash_text64`) first and checks only candidates
+with 128 bit fingerprints: `python fingerprint_index.py test-cascade` compares it with the full scan.
+
+Sharding: rows are split between shards by the mixed high half of the fingerprint (see `shard_of`).
+Every shard is served by `ShardServer` in its own process (or on its own node),
+`Coordinator` scatters a query to all shards, gathers and merges their results.
+A shard which doesn't answer in `timeout` seconds (slow, down, unreachable) is skipped
+and the result is marked as partial.
+
+`LocalCluster` starts shards as local processes, so the same coordinator code runs without real nodes:
+    with LocalCluster.from_index(index, shards=4) as cluster:
+        result = Coordinator(cluster.addresses, authkey=cluster.authkey, timeout=1).search(bits, n=6)
+
+Shards accept only peers with the same `authkey` (requests are pickled), there is no default one:
+`authkey` of `FINGERPRINT_SHARDS` in config.yaml, `--authkey` or FINGERPRINT_AUTHKEY environment variable of `serve`.
+
+Run shard of the db table on a node:
+    FINGERPRINT_AUTHKEY=<secret> python fingerprint_index.py serve --table sections --column simhash_text --shard 0 --shards 4 --port 6100
+add `--store` to load the shard from the snapshot of fingerprint_store.py instead of DB.
+"""
+import argparse
+import copy
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing.connection import Connection, Listener, answer_challenge, deliver_challenge
+from time import perf_counter, sleep
+
+import numpy as np
+
+from utils import split_simhash
+
+# authkey of the former default config, known to everybody
+_PUBLIC_AUTHKEYS = (b'billsim',)
+
+# number of set bits in every 16 bit value, numpy<1.25 has no popcount
+_POPCOUNT_16 = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+
+def check_authkey(authkey):
+    """
+    Shared secret of shards and coordinators as bytes, ValueError if it's missing or the public default one
+    """
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if not authkey:
+        raise ValueError('authkey of shards is required, set a random secret, '
+                         'e.g. python -c "import secrets; print(secrets.token_hex(32))"')
+    if authkey in _PUBLIC_AUTHKEYS:
+        raise ValueError('authkey {!r} is public, set a random secret'.format(authkey.decode()))
+    return authkey
+
+
+def popcount64(values):
+    """
+    Number of set bits in every element of uint64 array
+    """
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _POPCOUNT_16[values.view(np.uint16)].reshape(-1, 4).sum(axis=1, dtype=np.uint8)
+
+
+def to_halves(bits):
+    """
+    Bit string of 128 bit fingerprint --> two unsigned 64 bit halves
+    """
+    return np.uint64(int(bits[:64], 2)), np.uint64(int(bits[64:], 2))
+
+
+def fmix64(values):
+    """
+    Finalizer of MurmurHash3: every bit of the result depends on all bits of the value, works for scalars and arrays
+    """
+    h = np.array(values, ndmin=1).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xff51afd7ed558ccd)
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xc4ceb9fe1a85ec53)
+        h ^= h >> np.uint64(33)
+    return h.reshape(np.shape(values))
+
+
+def shard_of(hi, shards):
+    """
+    Shard of the fingerprint by its high half mixed with `fmix64`, works for scalars and arrays.
+    Bits of simhash are not uniform (the top byte put most rows to one shard), mixed ones are.
+    Near duplicates with the same high half are in the same shard.
+    :param hi: high half of the fingerprint, uint64 or signed int64 as stored in `<column>_hi`
+    :param shards: number of shards
+    """
+    return (fmix64(hi) % np.uint64(shards)).astype(np.int64)
+
+
+class FingerprintIndex:
+    """
+    Fingerprints of one table (or one shard of it) in memory
+    """
+    def __init__(self, ids=None, hi=None, lo=None):
+        self.ids = np.asarray(ids if ids is not None else [], dtype=np.int64)
+        self.hi = np.asarray(hi if hi is not None else [], dtype=np.int64).view(np.uint64)
+        self.lo = np.asarray(lo if lo is not None else [], dtype=np.int64).view(np.uint64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_bits(cls, ids, fingerprints):
+        """
+        :param ids: ids of rows
+        :param fingerprints: bit strings of 128 bit fingerprints
+        """
+        halves = [split_simhash(bits)[:2] for bits in fingerprints]
+        return cls(ids, [h for h, _ in halves], [lo for _, lo in halves])
+
+    @classmethod
+    def from_db(cls, session, table, column='simhash_text', shard=None, shards=1):
+        """
+        Load fingerprints from `<column>_hi` and `<column>_lo` columns, see `bill.add_band_columns`
+        :param session: db_session
+        :param table: table name
+        :param column: name of bit(128) column
+        :param shard: load only rows of this shard, see `shard_of`
+        :param shards: number of shards
+        """
+        from sqlalchemy import text as text_to_query
+        query = 'SELECT id, {col}_hi, {col}_lo FROM {table} WHERE {col}_hi IS NOT NULL'.format(col=column, table=table)
+        index = cls()
+        # `shard_of` has no SQL counterpart (64 bit multiplication overflows bigint), rows are filtered here
+        result = session.execute(text_to_query(query).execution_options(stream_results=True))
+        for rows in result.partitions(100000):
+            ids, hi, lo = (np.array(values, dtype=np.int64) for values in zip(*rows))
+            if shard is not None:
+                mask = shard_of(hi, shards) == shard
+                ids, hi, lo = ids[mask], hi[mask], lo[mask]
+            index.add(ids, hi, lo)
+        return index
+
+    def add(self, ids, hi, lo):
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.hi = np.concatenate([self.hi, np.asarray(hi, dtype=np.int64).view(np.uint64)])
+        self.lo = np.concatenate([self.lo, np.asarray(lo, dtype=np.int64).view(np.uint64)])
+
+    def split(self, shards):
+        """
+        Split to `shards` indexes by `shard_of`
+        """
+        keys = shard_of(self.hi, shards)
+        return [FingerprintIndex(self.ids[keys == k], self.hi[keys == k].view(np.int64),
+                                 self.lo[keys == k].view(np.int64)) for k in range(shards)]
+
+    def distances(self, bits):
+        hi, lo = to_halves(bits)
+        return popcount64(self.hi ^ hi) + popcount64(self.lo ^ lo)
+
+    def search(self, bits, n, limit=None):
+        """
+        Rows with Hamming distance to `bits` lower than `n`
+        :param bits: bit string of 128 bit fingerprint
+        :param n: Hamming distance threshold
+        :param limit: return only `limit` closest rows
+        :return: list of tuples (id, distance) ordered by distance
+        """
+        if not len(self):
+            return []
+        distances = self.distances(bits)
+        found = np.flatnonzero(distances < n)
+        return self._closest(found, distances[found], limit)
+
+    def _closest(self, found, distances, limit=None):
+        """
+        :param found: positions of found rows
+        :param distances: their distances
+        :return: list of tuples (id, distance) ordered by distance, at most `limit`
+        """
+        if limit is not None and len(found) > limit:
+            closest = np.argpartition(distances, limit - 1)[:limit]
+            found, distances = found[closest], distances[closest]
+        order = np.argsort(distances, kind='stable')
+        return list(zip(self.ids[found[order]].tolist(), distances[order].tolist()))
+
+
+class CascadeIndex(FingerprintIndex):
+    """
+    Two-stage search: the compact 64 bit fingerprints (`simhash_text64`, 8 bytes per row) are scanned first,
+    only rows within `n64` of the query are checked with 128 bit fingerprints (see `test_search.search_cascade`
+    for the third stage - exact scores of texts).
+    64 bit simhash is built from other shingles (char 4-grams), its distance doesn't bound the 128 bit one:
+    a row close in 128 bits can be farther than `n64` in 64 bits and is missed. On sections of 100 synthetic bills
+    with 3 versions (`test_cascade_search`, `python tune.py --cascade`) `n64 = n + 4` (the default) keeps 99.9%
+    of rows found by the full 128 bit scan within n = 4, 8 and 12 (n64 = n keeps 96-99%); the first stage passes
+    2%, 16% and 49% of rows for these n, so the cascade pays off for small n.
+    """
+    def __init__(self, ids=None, fp64=None, hi=None, lo=None):
+        super().__init__(ids, hi, lo)
+        self.fp64 = np.asarray(fp64 if fp64 is not None else [], dtype=np.int64).view(np.uint64)
+
+    @classmethod
+    def from_db(cls, session, table, column='simhash_text', column64='simhash_text64'):
+        """
+        Load rows which have both fingerprints
+        :param column: name of bit(128) column with `<column>_hi` and `<column>_lo`
+        :param column64: name of bigint column of 64 bit fingerprints
+        """
+        from sqlalchemy import text as text_to_query
+        query = 'SELECT id, {col64}, {col}_hi, {col}_lo FROM {table} WHERE {col64} IS NOT NULL AND {col}_hi IS NOT NULL'
+        rows = session.execute(text_to_query(query.format(col=column, col64=column64, table=table))).all()
+        return cls([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], [r[3] for r in rows])
+
+    def add(self, ids, fp64, hi, lo):
+        super().add(ids, hi, lo)
+        self.fp64 = np.concatenate([self.fp64, np.asarray(fp64, dtype=np.int64).view(np.uint64)])
+
+    def candidates(self, fp64, n64):
+        """
+        The first stage: positions of rows which 64 bit fingerprint has distance lower than `n64`
+        :param fp64: 64 bit fingerprint of the query, signed integer as in `simhash_text64`
+        """
+        return np.flatnonzero(popcount64(self.fp64 ^ np.int64(fp64).view(np.uint64)) < n64)
+
+    def search(self, bits, n, fp64=None, n64=None, limit=None):
+        """
+        Rows with 128 bit Hamming distance to `bits` lower than `n` among candidates of the first stage
+        :param bits: bit string of 128 bit fingerprint
+        :param n: Hamming distance threshold of 128 bit fingerprints
+        :param fp64: 64 bit fingerprint of the query, without it all rows are checked as in FingerprintIndex
+        :param n64: threshold of the first stage, by default n + 4
+        :param limit: return only `limit` closest rows
+        :return: list of tuples (id, distance) ordered by distance
+        """
+        if fp64 is None:
+            return super().search(bits, n, limit)
+        if not len(self):
+            return []
+        rows = self.candidates(fp64, n64 if n64 is not None else n + 4)
+        hi, lo = to_halves(bits)
+        distances = popcount64(self.hi[rows] ^ hi) + popcount64(self.lo[rows] ^ lo)
+        found = distances < n
+        return self._closest(rows[found], distances[found], limit)
+
+
+class ShardServer:
+    """
+    Serves searches in one shard over `multiprocessing.connection`.
+    Requests are tuples ('search', bits, n, limit), ('add', ids, hi, lo), ('stats',), ('stop',),
+    replies are tuples ('ok', result) or ('error', message).
+    """
+    def __init__(self, index, address=('127.0.0.1', 0), authkey=None, delay=0):
+        """
+        :param index: FingerprintIndex of the shard
+        :param address: address to listen, port 0 - any free port
+        :param authkey: shared secret of shards and coordinators, required
+        :param delay: seconds to sleep before every reply, to emulate slow shard in tests
+        """
+        self.index = index
+        self.delay = delay
+        self.listener = Listener(address, authkey=check_authkey(authkey))
+        self.address = self.listener.address
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def handle(self, request):
+        command = request[0]
+        if command == 'search':
+            _, bits, n, limit = request
+            # searches run without the lock on the index they started with, 'add' replaces it as a whole
+            index = self.index
+            t0 = perf_counter()
+            hits = index.search(bits, n, limit=limit)
+            return dict(hits=hits, rows=len(index), seconds=perf_counter() - t0)
+        if command == 'add':
+            with self._lock:
+                # `add` assigns new arrays to the copy, the index seen by running searches isn't changed
+                index = copy.copy(self.index)
+                index.add(*request[1:])
+                self.index = index
+            return len(index)
+        if command == 'stats':
+            return dict(rows=len(self.index), address=self.address, pid=os.getpid())
+        if command == 'stop':
+            self._stopped.set()
+            return True
+        raise ValueError('unknown command {}'.format(command))
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', self.handle(request))
+                except Exception as e:
+                    reply = ('error', '{}: {}'.format(type(e).__name__, e))
+                if self.delay:
+                    sleep(self.delay)
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+                if self._stopped.is_set():
+                    self.listener.close()
+                    return
+
+    def serve_forever(self):
+        while not self._stopped.is_set():
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                # listener closed by 'stop'
+                break
+            threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+
+class Coordinator:
+    """
+    Scatters queries to all shards and merges their results
+    """
+    def __init__(self, addresses, authkey=None, timeout=5.0):
+        """
+        :param addresses: addresses of shard servers, tuples (host, port) or strings 'host:port'
+        :param authkey: shared secret of shards and coordinators, required
+        :param timeout: seconds to wait for every shard
+        """
+        self.addresses = [_parse_address(a) for a in addresses]
+        self.authkey = check_authkey(authkey)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self.addresses), 1))
+        # address -> future of the last request, a shard is not queried again while it's still running
+        self._running = dict()
+
+    @classmethod
+    def from_config(cls):
+        """
+        Coordinator of shards listed in `FINGERPRINT_SHARDS` of config.yaml
+        """
+        from config import CONFIG
+        shards = CONFIG.get('FINGERPRINT_SHARDS') or dict()
+        return cls(shards.get('addresses', []), authkey=shards.get('authkey'), timeout=shards.get('timeout', 5.0))
+
+    def _connect(self, address):
+        """
+        `multiprocessing.connection.Client` with `timeout` for connecting and for authentication:
+        a node that doesn't accept connections (down, firewalled) fails in `timeout` seconds,
+        instead of hanging for minutes of TCP timeouts
+        """
+        try:
+            sock = socket.create_connection(address, timeout=self.timeout)
+        except socket.timeout:
+            raise TimeoutError('shard {} did not accept connection in {} sec'.format(address, self.timeout))
+        # Connection reads and writes the raw descriptor, the handshake is bounded by socket options
+        timeval = struct.pack('ll', int(self.timeout), int(self.timeout % 1 * 1e6))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+        sock.setblocking(True)
+        connection = Connection(sock.detach())
+        try:
+            answer_challenge(connection, self.authkey)
+            deliver_challenge(connection, self.authkey)
+        except BlockingIOError:
+            # SO_RCVTIMEO / SO_SNDTIMEO expired
+            connection.close()
+            raise TimeoutError('shard {} did not authenticate in {} sec'.format(address, self.timeout))
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def _request(self, address, request):
+        """
+        Send request to one shard, a new connection per request so a late reply never mixes with the next one
+        """
+        connection = self._connect(address)
+        try:
+            connection.send(request)
+            if not connection.poll(self.timeout):
+                raise TimeoutError('shard {} did not answer in {} sec'.format(address, self.timeout))
+            status, result = connection.recv()
+        finally:
+            connection.close()
+        if status != 'ok':
+            raise RuntimeError('shard {}: {}'.format(address, result))
+        return result
+
+    def scatter(self, request):
+        """
+        Send request to all shards in parallel
+        :return: tuple (list of results of answered shards, dict address -> error of failed shards)
+        """
+        results, errors = list(), dict()
+        futures = dict()
+        for address in self.addresses:
+            running = self._running.get(address)
+            if running is not None and not running.done():
+                # the worker is still busy with the previous request, a new one would wait in the queue of the pool
+                errors[address] = 'TimeoutError: shard {} is still busy with the previous request'.format(address)
+                continue
+            futures[address] = self._running[address] = self._executor.submit(self._request, address, request)
+        # one deadline for all shards: connection and reply have `timeout` each
+        wait(futures.values(), timeout=self.timeout * 2)
+        for address, future in futures.items():
+            if not future.done():
+                errors[address] = 'TimeoutError: shard {} did not answer in {} sec'.format(address, self.timeout * 2)
+                continue
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors[address] = '{}: {}'.format(type(e).__name__, e)
+        return results, errors
+
+    def search(self, bits, n, limit=None):
+        """
+        Search fingerprints with Hamming distance to `bits` lower than `n` in all shards
+        :param bits: bit string of 128 bit fingerprint
+        :param n: Hamming distance threshold
+        :param limit: return only `limit` closest rows
+        :return: dict with keys
+            hits - list of tuples (id, distance) ordered by distance,
+            partial - True if some shards didn't answer,
+            errors - dict address -> error of such shards,
+            rows - number of fingerprints in answered shards
+        """
+        results, errors = self.scatter(('search', bits, n, limit))
+        hits = sorted((hit for result in results for hit in result['hits']), key=lambda hit: hit[1])
+        if limit is not None:
+            hits = hits[:limit]
+        return dict(hits=[tuple(hit) for hit in hits], partial=bool(errors), errors=errors,
+                    rows=sum(result['rows'] for result in results))
+
+    def add(self, ids, hi, lo):
+        """
+        Add fingerprints (signed halves as stored in DB) to their shards.
+        Shards are numbered by order of `addresses`.
+        """
+        hi = np.asarray(hi, dtype=np.int64)
+        lo = np.asarray(lo, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        keys = shard_of(hi, len(self.addresses))
+        for shard, address in enumerate(self.addresses):
+            mask = keys == shard
+            if mask.any():
+                self._request(address, ('add', ids[mask], hi[mask], lo[mask]))
+
+    def stats(self):
+        results, errors = self.scatter(('stats',))
+        return dict(shards=results, errors=errors)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def _parse_address(address):
+    if isinstance(address, str):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return tuple(address)
+
+
+def _run_shard(queue, index, authkey, delay, db_spec):
+    """
+    Target of shard process: load shard (from DB if `db_spec` is given), report address and serve
+    """
+    if db_spec is not None:
+        from config import CONFIG
+        from utils import create_session
+        table, column, shard, shards = db_spec
+        index = FingerprintIndex.from_db(create_session(CONFIG['DB_connection']), table, column, shard, shards)
+    server = ShardServer(index, authkey=authkey, delay=delay)
+    queue.put(server.address)
+    server.serve_forever()
+
+
+class LocalCluster:
+    """
+    Shard servers in local processes, stand-in for shards on separate nodes
+    """
+    def __init__(self, indexes=None, db=None, shards=None, authkey=None, delays=None):
+        """
+        :param indexes: list of FingerprintIndex, one per shard
+        :param db: tuple (table, column) to load shards from DB in shard processes instead of `indexes`
+        :param shards: number of shards for `db`
+        :param authkey: shared secret of shards, random by default (see `authkey` attribute)
+        :param delays: seconds of artificial latency per shard, for tests
+        """
+        count = len(indexes) if indexes is not None else shards
+        self.authkey = check_authkey(authkey) if authkey is not None else os.urandom(32)
+        self.processes = list()
+        self.addresses = list()
+        queue = multiprocessing.Queue()
+        for shard in range(count):
+            index = indexes[shard] if indexes is not None else None
+            db_spec = (db[0], db[1], shard, count) if db is not None else None
+            delay = delays[shard] if delays else 0
+            process = multiprocessing.Process(target=_run_shard, args=(queue, index, self.authkey, delay, db_spec),
+                                              daemon=True)
+            process.start()
+            # address of every shard is needed in order of shards
+            self.addresses.append(queue.get(timeout=60))
+            self.processes.append(process)
+
+    @classmethod
+    def from_index(cls, index, shards, **kwargs):
+        return cls(index.split(shards), **kwargs)
+
+    def kill(self, shard):
+        """
+        Stop shard process abruptly, to test missing shards
+        """
+        self.processes[shard].terminate()
+        self.processes[shard].join()
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def test_sharded_search(rows=200000, shards=4, n=10):
+    """
+    Compare sharded search with the search in a single index, then make one shard slow and another one missing
+    """
+    rng = np.random.default_rng(0)
+    hi = rng.integers(-2 ** 63, 2 ** 63 - 1, size=rows, dtype=np.int64)
+    lo = rng.integers(-2 ** 63, 2 ** 63 - 1, size=rows, dtype=np.int64)
+    # near duplicates of the first row, with the same high half they are in the same shard
+    hi[1:50] = hi[0]
+    lo[1:50] = lo[0] ^ (1 << rng.integers(0, 63, size=49)) ^ (1 << rng.integers(0, 63, size=49))
+    index = FingerprintIndex(np.arange(rows), hi, lo)
+    bits = format(int(index.hi[0]), '064b') + format(int(index.lo[0]), '064b')
+
+    t0 = perf_counter()
+    expected = index.search(bits, n)
+    print('single index: {} hits in {:.4f} sec'.format(len(expected), perf_counter() - t0))
+
+    # the slow shard is not the one with near duplicates, they are lost only when their shard is missing
+    first_shard = int(shard_of(hi[0], shards))
+    delays = [0] * shards
+    delays[(first_shard + 1) % shards] = 2
+    with LocalCluster.from_index(index, shards, delays=delays) as cluster:
+        coordinator = Coordinator(cluster.addresses, authkey=cluster.authkey, timeout=5)
+        t0 = perf_counter()
+        result = coordinator.search(bits, n)
+        print('{} shards: {} hits in {:.4f} sec, partial: {}'.format(shards, len(result['hits']),
+                                                                     perf_counter() - t0, result['partial']))
+        print('same hits as single index:', sorted(result['hits']) == sorted(expected))
+        coordinator.close()
+
+        coordinator = Coordinator(cluster.addresses, authkey=cluster.authkey, timeout=1)
+        t0 = perf_counter()
+        result = coordinator.search(bits, n)
+        print('with slow shard: {} hits in {:.4f} sec, partial: {}, errors: {}'.format(
+            len(result['hits']), perf_counter() - t0, result['partial'], result['errors']))
+        cluster.kill(first_shard)
+        result = coordinator.search(bits, n, limit=5)
+        print('with missing shard: {} hits, partial: {}, errors: {}'.format(len(result['hits']), result['partial'],
+                                                                            result['errors']))
+        coordinator.close()
+
+
+def test_cascade_search(rows=1000000, n=8, repeat=10, bills=100, versions=3):
+    """
+    Time of the cascade search against the full scan of 128 bit fingerprints, on random rows with near duplicates,
+    then recall of the cascade on sections of synthetic bills (`tune.cascade_recall`):
+    share of rows within n of the full 128 bit scan which are kept by the default `n64 = n + 4`
+    """
+    rng = np.random.default_rng(0)
+    fp64, hi, lo = (rng.integers(-2 ** 63, 2 ** 63 - 1, size=rows, dtype=np.int64) for _ in range(3))
+    for values in (fp64, hi, lo):
+        values[1:50] = values[0] ^ (1 << rng.integers(0, 63, size=49))
+    index = CascadeIndex(np.arange(rows), fp64, hi, lo)
+    bits = format(int(index.hi[0]), '064b') + format(int(index.lo[0]), '064b')
+    for name, search in (('128 bit scan', lambda: index.search(bits, n)),
+                         ('64/128 cascade', lambda: index.search(bits, n, fp64=int(fp64[0])))):
+        t0 = perf_counter()
+        for _ in range(repeat):
+            found = search()
+        print('{}: {} hits in {:.4f} sec'.format(name, len(found), (perf_counter() - t0) / repeat))
+
+    # random rows say nothing about recall: 64 and 128 bit fingerprints of real texts are built from other shingles
+    from synthetic import DEFAULT_ROOT, generate_corpus
+    from tune import cascade_recall, load_files_corpus, print_cascade
+    root = DEFAULT_ROOT + '_cascade'
+    generate_corpus(root=root, bills=bills, versions=versions)
+    _, texts = load_files_corpus(root)
+    print('recall of the cascade on {} sections of synthetic bills:'.format(len(texts)))
+    print_cascade(cascade_recall(texts, ns=(4, n, 12), offsets=(0, 4, 8)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shard server of simhash fingerprints')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve', help='load shard from DB and serve it')
+    serve.add_argument('--table', required=True)
+    serve.add_argument('--column', default='simhash_text')
+    serve.add_argument('--shard', type=int, required=True)
+    serve.add_argument('--shards', type=int, required=True)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=6100)
+    serve.add_argument('--authkey', default=os.environ.get('FINGERPRINT_AUTHKEY'),
+                       help='shared secret of shards and coordinators, FINGERPRINT_AUTHKEY environment variable by default')
+    serve.add_argument('--store', action='store_true', help='load from fingerprint_store.py snapshot instead of DB')
+    subparsers.add_parser('test', help='run test_sharded_search')
+    subparsers.add_parser('test-cascade', help='run test_cascade_search')
+    args = parser.parse_args(argv)
+    if args.command == 'test':
+        test_sharded_search()
+        return
+    if args.command == 'test-cascade':
+        test_cascade_search()
+        return
+    try:
+        authkey = check_authkey(args.authkey)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.store:
+        from fingerprint_store import FingerprintStore
+        index = FingerprintStore.for_column(args.table, args.column).load(args.shard, args.shards)
+    else:
+        from config import CONFIG
+        from utils import create_session
+        session = create_session(CONFIG['DB_connection'])
+        index = FingerprintIndex.from_db(session, args.table, args.column, args.shard, args.shards)
+        session.close()
+    server = ShardServer(index, (args.host, args.port), authkey=authkey)
+    print('shard {}/{} of {}.{}: {} fingerprints, listening on {}'.format(args.shard, args.shards, args.table,
+                                                                         args.column, len(index), server.address))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+On-disk snapshot of fingerprints with an append-only log, for fast start of in-memory searches.
+
+Instead of selecting all fingerprints from DB, a searcher maps the snapshot files and replays the log:
+    store = FingerprintStore.for_column('sections', 'simhash_text')
+    index = store.load()  # FingerprintIndex
+
+Folder of a store (`FINGERPRINT_STORE/<table>.<column>`):
+    meta.json - current generation of the snapshot, its number of rows and max id
+    snapshot-<generation>.{ids,hi,lo}.npy - rows sorted by fingerprint (hi, lo), memory-mapped on load
+    log.bin - records (id, hi, lo) of int64 appended after the snapshot, the last record of an id wins;
+        a record with negative id is a tombstone: row -id is deleted
+    lock - flock: appends and compaction are exclusive, loads are shared
+
+Ingestion (`main_tests.parse_and_load`) syncs stores which exist with DB after loading: ids of the table are compared
+with stored ones, new rows (in any order of ids) are appended, deleted rows (e.g. by `main_tests.forget_origins`)
+get tombstones. Fingerprints recomputed by backfill.py are appended to the log by backfill itself.
+The log is compacted to a new snapshot when it grows over `compact_ratio` of the snapshot.
+Build the snapshot, compact the log or show stats:
+    python fingerprint_store.py snapshot sections simhash_text
+    python fingerprint_store.py compact sections simhash_text
+    python fingerprint_store.py stats sections simhash_text
+"""
+import argparse
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from glob import glob
+
+import numpy as np
+
+from fingerprint_index import FingerprintIndex, shard_of
+
+RECORD = np.dtype([('id', '<i8'), ('hi', '<i8'), ('lo', '<i8')])
+
+
+def _store_root():
+    from config import CONFIG
+    return CONFIG.get('FINGERPRINT_STORE', 'fingerprints')
+
+
+def _replay(ids, hi, lo, log):
+    """
+    Rows of the snapshot with the log applied: the last record of every id replaces its row, tombstones delete it
+    """
+    if not len(log):
+        return ids, hi, lo
+    row_ids = np.abs(log['id'])
+    _, last = np.unique(row_ids[::-1], return_index=True)
+    log = log[len(log) - 1 - last]
+    kept = np.isin(ids, np.abs(log['id']), invert=True)
+    log = log[log['id'] > 0]
+    return (np.concatenate([ids[kept], log['id']]), np.concatenate([hi[kept], log['hi']]),
+            np.concatenate([lo[kept], log['lo']]))
+
+
+class FingerprintStore:
+    """
+    Snapshot and log of fingerprints of one column
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    @classmethod
+    def for_column(cls, table, column='simhash_text', root=None):
+        return cls(os.path.join(root or _store_root(), '{}.{}'.format(table, column)))
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def exists(self):
+        return os.path.isfile(self._path('meta.json'))
+
+    @contextmanager
+    def _lock(self, exclusive=True):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self._path('lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _meta(self):
+        with open(self._path('meta.json')) as meta:
+            return json.load(meta)
+
+    def _read_snapshot(self, meta, mmap=True):
+        prefix = 'snapshot-{}'.format(meta['generation'])
+        return [np.load(self._path('{}.{}.npy'.format(prefix, name)), mmap_mode='r' if mmap else None)
+                for name in ('ids', 'hi', 'lo')]
+
+    def _read_log(self):
+        if not os.path.isfile(self._path('log.bin')):
+            return np.zeros(0, dtype=RECORD)
+        with open(self._path('log.bin'), 'rb') as log:
+            data = log.read()
+        # incomplete last record of an interrupted append is ignored
+        return np.frombuffer(data[:len(data) - len(data) % RECORD.itemsize], dtype=RECORD)
+
+    def _write_snapshot(self, ids, hi, lo):
+        """
+        New generation of the snapshot, the log is emptied. Call under exclusive lock.
+        :param ids: unique ids of rows
+        """
+        ids, hi, lo = (np.asarray(a, dtype=np.int64) for a in (ids, hi, lo))
+        order = np.lexsort((lo.view(np.uint64), hi.view(np.uint64)))
+        generation = self._meta()['generation'] + 1 if self.exists() else 1
+        prefix = 'snapshot-{}'.format(generation)
+        for name, values in (('ids', ids), ('hi', hi), ('lo', lo)):
+            np.save(self._path('{}.{}.npy'.format(prefix, name)), values[order])
+        meta = dict(generation=generation, rows=len(ids), max_id=int(ids.max()) if len(ids) else 0)
+        with open(self._path('meta.json.tmp'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(self._path('meta.json.tmp'), self._path('meta.json'))
+        open(self._path('log.bin'), 'wb').close()
+        # processes which mapped old files keep them until they exit
+        for file_name in glob(self._path('snapshot-*.npy')):
+            if not os.path.basename(file_name).startswith(prefix + '.'):
+                os.remove(file_name)
+        return meta
+
+    def snapshot(self, ids, hi, lo):
+        """
+        Replace stored fingerprints with these
+        :param ids: ids of rows
+        :param hi: signed 64 bit high halves, as `<column>_hi` columns
+        :param lo: low halves
+        """
+        ids, hi, lo = (np.asarray(a, dtype=np.int64) for a in (ids, hi, lo))
+        # the last row of every id wins, as in the log
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = len(ids) - 1 - last
+        with self._lock():
+            return self._write_snapshot(ids[keep], hi[keep], lo[keep])
+
+    def snapshot_from_db(self, session, table, column='simhash_text'):
+        index = FingerprintIndex.from_db(session, table, column)
+        return self.snapshot(index.ids, index.hi.view(np.int64), index.lo.view(np.int64))
+
+    def append(self, ids, hi, lo):
+        """
+        Append new or changed rows to the log
+        """
+        records = np.zeros(len(ids), dtype=RECORD)
+        records['id'], records['hi'], records['lo'] = ids, hi, lo
+        return self._append(records)
+
+    def remove(self, ids):
+        """
+        Append tombstones of deleted rows to the log
+        """
+        records = np.zeros(len(ids), dtype=RECORD)
+        records['id'] = -np.asarray(ids, dtype=np.int64)
+        return self._append(records)
+
+    def _append(self, records):
+        if not len(records):
+            return 0
+        with self._lock():
+            with open(self._path('log.bin'), 'ab') as log:
+                # drop incomplete record of an interrupted append, otherwise new records are shifted
+                size = log.tell()
+                if size % RECORD.itemsize:
+                    log.truncate(size - size % RECORD.itemsize)
+                log.write(records.tobytes())
+                log.flush()
+                os.fsync(log.fileno())
+        return len(records)
+
+    def compact(self):
+        """
+        Merge the log into a new snapshot
+        """
+        with self._lock():
+            meta = self._meta()
+            log = self._read_log()
+            if not len(log):
+                return meta
+            return self._write_snapshot(*_replay(*self._read_snapshot(meta), log))
+
+    def load(self, shard=None, shards=1, mmap=True):
+        """
+        Index of the snapshot with the log replayed.
+        Without log and shard, arrays of the index are the mapped snapshot files (nothing is read in advance).
+        :param shard: only rows of this shard, see `fingerprint_index.shard_of`
+        :param shards: number of shards
+        :return: FingerprintIndex
+        """
+        with self._lock(exclusive=False):
+            ids, hi, lo = _replay(*self._read_snapshot(self._meta(), mmap=mmap), self._read_log())
+        if shard is not None:
+            rows = shard_of(hi, shards) == shard
+            ids, hi, lo = ids[rows], hi[rows], lo[rows]
+        return FingerprintIndex(ids, hi, lo)
+
+    def sync(self, session, table, column='simhash_text', compact_ratio=0.25, batch_size=10000):
+        """
+        Make stored rows the same as rows of the table with fingerprints: ids of the table are compared
+        with stored ones, new rows are appended (whatever their ids are), deleted rows get tombstones.
+        Compact if the log is large.
+        :return: tuple (number of appended rows, number of removed rows)
+        """
+        from sqlalchemy import text as text_to_query
+        with self._lock(exclusive=False):
+            stored = _replay(*self._read_snapshot(self._meta()), self._read_log())[0]
+        db_ids = np.array(session.execute(text_to_query(
+            'SELECT id FROM {table} WHERE {col}_hi IS NOT NULL'.format(col=column, table=table))).scalars().all(),
+            dtype=np.int64)
+        new_ids = np.setdiff1d(db_ids, stored)
+        removed = np.setdiff1d(stored, db_ids)
+        query = 'SELECT id, {col}_hi, {col}_lo FROM {table} WHERE id = ANY(:ids) AND {col}_hi IS NOT NULL ' \
+                'ORDER BY id'.format(col=column, table=table)
+        appended = 0
+        for start in range(0, len(new_ids), batch_size):
+            rows = session.execute(text_to_query(query), dict(ids=new_ids[start:start + batch_size].tolist())).all()
+            appended += self.append([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])
+        self.remove(removed)
+        if appended or len(removed):
+            stats = self.stats()
+            if stats['log_rows'] > compact_ratio * max(stats['rows'], 1):
+                self.compact()
+        return appended, len(removed)
+
+    def stats(self):
+        meta = self._meta()
+        return dict(folder=self.folder, generation=meta['generation'], rows=meta['rows'], max_id=meta['max_id'],
+                    log_rows=len(self._read_log()))
+
+
+def existing_stores(root=None):
+    """
+    Stores created in the root folder: list of tuples (table, column, FingerprintStore)
+    """
+    stores = list()
+    for meta_path in sorted(glob(os.path.join(root or _store_root(), '*.*', 'meta.json'))):
+        table, column = os.path.basename(os.path.dirname(meta_path)).split('.', 1)
+        stores.append((table, column, FingerprintStore(os.path.dirname(meta_path))))
+    return stores
+
+
+def find_store(table, column, root=None):
+    """
+    :return: FingerprintStore of the column if it was created, otherwise None
+    """
+    store = FingerprintStore.for_column(table, column, root)
+    return store if store.exists() else None
+
+
+def sync_stores(session, root=None):
+    """
+    Sync all existing stores with DB, called after loading bills
+    """
+    for table, column, store in existing_stores(root):
+        added, removed = store.sync(session, table, column)
+        if added or removed:
+            print('appended {} and removed {} fingerprints of {}'.format(added, removed, store.folder))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Snapshots of fingerprints for in-memory search')
+    parser.add_argument('command', choices=('snapshot', 'compact', 'sync', 'stats'))
+    parser.add_argument('table')
+    parser.add_argument('column', nargs='?', default='simhash_text')
+    parser.add_argument('--root', help='folder of stores, by default FINGERPRINT_STORE of config')
+    args = parser.parse_args(argv)
+    store = FingerprintStore.for_column(args.table, args.column, args.root)
+    if args.command in ('snapshot', 'sync'):
+        from config import CONFIG
+        from utils import create_session
+        session = create_session(CONFIG['DB_connection'])
+        if args.command == 'snapshot':
+            store.snapshot_from_db(session, args.table, args.column)
+        else:
+            store.sync(session, args.table, args.column)
+    elif args.command == 'compact':
+        store.compact()
+    print(store.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,17 @@
 import sys
 import os
 import re
+import hashlib
 import pickle
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
 from lxml import etree
 from bill import Bill, Section, Base, BillPath
+from bill import SectionContent, SectionRef
+from bill import SIMHASH_BANDS, BANDED_COLUMNS
+from sqlalchemy import inspect, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy import text as text_to_query
 from config import CONFIG
 from bs4 import BeautifulSoup
@@ -13,6 +21,7 @@ from utils import text_cleaning, create_title
 from utils import create_session, get_engine
 from utils import build_sim_hash
 from utils import build_128_simhash
+from utils import simhash_to_int
 from utils import get_all_file_paths
 from utils import chunk
 from utils import get_xml_sections
@@ -20,6 +29,21 @@ from utils import create_bill_name
 from utils import timer_wrapper
 from utils import clean_bill_text
 from utils import parse_xml_section, parse_soup_section
+from utils import unique_word_ngrams
+from utils import fingerprint_columns
+from utils import split_simhash
+from utils import hamming_condition
+from clusters import apply_boilerplate
+from fingerprint_store import sync_stores
+from test_search import rank_related_bills
+from metrics import span, increment, merge_result, WorkerJob
+
+# digests of section contents already stored (or hashed by this process), see `parse_contents_file`
+_KNOWN_CONTENT_DIGESTS = set()
+
+# order of text versions of the bill, from introduced to enrolled
+TEXT_VERSIONS_ORDER = ('ih', 'is', 'rih', 'ris', 'rh', 'rs', 'rch', 'rcs', 'rfh', 'rfs', 'rdh', 'rds', 'pch', 'pcs',
+                       'cph', 'cps', 'eh', 'es', 'eah', 'eas', 'ath', 'ats', 'ash', 'enr')
 
 
 def create_bill_from_dict(element):
@@ -31,8 +55,10 @@ def create_bill_from_dict(element):
     paragraph_text = element.get('text')
     if not paragraph_text:
         return None
-    cleaned = text_cleaning(paragraph_text)
-    simhash_text = build_sim_hash(cleaned)
+    with span('ingest.clean'):
+        cleaned = text_cleaning(paragraph_text)
+    with span('ingest.hash'):
+        simhash_text = build_sim_hash(cleaned)
     title = create_title(element.get('header', ''))
     origin = element.get('origin')
     label = element.get('num')
@@ -52,112 +78,416 @@ def create_bill_from_dict(element):
     return bill
 
 
-def create_section_from_dict(element):
+def text_digest(text):
     """
-    Create ORM model of the Section from soup Tag
-    :param element: dict with info to create model
-    :return: Bill as orm model
+    Digest of the cleaned section text (see `utils.text_cleaning`), the same for unchanged sections
+    of different versions and for `SectionContent` rows
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class VersionDiff:
+    """
+    Sections of consecutive text versions of one bill aligned by section id (header if there is no id)
+    and digest of the cleaned text.
+    Fingerprints are computed only for changed sections, unchanged ones get fingerprints of the same text
+    hashed in one of the previous versions.
+    """
+    def __init__(self):
+        # digest -> columns of fingerprints of the text
+        self.hashes = dict()
+        # section key -> digest, in the previous and the current version
+        self.previous = dict()
+        self.current = dict()
+
+    def next_version(self):
+        self.previous, self.current = self.current, dict()
+
+    def unchanged(self, element, digest):
+        """
+        Fingerprint columns of the section if its text was already hashed, None if the section is new or changed
+        """
+        key = element.get('id') or element.get('header')
+        self.current[key] = digest
+        hashes = self.hashes.get(digest)
+        if hashes is None:
+            if key in self.previous:
+                increment('ingest.sections_changed')
+            return None
+        # the same section as in the previous version, or moved / copied from another one
+        increment('ingest.sections_aligned' if self.previous.get(key) == digest else 'ingest.sections_moved')
+        return hashes
+
+    def add(self, digest, hashes):
+        self.hashes[digest] = hashes
+
+
+def section_row_from_dict(element, ngrams=True, versions=None):
+    """
+    Create row of the sections table from parsed section:
+    count hashes and (optionally) unique word 4-grams of the text.
+    Rows are plain dicts, so they can be created in worker processes and bulk-loaded to DB.
+
+    If the same text was hashed in one of the previous versions of the bill (see `VersionDiff`),
+    it's not hashed again: row gets fingerprints of that text but not the text itself
+    and is linked to the stored row after loading, see `link_unchanged_sections`.
+    :param element: dict with info to create row
+    :param ngrams: count `text_query_index_col`, it's indexed only for top level sections
+    :param versions: VersionDiff of the bill, the text is added to it
+    :return: dict with column values or None if there is no text
     """
     paragraph_text = element.get('text')
     if not paragraph_text or len(paragraph_text) < 10:
         return None
-    cleaned = text_cleaning(paragraph_text)
-    simhash_text = build_128_simhash(cleaned)
-    hash_ngrams = build_128_simhash(cleaned, words=True)
-    hash_words = build_128_simhash(cleaned, words=True, n=1)
-    section_id = element.get('id')
     header = element.get('header')
-    section = Section(text=paragraph_text,
-                      simhash_text=simhash_text,
-                      section_id=section_id,
-                      hash_ngrams=hash_ngrams,
-                      hash_words=hash_words,
-                      length=len(paragraph_text))
-    if header:
-        section.header = header[:225]
-    return section
+    with span('ingest.clean'):
+        cleaned = text_cleaning(paragraph_text)
+    digest = text_digest(cleaned)
+    row = dict(text=None,
+               section_id=element.get('id'),
+               length=len(paragraph_text),
+               header=header[:225] if header else None,
+               parent_id=None,
+               text_query_index_col=None,
+               digest=digest,
+               linked_section_id=None)
+    hashes = versions.unchanged(element, digest) if versions is not None else None
+    if hashes is not None:
+        row.update(hashes)
+        increment('ingest.sections_unchanged')
+    else:
+        with span('ingest.hash'):
+            simhash_text = build_128_simhash(cleaned)
+            hashes = dict(simhash_text=simhash_text,
+                          simhash_text64=simhash_to_int(build_sim_hash(cleaned)),
+                          hash_ngrams=build_128_simhash(cleaned, words=True),
+                          hash_words=build_128_simhash(cleaned, words=True, n=1))
+            hashes.update(fingerprint_columns('simhash_text', simhash_text, SIMHASH_BANDS))
+        row.update(hashes, text=paragraph_text)
+        if versions is not None:
+            versions.add(digest, hashes)
+    if ngrams:
+        with span('ingest.ngrams'):
+            row['text_query_index_col'] = unique_word_ngrams(paragraph_text, n=4)
+    return row
+
+
+def create_section_from_dict(element, ngrams=True):
+    """
+    Create ORM model of the Section from soup Tag
+    :param element: dict with info to create model
+    :param ngrams: count unique word 4-grams of the text
+    :return: Section as orm model
+    """
+    row = section_row_from_dict(element, ngrams=ngrams)
+    return Section(**row) if row else None
+
+
+def _read_soup(xml_path):
+    with open(xml_path) as xml:
+        return BeautifulSoup(xml, features="xml")
+
+
+def parse_file(xml_path, sections=False, bills=False, versions=None, dedup=False):
+    """
+    Parse single xml file to rows of sections and bill tables.
+    Doesn't use DB, so it can run in worker processes.
+    :param xml_path: path to bill in xml format
+    :param sections: parse sections
+    :param bills: parse bill as a whole
+    :param versions: VersionDiff of previous text versions of the bill, see `section_row_from_dict`
+    :param dedup: parse sections to unique contents and references to them instead of sections rows
+    :return: dict with keys 'sections' (see `parse_sections_file`) or 'contents' (see `parse_contents_file`)
+        and 'bill' (see `parse_bill_file`)
+    """
+    with span('ingest.parse', file=xml_path):
+        soup = _read_soup(xml_path)
+    parsed = dict(xml_path=xml_path)
+    if sections and dedup:
+        parsed['contents'] = parse_contents_file(xml_path, soup=soup)
+    elif sections:
+        parsed['sections'] = parse_sections_file(xml_path, soup=soup, versions=versions)
+    if bills:
+        parsed['bill'] = parse_bill_file(xml_path, soup=soup)
+    return parsed
+
+
+def text_version(xml_path):
+    """
+    Code of the text version from the path in congress folder:
+    .../bills/hr/hr1500/text-versions/ih/document.xml  -->  'ih'
+    :return: version code or None
+    """
+    folders = os.path.normpath(xml_path).split(os.path.sep)
+    if 'text-versions' in folders:
+        position = folders.index('text-versions')
+        if position + 1 < len(folders) - 1:
+            return folders[position + 1]
+    return None
+
+
+def _version_order(xml_path):
+    version = text_version(xml_path)
+    if version in TEXT_VERSIONS_ORDER:
+        return TEXT_VERSIONS_ORDER.index(version), version or ''
+    return len(TEXT_VERSIONS_ORDER), version or ''
+
+
+def group_text_versions(files):
+    """
+    Group files by bills: all text versions of the bill are in one group ordered from introduced to enrolled.
+    Files outside `text-versions` folders make groups of one file.
+    :param files: list of xml paths
+    :return: list of lists of xml paths
+    """
+    groups = dict()
+    for xml_path in files:
+        folders = os.path.normpath(xml_path).split(os.path.sep)
+        if 'text-versions' in folders:
+            key = os.path.sep.join(folders[:folders.index('text-versions')])
+        else:
+            key = xml_path
+        groups.setdefault(key, list()).append(xml_path)
+    return [sorted(paths, key=_version_order) for paths in groups.values()]
+
+
+def parse_versions(xml_paths, sections=False, bills=False, dedup=False):
+    """
+    Parse consecutive text versions of one bill.
+    Sections which text is the same as in one of the previous versions are not hashed again, see `VersionDiff`.
+    :param xml_paths: paths of text versions ordered by `group_text_versions`
+    :return: list of parsed files, see `parse_file`
+    """
+    versions = VersionDiff()
+    parsed = list()
+    for xml_path in xml_paths:
+        parsed.append(parse_file(xml_path, sections=sections, bills=bills, versions=versions, dedup=dedup))
+        versions.next_version()
+    return parsed
+
+
+def _set_known_content_digests(digests):
+    """
+    Initializer of worker processes: digests of contents which are already stored in DB
+    """
+    _KNOWN_CONTENT_DIGESTS.clear()
+    _KNOWN_CONTENT_DIGESTS.update(digests)
 
 
 @timer_wrapper
-def parse_and_load(sections=False, bills=False, full=False):
+def parse_and_load(sections=False, bills=False, full=False, workers=1, versions=False, dedup=False, folder=None):
     """
     !WARNING there is no protection of uniqueness texts/hashes or any other check
     if the text/paragraph was already loaded to DB table or not.
     So run this only once, or truncate table, otherwise you create a lot of duplicates,
      and further search of similar will produce a bunch of noise results.
 
+    Parsing, hashing and building n-grams run in `workers` processes,
+    main process only bulk-loads ready rows to DB.
+
     :param sections: flag to create sections
     :param bills: flag to create bills
     :param full: save both bills and sections (takes much longer time)
+    :param workers: number of worker processes
+    :param versions: process all text versions of a bill together and don't hash sections unchanged
+        since previous versions, they are linked to already stored sections
+    :param dedup: store every unique section text once (`SectionContent`) with references from bills (`SectionRef`)
+    :param folder: folder to scan, by default congress 117 in `CONGRESS_ROOT_FOLDER`
     :return:
     """
     # specify your folder here:
     # samples_folder = '/Users/dmytroustynov/programm/BillMap/xc-nlp-test/samples'
     # samples_folder = '/Users/dmytroustynov/programm/congress.nosync/data'
     samples_folder = CONFIG['CONGRESS_ROOT_FOLDER']
-    scan_folder = os.path.join(samples_folder, '117')
+    scan_folder = folder or os.path.join(samples_folder, '117')
 
-    files = get_all_file_paths(scan_folder, ext='xml')
+    files = [f for f in get_all_file_paths(scan_folder, ext='xml') if os.path.isfile(f)]
     print('Processing {} files...'.format(len(files)) if files else
           'No files found')
     db_config = CONFIG['DB_connection']
     session = create_session(db_config)
-    for filename in files:
-        if not os.path.isfile(filename):
-            print('file not found')
-            continue
-        if sections or full:
-            parse_sections_to_db(filename, session)
-        if bills or full:
-            parse_bill_and_load(filename, session)
+    with ingestion_pool(session, workers, dedup) as pool:
+        load_files(files, session, pool=pool, sections=sections or full, bills=bills or full, versions=versions,
+                   dedup=dedup)
+
+
+def load_known_content_digests(session):
+    """
+    Digests of contents stored in DB become the known ones of this process (their contents are not parsed again).
+    Call it after a rollback: digests of contents which were parsed, but not stored are forgotten
+    (workers of a pool keep theirs, start a new `ingestion_pool`)
+    :return: set of digests
+    """
+    digests = set(session.execute(select(SectionContent.digest)).scalars())
+    _set_known_content_digests(digests)
+    return digests
+
+
+def ingestion_pool(session, workers=1, dedup=False):
+    """
+    Pool of parsing processes for `load_files` (null context if workers=1),
+    with digests of stored contents if `dedup`
+    """
+    known_digests = load_known_content_digests(session) if dedup else set()
+    _set_known_content_digests(known_digests)
+    pool_args = dict(initializer=_set_known_content_digests, initargs=(known_digests,))
+    return Pool(workers, **pool_args) if workers > 1 else nullcontext()
+
+
+def load_files(files, session, pool=None, sections=False, bills=False, versions=False, dedup=False):
+    """
+    Parse xml files (in the pool of `ingestion_pool` if given) and load them to DB,
+    see `parse_and_load` for the flags
+    :return: number of loaded files
+    """
+    # every job is a group of text versions of one bill
+    groups = group_text_versions(files) if versions else [[f] for f in files]
+    job = partial(parse_versions, sections=sections, bills=bills, dedup=dedup)
+    bill_rows = list()
+    loaded = 0
+    # spans and counters of workers come with their results
+    results = map(merge_result, pool.imap_unordered(WorkerJob(job), groups, chunksize=4)) if pool else map(job, groups)
+    for parsed_versions in results:
+        origins = list()
+        for parsed in parsed_versions:
+            increment('ingest.files')
+            loaded += 1
+            if parsed.get('sections'):
+                load_sections(parsed['sections'], session)
+                origins.append(parsed['sections']['origin'])
+            if parsed.get('contents'):
+                load_contents(parsed['contents'], session)
+            if parsed.get('bill'):
+                bill_rows.append(parsed['bill'])
+        if versions and origins:
+            link_unchanged_sections(origins, session)
+        if len(bill_rows) >= 100:
+            load_bills(bill_rows, session)
+            bill_rows = list()
+    load_bills(bill_rows, session)
     session.commit()
+    # new and deleted fingerprints to snapshots of in-memory searches, once per call, see fingerprint_store.py
+    sync_stores(session)
+    return loaded
 
 
-def parse_bill_and_load(xml_path, session):
+def forget_origins(origins, session):
     """
-    Tool for saving whole bills with their hashes to db
-    :param xml_path:
-    :param session:
-    :return:
+    Delete rows loaded from bills `origins` (e.g. before loading their changed files again).
+    Sections of other versions linked to deleted sections (stored without text) don't lose their content:
+    the first of them gets the text and fingerprints of the deleted section and the others are linked to it.
+    :param origins: list of bill origins, see `utils.create_bill_name`
+    :param session: db_session
     """
-    with open(xml_path) as xml:
-        soup = BeautifulSoup(xml, features="xml")
-    sections = list(soup.findAll('section'))
-    if not sections:
-        print('!NO SECTIONS in {}'.format(xml_path))
-        return
-    raw_text = clean_bill_text(soup)
-    cleaned = text_cleaning(raw_text)
-    bit_simhash_text = build_128_simhash(cleaned)
-    origin = create_bill_name(xml_path)
-    titles = soup.find('dc:title') or soup.find('title')
-    title = titles.text if titles else ''
+    sections_table = Section.__tablename__
+    columns = ['text', 'simhash_text', 'simhash_text64', 'hash_ngrams', 'hash_words', 'text_query_index_col']
+    columns += list(fingerprint_columns('simhash_text', None, SIMHASH_BANDS))
+    # the first linked section of other bills, for every section to delete
+    heirs = """
+        SELECT DISTINCT ON (l.linked_section_id) l.linked_section_id AS source_id, l.id
+        FROM {table} l JOIN {table} s ON s.id = l.linked_section_id
+        WHERE s.bill_origin = ANY(:origins) AND NOT l.bill_origin = ANY(:origins)
+        ORDER BY l.linked_section_id, l.id"""
+    with span('ingest.forget'):
+        session.execute(text_to_query("""
+            UPDATE {table} AS l SET linked_section_id = h.id FROM ({heirs}) AS h
+            WHERE l.linked_section_id = h.source_id AND l.id <> h.id""".format(
+            table=sections_table, heirs=heirs.format(table=sections_table))), {'origins': origins})
+        # only heirs are still linked to sections to delete
+        session.execute(text_to_query("""
+            UPDATE {table} AS l SET {assignments}, linked_section_id = NULL FROM {table} AS s
+            WHERE l.linked_section_id = s.id AND s.bill_origin = ANY(:origins)
+              AND NOT l.bill_origin = ANY(:origins)""".format(
+            table=sections_table, assignments=', '.join('{0} = s.{0}'.format(c) for c in columns))),
+            {'origins': origins})
+        for model, column in ((Section, Section.bill_origin), (SectionRef, SectionRef.bill_origin),
+                              (Bill, Bill.origin), (BillPath, BillPath.origin)):
+            session.query(model).filter(column.in_(origins)).delete(synchronize_session=False)
+        session.commit()
+
+
+def parse_bill_file(xml_path, soup=None):
+    """
+    Parse whole bill to row of the bills table with hashes and unique word 4-grams of the text
+    :param xml_path: path to bill in xml format
+    :param soup: already parsed xml, if any
+    :return: dict with column values or None
+    """
+    with span('ingest.parse', file=xml_path):
+        if soup is None:
+            soup = _read_soup(xml_path)
+        sections = list(soup.findAll('section'))
+        if not sections:
+            print('!NO SECTIONS in {}'.format(xml_path))
+            return None
+        raw_text = clean_bill_text(soup)
     if not raw_text:
         print('-- !! NO text in bill ', xml_path)
-        return
+        return None
+    with span('ingest.clean'):
+        cleaned = text_cleaning(raw_text)
+    with span('ingest.hash'):
+        bit_simhash_text = build_128_simhash(cleaned)
+        simhash_text64 = simhash_to_int(build_sim_hash(cleaned))
+    with span('ingest.ngrams'):
+        ngrams = unique_word_ngrams(raw_text, n=4)
+    titles = soup.find('dc:title') or soup.find('title')
+    title = titles.text if titles else ''
     res = soup.find('resolution')
-    meta_info = res.attrs if res else dict()
-    xml_id = meta_info.get('dms-id')
+    meta_info = dict(res.attrs) if res else dict()
     bill_date = soup.find('dc:date')
     if bill_date:
         meta_info['xml_date'] = bill_date.text
-    bill = Bill(bill_text=raw_text,
-                simhash_text=bit_simhash_text,
-                origin=origin)
-    if xml_id:
-        bill.xml_id = xml_id
-    if meta_info:
-        bill.meta_info = meta_info
+    row = dict(bill_text=raw_text,
+               simhash_text=bit_simhash_text,
+               simhash_text64=simhash_text64,
+               origin=create_bill_name(xml_path),
+               xml_id=meta_info.get('dms-id'),
+               meta_info=meta_info or None,
+               title=title or None,
+               simhash_title=None,
+               text_query_index_col=ngrams)
     if title:
-        bill.title = title
-        bill.simhash_title = build_128_simhash(text_cleaning(title))
-    session.add(bill)
-    session.commit()
-    if len(title) > 1000:
-        msg = f'WARNING! LARGE TITLE: bill.id {bill.id}'
-    else:
-        msg = f'created bill, ID:{bill.id}'
-    print(msg)
+        with span('ingest.hash'):
+            row['simhash_title'] = build_128_simhash(text_cleaning(title))
+        if len(title) > 1000:
+            print(f'WARNING! LARGE TITLE: {row["origin"]}')
+    row.update(fingerprint_columns('simhash_text', row['simhash_text'], SIMHASH_BANDS))
+    row.update(fingerprint_columns('simhash_title', row['simhash_title'], SIMHASH_BANDS))
+    return row
+
+
+def load_bills(rows, session):
+    """
+    Bulk insert of parsed bills
+    :param rows: list of dicts, see `parse_bill_file`
+    :param session: db_session
+    """
+    if not rows:
+        return
+    with span('ingest.insert'):
+        session.bulk_insert_mappings(Bill, rows)
+        session.commit()
+    increment('ingest.bills', len(rows))
+    print('created {} bills'.format(len(rows)))
+
+
+def parse_bill_and_load(xml_path, session):
+    """
+    Tool for saving whole bills with their hashes to db
+    :param xml_path:
+    :param session:
+    :return:
+    """
+    row = parse_bill_file(xml_path)
+    if not row:
+        return
+    bill = Bill(**row)
+    with span('ingest.insert'):
+        session.add(bill)
+        session.commit()
+    increment('ingest.bills')
+    print(f'created bill, ID:{bill.id}')
 
 
 def parse_xml_and_load_to_db(xml_path):
@@ -200,64 +530,215 @@ def parse_xml_and_load_to_db(xml_path):
     print('Added {} texts to db, including {} nested'.format(counter+nested_bills_counter, nested_bills_counter))
 
 
-def parse_sections_to_db(xml_path, session):
+def parse_sections_file(xml_path, soup=None, versions=None):
     """
-    Parse single xml file and load to DB
-    Splits the bill to sections and store them separately.
-    If section contain subsections (paragraphs) store each of them as well.
+    Parse single xml file to rows of sections table.
+    Splits the bill to sections, if section contain subsections (paragraphs) create rows for each of them as well.
 
     :param xml_path: path to bill in xml format
-    :return: None
+    :param soup: already parsed xml, if any
+    :param versions: VersionDiff of previous text versions of the bill, see `section_row_from_dict`
+    :return: dict with origin, full_path of the file, rows of sections; None if no sections found
     """
-    with open(xml_path) as xml:
-        soup = BeautifulSoup(xml, features="xml")
-    sections = soup.findAll('section')
-    if not sections:
-        return
-    parsed = [parse_soup_section(sec) for sec in sections]
-    print('-- Successfully parsed {} xml sections.'. format(len(parsed)))
-    counter = 0
-    nested_bills_counter = 0
+    with span('ingest.parse', file=xml_path):
+        if soup is None:
+            soup = _read_soup(xml_path)
+        sections = soup.findAll('section')
+        if not sections:
+            return None
+        parsed = [parse_soup_section(sec) for sec in sections]
     origin = create_bill_name(xml_path)
-    full_path = re.sub(os.environ.get('HOME'), '', xml_path)
-    bill_path = BillPath(origin=origin,
-                         full_path=full_path)
-    session.add(bill_path)
-    for num, element in enumerate(parsed):
-        section_item = create_section_from_dict(element)
-        if not section_item:
+    version = text_version(xml_path)
+    rows = list()
+    nested_counter = 0
+    for element in parsed:
+        row = section_row_from_dict(element, versions=versions)
+        if not row:
             continue
-        section_item.bill_origin = origin
-        session.add(section_item)
-        counter += 1
+        row['bill_origin'] = origin
+        row['version'] = version
+        rows.append(row)
         for nested in element.get('nested', []):
-            nested_section = create_section_from_dict(nested)
-            if not nested_section:
+            nested_row = section_row_from_dict(nested, ngrams=False, versions=versions)
+            if not nested_row:
                 continue
-            nested_section.bill_origin = origin
-            nested_section.parent_id = section_item.section_id
-            session.add(nested_section)
-            nested_bills_counter += 1
+            nested_row['bill_origin'] = origin
+            nested_row['version'] = version
+            nested_row['parent_id'] = row['section_id']
+            rows.append(nested_row)
+            nested_counter += 1
+    return dict(origin=origin,
+                full_path=re.sub(os.environ.get('HOME'), '', xml_path),
+                parsed=len(parsed),
+                rows=rows,
+                nested=nested_counter)
+
+
+def load_sections(parsed, session):
+    """
+    Bulk insert of sections of one bill and its path
+    :param parsed: dict, see `parse_sections_file`
+    :param session: db_session
+    """
+    bill_path = BillPath(origin=parsed['origin'],
+                         full_path=parsed['full_path'])
+    session.add(bill_path)
+    with span('ingest.insert'):
+        session.bulk_insert_mappings(Section, parsed['rows'])
         session.commit()
-    if counter:
-        print('Added {} sections to db, including {} nested'.format(counter+nested_bills_counter, nested_bills_counter))
+    increment('ingest.sections', len(parsed['rows']))
+    print('-- Successfully parsed {} xml sections.'.format(parsed['parsed']))
+    if parsed['rows']:
+        print('Added {} sections to db, including {} nested'.format(len(parsed['rows']), parsed['nested']))
+
+
+def parse_contents_file(xml_path, soup=None):
+    """
+    Parse single xml file to unique section contents and references of the bill sections to them.
+    Contents are keyed by digest of the cleaned text, the text is hashed only if its digest is unknown
+    (not stored in DB before the start of loading and not hashed by this process yet).
+
+    :param xml_path: path to bill in xml format
+    :param soup: already parsed xml, if any
+    :return: dict with origin, full_path of the file, rows of new contents and references; None if no sections
+    """
+    with span('ingest.parse', file=xml_path):
+        if soup is None:
+            soup = _read_soup(xml_path)
+        sections = soup.findAll('section')
+        if not sections:
+            return None
+        parsed = [parse_soup_section(sec) for sec in sections]
+    origin = create_bill_name(xml_path)
+    version = text_version(xml_path)
+    contents = list()
+    refs = list()
+
+    def add(element, parent_id=None):
+        paragraph_text = element.get('text')
+        if not paragraph_text or len(paragraph_text) < 10:
+            return False
+        with span('ingest.clean'):
+            cleaned = text_cleaning(paragraph_text)
+        digest = text_digest(cleaned)
+        header = element.get('header')
+        refs.append(dict(digest=digest,
+                         bill_origin=origin,
+                         section_id=element.get('id'),
+                         parent_id=parent_id,
+                         header=header[:225] if header else None,
+                         version=version))
+        if digest in _KNOWN_CONTENT_DIGESTS:
+            increment('ingest.contents_known')
+            return True
+        _KNOWN_CONTENT_DIGESTS.add(digest)
+        with span('ingest.hash'):
+            simhash_text = build_128_simhash(cleaned)
+            simhash_text64 = simhash_to_int(build_sim_hash(cleaned))
+        with span('ingest.ngrams'):
+            ngrams = unique_word_ngrams(paragraph_text, n=4)
+        content = dict(digest=digest,
+                       text=paragraph_text,
+                       simhash_text=simhash_text,
+                       simhash_text64=simhash_text64,
+                       text_query_index_col=ngrams,
+                       length=len(paragraph_text))
+        content.update(fingerprint_columns('simhash_text', simhash_text, SIMHASH_BANDS))
+        contents.append(content)
+        return True
+
+    for element in parsed:
+        if not add(element):
+            continue
+        for nested in element.get('nested', []):
+            add(nested, parent_id=element.get('id'))
+    return dict(origin=origin,
+                full_path=re.sub(os.environ.get('HOME'), '', xml_path),
+                contents=contents,
+                refs=refs)
+
+
+def load_contents(parsed, session):
+    """
+    Insert new unique contents (skipping those already stored) and references of the bill sections to them
+    :param parsed: dict, see `parse_contents_file`
+    :param session: db_session
+    """
+    session.add(BillPath(origin=parsed['origin'], full_path=parsed['full_path']))
+    with span('ingest.insert'):
+        if parsed['contents']:
+            statement = insert(SectionContent).values(parsed['contents'])
+            session.execute(statement.on_conflict_do_nothing(index_elements=['digest']))
+        digests = list({ref['digest'] for ref in parsed['refs']})
+        content_ids = dict(session.execute(select(SectionContent.digest, SectionContent.id)
+                                           .where(SectionContent.digest.in_(digests))).all())
+        refs = [dict(content_id=content_ids[ref.pop('digest')], **ref) for ref in parsed['refs']]
+        session.bulk_insert_mappings(SectionRef, refs)
+        session.commit()
+    increment('ingest.contents', len(parsed['contents']))
+    increment('ingest.sections', len(refs))
+    print('Added {} sections of {} to db, {} new unique texts'.format(len(refs), parsed['origin'],
+                                                                     len(parsed['contents'])))
+
+
+def link_unchanged_sections(origins, session):
+    """
+    Link rows of unchanged sections (stored without text) to the rows with the same text
+    among versions `origins` of one bill. If there are several such rows,
+    the row of the same section (by section id) is preferred, then the first stored one.
+    :param origins: origins of all text versions of the bill
+    :param session: db_session
+    """
+    db_table_name = CONFIG['DB_connection']['sections_table_name']
+    sql_template = """
+        UPDATE {db_table} AS l SET linked_section_id = m.source_id
+        FROM (
+            SELECT DISTINCT ON (l.id) l.id, s.id AS source_id
+            FROM {db_table} AS l JOIN {db_table} AS s ON s.digest = l.digest
+            WHERE l.bill_origin = ANY(:origins) AND l.text IS NULL AND l.linked_section_id IS NULL
+              AND s.bill_origin = ANY(:origins) AND s.text IS NOT NULL
+            ORDER BY l.id, s.section_id IS NOT DISTINCT FROM l.section_id DESC, s.id
+        ) AS m
+        WHERE l.id = m.id
+    """
+    with span('ingest.link'):
+        result = session.execute(text_to_query(sql_template.format(db_table=db_table_name)),
+                                 {'origins': origins})
+        session.commit()
+    increment('ingest.sections_linked', result.rowcount)
+
+
+def parse_sections_to_db(xml_path, session):
+    """
+    Parse single xml file and load to DB
+    Splits the bill to sections and store them separately.
+    If section contain subsections (paragraphs) store each of them as well.
+
+    :param xml_path: path to bill in xml format
+    :return: None
+    """
+    parsed = parse_sections_file(xml_path)
+    if parsed:
+        load_sections(parsed, session)
 
 
 @timer_wrapper
-def search_grouped_origins(session, text=None, hsh=None, n=4):
+def search_grouped_origins(session, text=None, hsh=None, n=4, use_bands=True, boilerplate='include'):
     """
     Search not repeated origins (filenames) in which most related sections are present.
     Most related - those which has closer Hamming distance
     Entities supposed to be similar if they have Hamming distance lower than n (by default 4).
-    Hamming distance counted between `simhash_value` - integers stored in every row,
-    it counted by MYSQL internal function BIT_COUNT of the XOR operation between values stored in db
-    and the hash provided (`hsh` argument).
+    Hamming distance counted between 128 bit `simhash_text` stored in every row and the hash provided (`hsh` argument),
+    it counted by PostgreSQL function bit_count of the XOR operation between them.
+    If n <= SIMHASH_BANDS candidates are found by indexed band columns, see `utils.hamming_condition`.
     If hsh not provided, we try to count it from `text` provided.
     At least `hsh` or `text` should be specified
     :param session: db_session
     :param text: (optional) text to search
-    :param hsh: (optional) hash value to count Hamming distance
+    :param hsh: (optional) bit string of the hash to count Hamming distance
     :param n: distance between similar entities
+    :param use_bands: use band columns to find candidates
+    :param boilerplate: 'include', 'exclude' or 'collapse' rows of boilerplate clusters, see `clusters.py`
     :return: list of all entities found
     """
     db_table_name = CONFIG['DB_connection']['bills_table_name']
@@ -265,19 +746,25 @@ def search_grouped_origins(session, text=None, hsh=None, n=4):
         if not text:
             print('ERROR, neither hsh, nor text specified')
             return []
-        cleaned = text_cleaning(text)
-        hash_to_find = build_sim_hash(cleaned)
+        with span('search.hash'):
+            cleaned = text_cleaning(text)
+            hash_to_find = build_128_simhash(cleaned)
     else:
         hash_to_find = hsh
     print(f' hash to find: {hash_to_find}')
     sql_template = """
-        SELECT origin, sum(bit_count({hsh} ^ simhash_text)) as sum 
-        from {db_table} WHERE BIT_COUNT({hsh} ^ simhash_text) < {offset} 
+        SELECT origin, sum(bit_count(simhash_text # b'{hsh}')) as sum 
+        from {source} 
         group by origin 
         order by sum
     """
-    query = text_to_query(sql_template.format(db_table=db_table_name, hsh=hash_to_find, offset=n))
-    return {r.origin for r in session.execute(query)}
+    condition = hamming_condition('simhash_text', hash_to_find, n, bands=SIMHASH_BANDS, use_bands=use_bands)
+    source = apply_boilerplate(db_table_name, condition, boilerplate,
+                               order_by=f"bit_count(simhash_text # b'{hash_to_find}')")
+    query = text_to_query(sql_template.format(source=source, hsh=hash_to_find))
+    with span('search.sql', search='grouped_origins'):
+        rows = session.execute(query).fetchall()
+    return {r.origin for r in rows}
 
 
 def find_related_origins(section, session, n=3):
@@ -296,17 +783,14 @@ def test_search():
     # '../../../congress.nosync/data/117/bills/hr/hr1030/text-versions/ih/document.xml'
     # '../../../congress.nosync/data/117/bills/s/s2569/text-versions/is/document.xml'
     #  '../../../congress.nosync/data/117/bills/hr/hr4521/text-versions/eas/document.xml'
-    sections = get_xml_sections(fn)
     db_config = CONFIG['DB_connection']
     session = create_session(db_config)
-    for section in sections:
-        headers = section.xpath('header')
-        title = etree.tostring(headers[0], method='text', encoding='unicode') if headers else 'No title found'
-        origins = set(find_related_origins(section, session, n=3))
-        if origins:
-            print(' section  "{}".'.format(title.strip()))
-            print('Found {} related bills:'.format(len(origins)))
-            print(origins)
+    related = rank_related_bills(session, xml_path=fn, n=4, top_k=10)
+    print('Found {} related bills:'.format(len(related)))
+    for bill in related:
+        print('{origin}: {matched_sections} sections matched ({coverage:.0%}), score {score}'.format(**bill))
+        for evidence in bill['evidence']:
+            print('    section #{section} ~ section id {id}, distance {distance}'.format(**evidence))
         print('-'*55)
 
 
@@ -359,6 +843,76 @@ def test_parse_and_dump():
         print('successfully serialized {} xml bills to {}.'.format(len(parsed), pkl_file_name))
 
 
+def _band_sql(column_name, i, bands=SIMHASH_BANDS):
+    """
+    Bit string of band i of bit(128) fingerprint: bits i, i + bands, ... of it, as `utils.band_bits`
+    """
+    return ' || '.join('substring({} from {} for 1)'.format(column_name, j + 1) for j in range(i, 128, bands))
+
+
+def _band_columns_sql(table_name, column_name, bands=SIMHASH_BANDS, refill=False):
+    """
+    UPDATE filling halves and bands of bit(128) fingerprint from its value for rows where they are empty
+    :param refill: fill them for all rows with the fingerprint, e.g. when bands were built with another layout
+    """
+    band_type = 'bigint' if 128 // bands > 31 else 'int'
+    assignments = ['{c}_hi = substring({c} from 1 for 64)::bigint'.format(c=column_name),
+                   '{c}_lo = substring({c} from 65 for 64)::bigint'.format(c=column_name)]
+    assignments += ['{c}_b{i} = ({band})::bit({w})::{t}'.format(
+        c=column_name, i=i, band=_band_sql(column_name, i, bands), w=128 // bands, t=band_type) for i in range(bands)]
+    query = 'UPDATE {table} SET {assignments} WHERE {c} IS NOT NULL'.format(
+        table=table_name, assignments=', '.join(assignments), c=column_name)
+    return query if refill else query + ' AND {}_hi IS NULL'.format(column_name)
+
+
+def _bands_outdated(connection, table_name, column_name, bands=SIMHASH_BANDS, sample=10):
+    """
+    Whether stored bands of some rows differ from bands of their fingerprints (`utils.split_simhash`),
+    e.g. they were filled before bands were interleaved
+    """
+    query = 'SELECT {c}::text, {names} FROM {table} WHERE {c}_hi IS NOT NULL LIMIT {sample}'.format(
+        c=column_name, table=table_name, sample=int(sample),
+        names=', '.join('{}_b{}'.format(column_name, i) for i in range(bands)))
+    return any(list(row[1:]) != split_simhash(row[0], bands)[2]
+               for row in connection.execute(text_to_query(query)).all())
+
+
+@timer_wrapper
+def migrate_db():
+    """
+    Migrate existing tables to the current ORM models:
+    - add columns missing in db tables (band columns of fingerprints, word n-grams etc.)
+    - fill band columns from existing bit(128) fingerprints (all rows, if bands of the table have another layout)
+    - create indexes after columns are filled
+    Tables that don't exist are skipped, create them with `create_db`.
+    """
+    db_config = CONFIG['DB_connection']
+    engine = get_engine(db_config)
+    inspector = inspect(engine)
+    tables = [t for t in Base.metadata.sorted_tables if inspector.has_table(t.name)]
+    with engine.begin() as connection:
+        for table in tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                connection.execute(text_to_query(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f'added column {table.name}.{column.name}')
+        for model, column_name in BANDED_COLUMNS:
+            if model.__table__ not in tables:
+                continue
+            refill = _bands_outdated(connection, model.__tablename__, column_name)
+            result = connection.execute(text_to_query(_band_columns_sql(model.__tablename__, column_name,
+                                                                        refill=refill)))
+            print(f'{"refilled" if refill else "filled"} bands of {model.__tablename__}.{column_name} '
+                  f'for {result.rowcount} rows')
+    for table in tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    print('Migration done.')
+
+
 def create_db():
     db_config = CONFIG['DB_connection']
     engine = get_engine(db_config)
@@ -372,6 +926,9 @@ if __name__ == '__main__':
     """
     To create tables : 
         python main_tests.py -create_db
+
+    To add new columns (e.g. bands of simhashes) to existing tables, fill them and create indexes:
+        python main_tests.py -migrate
         
     To parse bills as whole and save them to bills_table:
         python main_tests.py -bills
@@ -381,20 +938,35 @@ if __name__ == '__main__':
         
     To parse and load both bills and sections:
         python main_tests.py -all
+
+    Parsing and hashing may run in several processes, add `-workers N` to any of the commands:
+        python main_tests.py -all -workers 4
+
+    To skip hashing of sections which were not changed since previous text version of the bill:
+        python main_tests.py -sections -versions
+
+    To store every unique section text once with references from bills (section_contents and section_refs tables):
+        python main_tests.py -sections -dedup
     """
     print(' ==== START ==== ')
     args = sys.argv
     # create tables in db according to ORM models
     if '-create_db' in args:
         create_db()
+    # add new columns and indexes to existing tables
+    if '-migrate' in args:
+        migrate_db()
     # `parse_and_load` performs loading entities to DB:
     # - read and parse xml files from `samples/congress` folder
     # - split them to sections and count simhash for each section and the bill
     # - load to PostgreSQL DB
+    workers = int(args[args.index('-workers') + 1]) if '-workers' in args else 1
+    versions = '-versions' in args
+    dedup = '-dedup' in args
     if '-sections' in args:
-        parse_and_load(sections=True)
+        parse_and_load(sections=True, workers=workers, versions=versions, dedup=dedup)
     if '-bills' in args:
-        parse_and_load(bills=True)
+        parse_and_load(bills=True, workers=workers, versions=versions)
     if '-all' in args:
-        parse_and_load(full=True)
+        parse_and_load(full=True, workers=workers, versions=versions, dedup=dedup)
     print(' ==== END ==== ')
@@ -0,0 +1,304 @@
+"""
+Instrumentation of ingestion, vectorization and search stages: named spans, counters and latency histograms.
+
+Metrics are disabled by default and then every call is a no-op (span returns shared dummy context manager).
+Enable them with env variable `BILLSIM_METRICS=1` or by calling `configure(enabled=True)`.
+
+Usage:
+    with span('search.sql'):
+        rows = session.execute(query)
+    increment('ingest.sections', 10)
+
+Exporters:
+    - json log: every finished span is written as a json line, see `configure(json_log=...)`
+    - prometheus text format: `prometheus_text()` or http endpoint started with `serve_prometheus(port)`
+
+Worker processes have their own registry: jobs of a process pool are wrapped in `WorkerJob`,
+which returns metrics of the job with its result, and the parent merges them with `merge_result`:
+    results = map(merge_result, pool.imap_unordered(WorkerJob(job), tasks))
+"""
+import json
+import os
+import sys
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter, time
+
+# upper bounds of histogram buckets, seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+METRICS_PREFIX = 'billsim'
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return dict(count=self.count, sum=round(self.sum, 6),
+                    buckets=dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)))
+
+    def merge(self, data):
+        """
+        Add observations of another histogram with the same buckets
+        :param data: `to_dict` of the histogram
+        """
+        for i, bound in enumerate([str(b) for b in self.buckets] + ['+Inf']):
+            self.counts[i] += data['buckets'].get(bound, 0)
+        self.count += data['count']
+        self.sum += data['sum']
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    Measures wall time of the block, stores it into histogram of the span name
+    and passes finished span to the json exporter.
+    """
+    def __init__(self, registry, name, attrs):
+        self.registry = registry
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.registry.stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self._t0 = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = perf_counter() - self._t0
+        self.registry.stack().pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.registry.finish_span(self)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.enabled = False
+        self.json_log = None
+        self.counters = dict()
+        self.histograms = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, attrs)
+
+    def finish_span(self, span):
+        self.observe(span.name, span.duration)
+        if self.json_log is not None:
+            record = dict(ts=round(time(), 6), span=span.name, duration=round(span.duration, 6))
+            if span.parent:
+                record['parent'] = span.parent
+            record.update(span.attrs)
+            line = json.dumps(record, default=str)
+            with self._lock:
+                self.json_log.write(line + '\n')
+                self.json_log.flush()
+
+    def increment(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self, reset=False):
+        """
+        :param reset: clear metrics after the snapshot, so the next one has only new metrics
+        """
+        with self._lock:
+            data = dict(counters=dict(self.counters),
+                        histograms={name: h.to_dict() for name, h in self.histograms.items()})
+            if reset:
+                self.counters.clear()
+                self.histograms.clear()
+            return data
+
+    def merge(self, data):
+        """
+        Add counters and histograms of a snapshot of another registry (e.g. of a worker process)
+        """
+        with self._lock:
+            for name, value in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in data['histograms'].items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].merge(histogram)
+
+    def prometheus_text(self):
+        """
+        Metrics in prometheus text exposition format
+        """
+        lines = list()
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = '{}_{}_total'.format(METRICS_PREFIX, _metric_name(name))
+                lines += ['# TYPE {} counter'.format(metric), '{} {}'.format(metric, value)]
+            if self.histograms:
+                metric = '{}_span_seconds'.format(METRICS_PREFIX)
+                lines.append('# TYPE {} histogram'.format(metric))
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{span="{}",le="{}"}} {}'.format(metric, name, bound, cumulative))
+                lines.append('{}_sum{{span="{}"}} {}'.format(metric, name, round(histogram.sum, 6)))
+                lines.append('{}_count{{span="{}"}} {}'.format(metric, name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _metric_name(name):
+    return ''.join(ch if ch.isalnum() else '_' for ch in name)
+
+
+REGISTRY = Registry()
+
+
+def configure(enabled=True, json_log=None):
+    """
+    Enable or disable metrics.
+    :param enabled: if False every call is a no-op
+    :param json_log: file name or stream to write finished spans as json lines, '-' for stderr
+    :return: registry
+    """
+    REGISTRY.enabled = enabled
+    if json_log == '-':
+        json_log = sys.stderr
+    elif isinstance(json_log, str):
+        json_log = open(json_log, 'a')
+    REGISTRY.json_log = json_log
+    return REGISTRY
+
+
+def span(name, **attrs):
+    return REGISTRY.span(name, **attrs)
+
+
+def increment(name, value=1):
+    REGISTRY.increment(name, value)
+
+
+def observe(name, value):
+    REGISTRY.observe(name, value)
+
+
+def is_enabled():
+    return REGISTRY.enabled
+
+
+def snapshot(reset=False):
+    return REGISTRY.snapshot(reset=reset)
+
+
+def prometheus_text():
+    return REGISTRY.prometheus_text()
+
+
+# process which ran the last WorkerJob, a forked worker starts with a copy of the parent's metrics
+_worker_pid = None
+
+
+class WorkerJob:
+    """
+    Job of a process pool which returns tuple (result, metrics of the job), see `merge_result`.
+    Metrics of the worker are reset after every job, so they are merged in the parent only once.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        global _worker_pid
+        if _worker_pid != os.getpid():
+            REGISTRY.reset()
+            _worker_pid = os.getpid()
+        result = self.func(*args, **kwargs)
+        return result, REGISTRY.snapshot(reset=True) if REGISTRY.enabled else None
+
+
+def merge_result(job_result):
+    """
+    Result of `WorkerJob`, its metrics are merged into the registry of this process
+    """
+    result, data = job_result
+    if data is not None:
+        REGISTRY.merge(data)
+    return result
+
+
+def serve_prometheus(port=9108, host='127.0.0.1'):
+    """
+    Start http endpoint with metrics in background thread, metrics are served on any path.
+    :return: http server, call `shutdown()` to stop it
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if os.environ.get('BILLSIM_METRICS', '').lower() in ('1', 'true', 'on', 'yes'):
+    configure(enabled=True, json_log=os.environ.get('BILLSIM_METRICS_LOG'))
@@ -1,7 +1,11 @@
 """
 Comparable class for bill paragraphs
 
+Hashes of paragraphs are computed lazily, on the first access to `hash_value`,
+or for the whole tree at once with `compute_hashes`. Computed hashes are kept in `to_dict` and in pickles,
+so trees restored from them are not hashed again.
 """
+import os
 import pickle
 from itertools import product
 
@@ -9,37 +13,117 @@ from utils import build_sim_hash
 from utils import text_cleaning
 
 
+def _hash_text(text):
+    """
+    64 bit simhash of the text as integer, None for empty text
+    """
+    if text is None:
+        return None
+    return int(build_sim_hash(text_cleaning(text)), 2)
+
+
 class Paragraph:
     def __init__(self, text, **kwargs):
         self.text = text
-        self.hash_value = None
+        # None is also the hash of empty text, `_hashed` tells whether the hash is computed
+        self._hash_value = None
+        self._hashed = False
         self.children = list()
         self.tag = kwargs.get('tag')
-        if kwargs.get('nested') is not None:
-            for item in kwargs.get('nested'):
+        # 'children' - key of trees dumped by `to_dict` before it was renamed to 'nested'
+        nested = kwargs.get('nested') if kwargs.get('nested') is not None else kwargs.get('children')
+        if nested is not None:
+            for item in nested:
                 self.add_child(Paragraph.from_dict(item))
         if kwargs.get('hash_value') is not None:
             self.hash_value = kwargs.get('hash_value')
-        if not self.hash_value and text is not None:
-            cleaned = text_cleaning(self.text)
-            self.hash_value = build_sim_hash(cleaned).value
+
+    def __setstate__(self, state):
+        """
+        Restore pickles of all versions: with `_hashed` flag, with `hash_value` attribute (computed eagerly)
+        and with the object() placeholder of not computed hashes
+        """
+        state = dict(state)
+        if 'hash_value' in state:
+            state['_hash_value'] = state.pop('hash_value')
+            state.setdefault('_hashed', True)
+        if '_hashed' not in state:
+            value = state.get('_hash_value')
+            state['_hashed'] = value is None or isinstance(value, (int, str))
+            if not state['_hashed']:
+                state['_hash_value'] = None
+        self.__dict__.update(state)
+
+    @property
+    def hash_value(self):
+        if not self._hashed:
+            self.hash_value = _hash_text(self.text)
+        return self._hash_value
+
+    @hash_value.setter
+    def hash_value(self, value):
+        self._hash_value = value
+        self._hashed = True
+
+    @property
+    def is_hashed(self):
+        return self._hashed
 
     def get_children(self):
         for ch in self.children:
             yield ch
 
+    def walk(self):
+        """
+        All paragraphs of the tree, this one first
+        """
+        yield self
+        for ch in self.get_children():
+            yield from ch.walk()
+
+    def compute_hashes(self, cache=None):
+        """
+        Compute hashes of all not hashed paragraphs of the tree in one batch,
+        equal texts are cleaned and hashed once.
+        :param cache: dict text -> hash shared between trees, see `compute_hashes_many`
+        :return: number of hashed texts
+        """
+        return Paragraph.compute_hashes_many([self], cache=cache)
+
+    @classmethod
+    def compute_hashes_many(cls, paragraphs, cache=None):
+        """
+        Compute hashes of all not hashed paragraphs of many trees in one batch
+        :param paragraphs: root paragraphs of trees
+        :param cache: dict text -> hash, filled with new hashes
+        :return: number of hashed texts
+        """
+        cache = cache if cache is not None else dict()
+        pending = [p for root in paragraphs for p in root.walk() if not p.is_hashed]
+        hashed = 0
+        for paragraph in pending:
+            if paragraph.text not in cache:
+                cache[paragraph.text] = _hash_text(paragraph.text)
+                hashed += 1
+            paragraph.hash_value = cache[paragraph.text]
+        return hashed
+
     @classmethod
     def from_dict(cls, data):
-        text = None
-        if data.get('text') is not None:
-            text = data.pop('text')
+        data = dict(data)
+        text = data.pop('text', None)
         return Paragraph(text, **data)
 
-    def to_dict(self):
+    def to_dict(self, with_hashes=True):
+        """
+        :param with_hashes: compute missing hashes of the tree to keep them in the dict
+        """
+        if with_hashes:
+            self.compute_hashes()
         return dict(text=self.text,
-                    hash_value=self.hash_value,
+                    hash_value=self._hash_value if self.is_hashed else None,
                     tag=self.tag,
-                    children=[f.to_dict() for f in self.get_children()])
+                    nested=[f.to_dict(with_hashes=False) for f in self.get_children()])
 
     def add_child(self, child):
         self.children.append(child)
@@ -58,12 +142,8 @@ class Paragraph:
             func(self)
 
     def hashes(self):
-        hashes = list()
-        for ch in self.get_children():
-            if ch.has_children:
-                hashes += [h for h in ch.hashes() if h]
-            hashes.append(self.hash_value)
-        return hashes
+        self.compute_hashes()
+        return [p.hash_value for p in self.walk() if p.hash_value]
 
     def compare(self, other):
         similars = []
@@ -89,17 +169,27 @@ class Paragraph:
         return '{} - [{}]'.format(self.text, len(self))
 
 
-def test_parse():
-
-    with open('../investigate/bills_6.pkl', 'rb') as pkl:
+def load_paragraphs(bills_file, paragraphs_file):
+    """
+    Paragraph trees of bills dumped by `main_tests.test_parse_and_dump`.
+    Converted trees with hashes are stored to `paragraphs_file` and loaded from it next time without hashing.
+    :return: dict number -> Paragraph
+    """
+    if os.path.isfile(paragraphs_file):
+        with open(paragraphs_file, 'rb') as pkl:
+            paragraphs = pickle.load(pkl)
+        print('Loaded {} processed bills from {}.'.format(len(paragraphs), paragraphs_file))
+        return paragraphs
+    with open(bills_file, 'rb') as pkl:
         bills = pickle.load(pkl)
-    paragraphs = dict()
     print('Load OK: {} bills.'.format(len(bills)))
-    for i, (num, b) in enumerate(bills.items()):
-        paragraphs[num] = Paragraph.from_dict(b)
-        if i % 100 == 0:
-            print(f'\r {i}')
-    print()
-    print('All {} converted.'.format(len(paragraphs)))
-    with open('../investigate/paragraphs_6.pkl', 'wb') as file:
+    paragraphs = {num: Paragraph.from_dict(b) for num, b in bills.items()}
+    hashed = Paragraph.compute_hashes_many(paragraphs.values())
+    print('All {} converted, {} unique texts hashed.'.format(len(paragraphs), hashed))
+    with open(paragraphs_file, 'wb') as file:
         pickle.dump(paragraphs, file)
+    return paragraphs
+
+
+def test_parse():
+    load_paragraphs('../investigate/bills_6.pkl', '../investigate/paragraphs_6.pkl')
@@ -0,0 +1,382 @@
+"""
+Backends of fingerprint search of Bill and Section rows: PostgreSQL of config or an embedded SQLite file.
+
+Both give the same results (`search_hits.SearchHit` ordered by distance and id) for the same rows,
+rows are given by model (Bill, Section) or by kind ('bills', 'sections'):
+    backend = PostgresBackend(session)
+    backend = SqliteBackend('search.sqlite')
+    hits = backend.search('sections', bits, n=6)
+    hits = backend.top_k(Bill, bits, k=10, column='simhash_title')
+
+`SqliteBackend` needs neither server nor config.yaml (ORM models and config are imported only by `PostgresBackend`,
+`copy_from` and `load_files`), it's used for local searches, benchmarks and tests.
+Tables (`DEFAULT_TABLES`, the default table names of `bill.py`) have the id, origin and title (header) columns
+of `search_hits.HIT_COLUMNS`, text and the integer columns of every banded fingerprint of the kind
+(see `bill.add_band_columns`): the fingerprint is stored as two signed 64 bit integers `<column>_hi`, `<column>_lo`
+and indexed bands `<column>_b0...`.
+SQLite has neither bit strings nor xor, so Hamming distance is computed by `hamming(hi, lo, query_hi, query_lo)`
+registered in the connection (popcount of `int.bit_count`). Distances below the number of bands
+are searched by the band indexes, as in `utils.hamming_condition`.
+
+Fill the file from DB or parse bills without DB:
+    python search_backend.py export search.sqlite --tables bills sections
+    python search_backend.py load search.sqlite path/to/congress/data --sections --bills
+    python search_backend.py stats search.sqlite
+"""
+import argparse
+import os
+import sqlite3
+
+from sqlalchemy import text as text_to_query
+
+from metrics import increment, span
+from search_hits import FINGERPRINT_COLUMNS, HIT_COLUMNS, TOP_K_RADII, SearchHit, progressive_radii, row_kind
+from utils import fingerprint_columns, hamming_condition, split_simhash
+
+_MASK_64 = (1 << 64) - 1
+
+# tables of SqliteBackend by kind of rows
+DEFAULT_TABLES = {'bills': 'xml_bills', 'sections': 'sections'}
+
+
+def _popcount(value):
+    return bin(value).count('1')
+
+
+_popcount = getattr(int, 'bit_count', _popcount)
+
+
+def hamming(hi, lo, query_hi, query_lo):
+    """
+    Hamming distance of two fingerprints given by signed 64 bit halves, sql function of SqliteBackend
+    """
+    if hi is None or lo is None:
+        return None
+    return _popcount((hi ^ query_hi) & _MASK_64) + _popcount((lo ^ query_lo) & _MASK_64)
+
+
+def halves_to_bits(hi, lo):
+    """
+    Bit string of 128 bit fingerprint from its signed 64 bit halves
+    """
+    return format(hi & _MASK_64, '064b') + format(lo & _MASK_64, '064b')
+
+
+def fingerprints_of(model):
+    """
+    Names of banded fingerprint columns of the model (or kind of rows)
+    """
+    return list(FINGERPRINT_COLUMNS[row_kind(model)])
+
+
+def orm_model(model):
+    """
+    Bill or Section model of the kind of rows, imported lazily: table names of the models are read from config
+    """
+    if not isinstance(model, str):
+        return model
+    from bill import Bill, Section
+    return {'bills': Bill, 'sections': Section}[row_kind(model)]
+
+
+class SearchBackend:
+    """
+    Fingerprint search over rows of Bill and Section models
+    """
+    # number of bands of fingerprints, radii up to it are searched by band indexes
+    bands = 0
+    def search(self, model, bits, n, column='simhash_text', limit=None):
+        """
+        Rows which fingerprint has Hamming distance lower than n
+        :param model: Bill or Section, or kind of rows: 'bills' or 'sections'
+        :param bits: bit string of 128 bit fingerprint
+        :param n: distance threshold
+        :param column: fingerprint column, e.g. 'simhash_title' of bills
+        :param limit: return only `limit` closest rows
+        :return: list of SearchHit ordered by distance and id
+        """
+        raise NotImplementedError
+
+    def top_k(self, model, bits, k=10, column='simhash_text', max_distance=None, radii=TOP_K_RADII):
+        """
+        k closest rows, the radius is widened until k rows are found, see `test_search.search_top_k`:
+        radii beyond band indexes are not tried, the last search is one scan within `max_distance`
+        :return: list of SearchHit ordered by distance and id, at most k
+        """
+        max_distance = max_distance or radii[-1]
+        found = list()
+        for radius in progressive_radii(radii, max_distance, self.bands):
+            found = self.search(model, bits, radius, column=column, limit=k)
+            increment('search.radii')
+            if len(found) >= k:
+                break
+        return found
+
+    def texts(self, model, ids):
+        """
+        :return: dict id -> text
+        """
+        raise NotImplementedError
+
+
+class PostgresBackend(SearchBackend):
+    """
+    Searches in DB of the session, the same queries as `test_search.search_top_k`
+    """
+    def __init__(self, session, use_bands=True):
+        from bill import SIMHASH_BANDS
+        self.session = session
+        self.use_bands = use_bands
+        self.bands = SIMHASH_BANDS if use_bands else 0
+
+    def search(self, model, bits, n, column='simhash_text', limit=None):
+        from test_search import _fetch_hits
+        model = orm_model(model)
+        condition = hamming_condition(column, bits, n, bands=self.bands, use_bands=self.use_bands)
+        query = "SELECT {columns}, bit_count({column} # b'{bits}') AS distance FROM {table} WHERE {condition} " \
+                "ORDER BY distance, id".format(columns=', '.join(HIT_COLUMNS[row_kind(model)]), column=column,
+                                               bits=bits, table=model.__tablename__, condition=condition)
+        if limit is not None:
+            query += ' LIMIT {}'.format(int(limit))
+        return _fetch_hits(self.session, text_to_query(query), model, 'backend')
+
+    def top_k(self, model, bits, k=10, column='simhash_text', max_distance=None, radii=TOP_K_RADII):
+        from test_search import search_top_k
+        return search_top_k(self.session, k=k, text_hash=bits, model=orm_model(model), column=column,
+                            max_distance=max_distance, radii=radii, use_bands=self.use_bands)
+
+    def texts(self, model, ids):
+        from test_search import text_source
+        source, text = text_source(orm_model(model))
+        query = 'SELECT s.id, {} FROM {} WHERE s.id = ANY(:ids)'.format(text, source)
+        return dict(self.session.execute(text_to_query(query), {'ids': list(ids)}).all())
+
+
+class BackendTexts:
+    """
+    Texts of all hits of one search, loaded from the backend on the first access to any of them
+    (the same as `test_search.TextLoader`)
+    """
+    def __init__(self, backend, model, ids):
+        self.backend = backend
+        self.model = model
+        self.ids = list(ids)
+        self._texts = None
+
+    def text(self, row_id):
+        if self._texts is None:
+            with span('search.load_texts', rows=len(self.ids)):
+                self._texts = self.backend.texts(self.model, self.ids)
+        return self._texts.get(row_id)
+
+
+class SqliteBackend(SearchBackend):
+    """
+    Rows and fingerprints in SQLite file (or in memory), see module docs
+    """
+    def __init__(self, path=':memory:', bands=None, tables=None):
+        """
+        :param path: database file, created if it doesn't exist
+        :param bands: number of bands of new file, by default SIMHASH_BANDS of config (8 without config),
+            existing file keeps its bands
+        :param tables: dict kind of rows -> table name, `DEFAULT_TABLES` by default
+        """
+        if bands is None:
+            from config import CONFIG
+            bands = CONFIG.get('SIMHASH_BANDS', 8)
+        self.path = path
+        self.tables = dict(DEFAULT_TABLES, **(tables or dict()))
+        self.connection = sqlite3.connect(path)
+        self.connection.create_function('hamming', 4, hamming, deterministic=True)
+        # number of bands is kept in the file
+        self.bands = self.connection.execute('PRAGMA user_version').fetchone()[0] or bands
+        self.connection.execute('PRAGMA user_version = {}'.format(int(self.bands)))
+        for kind in HIT_COLUMNS:
+            self._create_table(kind)
+            for name in fingerprints_of(kind):
+                self._check_bands(kind, name)
+        self.connection.commit()
+
+    def _check_bands(self, kind, name, sample=10):
+        """
+        Recompute bands from the halves if they were stored with another layout (files built before bands
+        were interleaved, see `utils.band_bits`)
+        """
+        band_names = ['{}_b{}'.format(name, i) for i in range(self.bands)]
+        query = 'SELECT id, {0}_hi, {0}_lo, {1} FROM {2} WHERE {0}_hi IS NOT NULL'.format(
+            name, ', '.join(band_names), self._table(kind))
+        rows = self.connection.execute(query + ' LIMIT {}'.format(int(sample))).fetchall()
+        if all(list(row[3:]) == split_simhash(halves_to_bits(row[1], row[2]), self.bands)[2] for row in rows):
+            return
+        values = [split_simhash(halves_to_bits(hi, lo), self.bands)[2] + [row_id]
+                  for row_id, hi, lo, *_ in self.connection.execute(query).fetchall()]
+        self.connection.executemany('UPDATE {} SET {} WHERE id = ?'.format(
+            self._table(kind), ', '.join('{} = ?'.format(band) for band in band_names)), values)
+        print('recomputed bands of {} rows of {}.{}'.format(len(values), self._table(kind), name))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _table(self, model):
+        return self.tables[row_kind(model)]
+
+    def _fingerprint_columns(self, model):
+        return [name for column in fingerprints_of(model) for name in fingerprint_columns(column, None, self.bands)]
+
+    def _columns(self, model):
+        """
+        Columns of the table of the model: hit columns, text and fingerprint columns
+        """
+        return list(HIT_COLUMNS[row_kind(model)]) + ['text'] + self._fingerprint_columns(model)
+
+    def _create_table(self, kind):
+        table = self._table(kind)
+        definitions = ['id INTEGER PRIMARY KEY'] + ['{} TEXT'.format(name) for name in HIT_COLUMNS[kind][1:]]
+        definitions += ['text TEXT'] + ['{} INTEGER'.format(name) for name in self._fingerprint_columns(kind)]
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, ', '.join(definitions)))
+        for name in fingerprints_of(kind):
+            for i in range(self.bands):
+                self.connection.execute('CREATE INDEX IF NOT EXISTS ix_{table}_{name}_b{i} ON {table} ({name}_b{i})'
+                                        .format(table=table, name=name, i=i))
+
+    def add(self, model, rows):
+        """
+        Insert or replace rows
+        :param model: Bill or Section, or kind of rows
+        :param rows: dicts with columns of `HIT_COLUMNS`, text (`bill_text` of rows of bills is accepted)
+            and bit strings of fingerprints, e.g. rows of `main_tests.parse_file`. Rows without id get a new one.
+        :return: number of rows
+        """
+        columns = self._columns(model)
+        values = list()
+        for row in rows:
+            value = [row.get(name) for name in HIT_COLUMNS[row_kind(model)]]
+            value.append(row.get('text', row.get('bill_text')))
+            for name in fingerprints_of(model):
+                value += fingerprint_columns(name, row.get(name), self.bands).values()
+            values.append(value)
+        with span('sqlite.insert', rows=len(values)):
+            self.connection.executemany('INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                self._table(model), ', '.join(columns), ', '.join('?' * len(columns))), values)
+            self.connection.commit()
+        return len(values)
+
+    def copy_from(self, session, model, batch_size=10000):
+        """
+        Copy rows of the model with fingerprints from DB of the session, rows already copied are replaced
+        :return: number of copied rows
+        """
+        from test_search import text_source
+        source, text = text_source(orm_model(model))
+        # sections without own text (versions mode) are copied with the text of the linked section
+        query = 'SELECT {}, {} AS text, {} FROM {} ORDER BY s.id'.format(
+            ', '.join('s.' + column for column in HIT_COLUMNS[row_kind(model)]), text,
+            ', '.join('s.' + column for column in fingerprints_of(model)), source)
+        copied = 0
+        connection = session.get_bind().connect()
+        try:
+            result = connection.execution_options(stream_results=True).execute(text_to_query(query))
+            for partition in result.partitions(batch_size):
+                copied += self.add(model, [dict(row._mapping) for row in partition])
+                print('copied {} rows of {}'.format(copied, orm_model(model).__tablename__))
+        finally:
+            connection.close()
+        return copied
+
+    def load_files(self, paths, sections=True, bills=False):
+        """
+        Parse xml bills and add their sections and (or) whole bills, as ingestion to DB does
+        :return: dict with numbers of added bills and sections
+        """
+        import main_tests
+        added = dict(bills=0, sections=0)
+        for xml_path in paths:
+            parsed = main_tests.parse_file(xml_path, sections=sections, bills=bills)
+            if parsed.get('sections'):
+                added['sections'] += self.add('sections', parsed['sections']['rows'])
+            if parsed.get('bill'):
+                added['bills'] += self.add('bills', [parsed['bill']])
+        return added
+
+    def search(self, model, bits, n, column='simhash_text', limit=None):
+        hi, lo, band_values = split_simhash(bits, self.bands)
+        params = dict(hi=hi, lo=lo, n=int(n))
+        distance = 'hamming({0}_hi, {0}_lo, :hi, :lo)'.format(column)
+        conditions = ['{} < :n'.format(distance)]
+        if n <= self.bands:
+            # at least one band of similar fingerprints is equal, see `utils.hamming_condition`
+            conditions.insert(0, '({})'.format(' OR '.join('{}_b{i} = :b{i}'.format(column, i=i)
+                                                           for i in range(self.bands))))
+            params.update(('b{}'.format(i), value) for i, value in enumerate(band_values))
+        query = 'SELECT {}, {} AS distance FROM {} WHERE {} ORDER BY distance, id'.format(
+            ', '.join(HIT_COLUMNS[row_kind(model)]), distance, self._table(model), ' AND '.join(conditions))
+        if limit is not None:
+            query += ' LIMIT {}'.format(int(limit))
+        with span('search.sql', search='sqlite'):
+            rows = self.connection.execute(query, params).fetchall()
+        loader = BackendTexts(self, model, [row[0] for row in rows])
+        hits = list()
+        for row in rows:
+            hit = SearchHit(*row)
+            hit.loader = loader
+            hits.append(hit)
+        increment('search.rows', len(hits))
+        return hits
+
+    def band_candidates(self, model, bits, column='simhash_text'):
+        """
+        Number of rows which share at least one band with the fingerprint: rows read by searches with `n <= bands`
+        """
+        band_values = split_simhash(bits, self.bands)[2]
+        condition = ' OR '.join('{}_b{i} = ?'.format(column, i=i) for i in range(self.bands))
+        return self.connection.execute('SELECT count(*) FROM {} WHERE {}'.format(self._table(model), condition),
+                                       band_values).fetchone()[0]
+
+    def texts(self, model, ids):
+        texts = dict()
+        ids = list(ids)
+        # sqlite limits the number of parameters of a statement
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            texts.update(self.connection.execute('SELECT id, text FROM {} WHERE id IN ({})'.format(
+                self._table(model), ', '.join('?' * len(chunk))), chunk).fetchall())
+        return texts
+
+    def count(self, model):
+        return self.connection.execute('SELECT count(*) FROM {}'.format(self._table(model))).fetchone()[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SQLite file for fingerprint search without DB server')
+    parser.add_argument('command', choices=('export', 'load', 'stats'))
+    parser.add_argument('path', help='sqlite file')
+    parser.add_argument('folder', nargs='?', help='folder of xml bills to load')
+    parser.add_argument('--tables', nargs='+', choices=('bills', 'sections'), default=['sections'],
+                        help='tables to export from DB')
+    parser.add_argument('--sections', action='store_true', help='load sections of bills')
+    parser.add_argument('--bills', action='store_true', help='load bills as a whole')
+    args = parser.parse_args(argv)
+    with SqliteBackend(args.path) as backend:
+        if args.command == 'export':
+            from config import CONFIG
+            from utils import create_session
+            session = create_session(CONFIG['DB_connection'])
+            for table in args.tables:
+                backend.copy_from(session, table)
+        elif args.command == 'load':
+            from utils import get_all_file_paths
+            if not args.folder or not os.path.isdir(args.folder):
+                parser.error('give folder of xml bills to load')
+            print(backend.load_files(get_all_file_paths(args.folder, ext='xml'), sections=args.sections,
+                                     bills=args.bills))
+        print('{}: {} bills, {} sections'.format(args.path, backend.count('bills'), backend.count('sections')))
+
+
+if __name__ == '__main__':
+    main()
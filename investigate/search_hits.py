@@ -0,0 +1,53 @@
+"""
+Lightweight search results shared by `test_search` (PostgreSQL) and `search_backend` (also SQLite).
+
+The module reads no config and doesn't import ORM models, so `search_backend.SqliteBackend` works without config.yaml.
+Rows are of two kinds: 'bills' (`bill.Bill`) and 'sections' (`bill.Section`), searches accept either.
+"""
+from collections import namedtuple
+
+# Hamming radii of `test_search.search_top_k`, radii up to SIMHASH_BANDS use band indexes
+TOP_K_RADII = (2, 4, 6, 8, 12, 16, 24, 32)
+
+# columns of lightweight results (`SearchHit`) of every kind of rows: id, origin, title
+HIT_COLUMNS = {'bills': ('id', 'origin', 'title'), 'sections': ('id', 'bill_origin', 'header')}
+
+# fingerprints stored with bands, the same as `bill.BANDED_COLUMNS` of Bill and Section
+FINGERPRINT_COLUMNS = {'bills': ('simhash_text', 'simhash_title'), 'sections': ('simhash_text',)}
+
+_MODEL_KINDS = {'Bill': 'bills', 'Section': 'sections'}
+
+
+def row_kind(model):
+    """
+    Bill --> 'bills', Section --> 'sections', names of kinds are returned as they are
+    """
+    if isinstance(model, str):
+        if model not in HIT_COLUMNS:
+            raise ValueError('kind of rows should be one of {}, got {}'.format(', '.join(HIT_COLUMNS), model))
+        return model
+    return _MODEL_KINDS[model.__name__]
+
+
+def progressive_radii(radii, max_distance, bands):
+    """
+    Radii of `test_search.search_top_k`: those found by band indexes (not larger than `bands`)
+    and lower than `max_distance`, then `max_distance`
+    """
+    return [r for r in radii if r <= bands and r < max_distance] + [max_distance]
+
+
+class SearchHit(namedtuple('SearchHit', ['id', 'origin', 'title', 'distance'])):
+    """
+    Lightweight search result: id, origin, title (header of sections) and Hamming distance.
+    `text` is loaded on the first access, for all hits of the same search at once
+    (see `test_search.TextLoader`, `search_backend.BackendTexts`).
+    """
+    loader = None
+
+    @property
+    def text(self):
+        return self.loader.text(self.id) if self.loader is not None else None
+
+    # compatibility with Bill objects
+    bill_text = text
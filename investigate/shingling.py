@@ -0,0 +1,260 @@
+"""
+Simhash fingerprints without n-gram strings: shingles are windows (start, length) over the utf-8 bytes
+of the normalized text, their hashes are computed for all windows at once in numpy arrays
+and summed bit by bit by `SimhashAccumulator`, chunk by chunk, so memory doesn't grow with the text.
+
+Two hash functions of windows:
+    compat=True - FNV-1a (64 bit, or 128 bit in two 64 bit limbs) of the window bytes, vectorized over windows.
+        Fingerprints are the same as of `Simhash` of `utils._get_ngrams` / `utils._get_features` with
+        `fnv1a_64` / `fnv1a_128`, so stored fingerprints stay valid (utils.build_sim_hash and
+        utils.build_128_simhash use it).
+    compat=False - polynomial rolling hash of the bytes (Rabin-Karp over prefix hashes, mod 2^64)
+        with murmur3 finalizer. The cost doesn't depend on the shingle width,
+        but fingerprints are different: don't compare them with stored ones.
+
+    fingerprint('some cleaned text', bits=128, n=6)
+    fingerprint('some cleaned text', bits=128, n=4, words=True, compat=False)
+"""
+import re
+
+import numpy as np
+
+FNV_64_PRIME = np.uint64(0x100000001b3)
+FNV1_64A_INIT = np.uint64(0xcbf29ce484222325)
+# 128 bit prime is 2^88 + 0x13b, init is split to two 64 bit limbs
+FNV_128_PRIME_LOW = np.uint64(0x13b)
+FNV1_128A_INIT_HI = np.uint64(0x6c62272e07bb0142)
+FNV1_128A_INIT_LO = np.uint64(0x62b821756295c58d)
+
+ROLLING_BASE = 0x100000001b3
+ROLLING_SEED_128 = np.uint64(0x9e3779b97f4a7c15)
+
+# windows hashed at once, bounds memory of temporary arrays
+CHUNK_SIZE = 1 << 16
+
+_U32 = np.uint64(0xffffffff)
+_NON_WORD_CHARS = re.compile(r'[^\w]+')
+_NON_ALPHANUMERIC = re.compile(r'[^a-zA-Z0-9\s]')
+_SPACES = re.compile(r' +')
+
+
+def char_windows(text, width=6):
+    """
+    Windows of `width` characters, the same shingles as `utils._get_ngrams`
+    :return: tuple (bytes buffer as uint8 array, starts, lengths) of windows in bytes
+    """
+    text = _NON_WORD_CHARS.sub('', str(text or '').strip().lower())
+    data = text.encode('utf-8')
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if not len(buffer):
+        return buffer, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if len(data) == len(text):
+        # ascii: characters are bytes
+        starts = np.arange(max(len(data) - width + 1, 1), dtype=np.int64)
+        return buffer, starts, np.minimum(width, len(data) - starts)
+    # first bytes of characters (not continuation bytes 10xxxxxx) and the end of the buffer
+    char_starts = np.append(np.flatnonzero((buffer & 0xC0) != 0x80), len(buffer))
+    count = max(len(text) - width + 1, 1)
+    starts = char_starts[:count]
+    ends = char_starts[np.minimum(np.arange(count) + width, len(text))]
+    return buffer, starts, ends - starts
+
+
+def word_windows(text, width=4):
+    """
+    Windows of `width` words joined by space, the same shingles as `utils._get_features`
+    :return: tuple (bytes buffer as uint8 array, starts, lengths) of windows in bytes
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if not text:
+        return np.zeros(0, dtype=np.uint8), empty, empty
+    # words are separated by single spaces, so every shingle is a slice of the buffer
+    text = _SPACES.sub(' ', _NON_ALPHANUMERIC.sub(' ', text.lower())).strip(' ')
+    buffer = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    if not len(buffer):
+        return buffer, empty, empty
+    spaces = np.flatnonzero(buffer == 32)
+    word_starts = np.append(0, spaces + 1)
+    word_ends = np.append(spaces, len(buffer))
+    count = len(word_starts) - width + 1
+    if count <= 0:
+        return buffer, empty, empty
+    starts = word_starts[:count]
+    return buffer, starts, word_ends[width - 1:] - starts
+
+
+def _by_length(starts, lengths):
+    """
+    Windows ordered by length, the longest first: at every byte offset the windows still hashed are a prefix
+    """
+    if len(lengths) and lengths.min() == lengths.max():
+        return starts, lengths
+    order = np.argsort(-lengths, kind='stable')
+    return starts[order], lengths[order]
+
+
+def _active(lengths, offset):
+    """
+    Number of windows (ordered by length) longer than offset
+    """
+    return int(np.searchsorted(-lengths, -offset, side='left'))
+
+
+def fnv1a_64_windows(buffer, starts, lengths):
+    """
+    64 bit FNV-1a of every window, equal to `fnvhash.fnv1a_64` of its bytes
+    :return: uint64 array, in order of windows sorted by length (simhash doesn't depend on the order)
+    """
+    starts, lengths = _by_length(starts, lengths)
+    hashes = np.full(len(starts), FNV1_64A_INIT, dtype=np.uint64)
+    for offset in range(int(lengths.max()) if len(lengths) else 0):
+        active = _active(lengths, offset)
+        hashes[:active] = (hashes[:active] ^ buffer[starts[:active] + offset]) * FNV_64_PRIME
+    return hashes
+
+
+def fnv1a_128_windows(buffer, starts, lengths):
+    """
+    128 bit FNV-1a of every window, equal to `utils.fnv1a_128` of its bytes.
+    Hash is kept in two uint64 limbs, multiplication by the prime 2^88 + 0x13b is
+    h * 0x13b + (h << 88) mod 2^128.
+    :return: tuple of uint64 arrays (high limbs, low limbs)
+    """
+    starts, lengths = _by_length(starts, lengths)
+    hi = np.full(len(starts), FNV1_128A_INIT_HI, dtype=np.uint64)
+    lo = np.full(len(starts), FNV1_128A_INIT_LO, dtype=np.uint64)
+    for offset in range(int(lengths.max()) if len(lengths) else 0):
+        active = _active(lengths, offset)
+        low = lo[:active] ^ buffer[starts[:active] + offset]
+        # high 64 bits of low * 0x13b
+        carry = ((low >> np.uint64(32)) * FNV_128_PRIME_LOW + (((low & _U32) * FNV_128_PRIME_LOW) >> np.uint64(32))) \
+            >> np.uint64(32)
+        hi[:active] = hi[:active] * FNV_128_PRIME_LOW + carry + (low << np.uint64(24))
+        lo[:active] = low * FNV_128_PRIME_LOW
+    return hi, lo
+
+
+def _fmix64(values):
+    """
+    Finalizer of murmur3: every bit of the result depends on every bit of the value
+    """
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+class RollingHash:
+    """
+    Polynomial hashes of any windows of the buffer from its prefix hashes:
+    prefix[j] = sum(buffer[t] * B^(j-1-t)), hash(start, length) = prefix[start + length] - prefix[start] * B^length,
+    all mod 2^64. Prefixes are computed without a python loop as B^j * cumsum(buffer[t] * B^-t).
+    """
+    def __init__(self, buffer, base=ROLLING_BASE):
+        inverse = pow(base, -1, 1 << 64)
+        size = len(buffer)
+        self.powers = np.cumprod(np.r_[np.uint64(1), np.full(size, base, dtype=np.uint64)], dtype=np.uint64)
+        inverse_powers = np.cumprod(np.r_[np.uint64(1), np.full(max(size - 1, 0), inverse, dtype=np.uint64)],
+                                    dtype=np.uint64)
+        sums = np.cumsum(buffer.astype(np.uint64) * inverse_powers[:size], dtype=np.uint64)
+        self.prefix = np.r_[np.uint64(0), self.powers[:size] * sums]
+
+    def windows(self, starts, lengths):
+        return self.prefix[starts + lengths] - self.prefix[starts] * self.powers[lengths]
+
+
+class SimhashAccumulator:
+    """
+    Bit counts of feature hashes: bit of the fingerprint is set if it's set in more than half of the features,
+    as in `simhash.Simhash` with weights 1
+    """
+    def __init__(self, bits=64):
+        self.bits = bits
+        self.counts = np.zeros(bits, dtype=np.int64)
+        self.features = 0
+
+    def add(self, *limbs):
+        """
+        :param limbs: uint64 arrays of hashes, the high limb first (one array for 64 bit hashes)
+        """
+        words = np.stack(limbs, axis=1).astype('>u8')
+        # big endian bytes: columns of unpacked bits go from the highest bit to the lowest
+        self.counts += np.unpackbits(words.view(np.uint8).reshape(len(words), -1), axis=1).sum(axis=0, dtype=np.int64)
+        self.features += len(words)
+
+    def bit_string(self):
+        return ''.join('1' if 2 * count > self.features else '0' for count in self.counts)
+
+
+def feature_hashes(buffer, starts, lengths, bits=64, compat=True):
+    """
+    Hashes of windows by chunks of CHUNK_SIZE
+    :return: generator of tuples of uint64 arrays (one array for 64 bits, high and low limbs for 128 bits)
+    """
+    rolling = None if compat else RollingHash(buffer)
+    for start in range(0, len(starts), CHUNK_SIZE):
+        chunk_starts, chunk_lengths = starts[start:start + CHUNK_SIZE], lengths[start:start + CHUNK_SIZE]
+        if compat:
+            if bits == 64:
+                yield fnv1a_64_windows(buffer, chunk_starts, chunk_lengths),
+            else:
+                yield fnv1a_128_windows(buffer, chunk_starts, chunk_lengths)
+            continue
+        hashes = rolling.windows(chunk_starts, chunk_lengths)
+        if bits == 64:
+            yield _fmix64(hashes),
+        else:
+            yield _fmix64(hashes), _fmix64(hashes ^ ROLLING_SEED_128)
+
+
+def fingerprint(text, bits=64, n=4, words=False, compat=True):
+    """
+    Simhash of the text as bit string
+    :param text: cleaned text, see `utils.text_cleaning`
+    :param bits: 64 or 128
+    :param n: width of shingles: characters, or words if `words`
+    :param words: shingles of words instead of characters
+    :param compat: FNV-1a hashes of shingles (the same fingerprints as before), otherwise rolling hashes
+    :return: bit string `bits` characters long
+    """
+    if bits not in (64, 128):
+        raise ValueError('bits should be 64 or 128, got {}'.format(bits))
+    buffer, starts, lengths = word_windows(text, n) if words else char_windows(text, n)
+    accumulator = SimhashAccumulator(bits)
+    for hashes in feature_hashes(buffer, starts, lengths, bits, compat):
+        accumulator.add(*hashes)
+    return accumulator.bit_string()
+
+
+def test_shingling(texts=None, repeat=3):
+    """
+    Compare fingerprints and time with the string n-gram implementation of utils
+    """
+    from time import perf_counter
+    from simhash import Simhash
+    from utils import _get_features, _get_ngrams, fnv1a_128
+    from fnvhash import fnv1a_64
+
+    def by_strings(text, bits, n, words):
+        features = _get_features(text, width=n) if words else _get_ngrams(text, width=n)
+        value = Simhash(features, f=bits, hashfunc=fnv1a_64 if bits == 64 else fnv1a_128).value
+        return format(value, '0{}b'.format(bits))
+
+    texts = texts or ['', 'ab', 'a  b c\td', 'héllo wörld ß İstanbul naïve café',
+                      ' '.join('section {} of the act is amended'.format(i) for i in range(20000))]
+    for bits, n, words in ((64, 4, False), (128, 6, False), (128, 4, True), (128, 1, True)):
+        equal = all(fingerprint(text, bits, n, words) == by_strings(text, bits, n, words) for text in texts)
+        timings = dict()
+        for name, func in (('strings', by_strings), ('compat', fingerprint),
+                           ('rolling', lambda *args: fingerprint(*args, compat=False))):
+            t0 = perf_counter()
+            for _ in range(repeat):
+                func(texts[-1], bits, n, words)
+            timings[name] = (perf_counter() - t0) / repeat
+        print('{} bits, n={}, words={}: same fingerprints {}, {}'.format(
+            bits, n, words, equal, ', '.join('{} {:.4f} sec'.format(k, v) for k, v in timings.items())))
+
+
+if __name__ == '__main__':
+    test_shingling()
@@ -0,0 +1,244 @@
+"""
+Generator of synthetic bills for benchmarks and local experiments.
+
+Bills are written offline, no real congress data is required.
+Two layouts are supported:
+    - congress tree (same as `CONGRESS_ROOT_FOLDER`), bill DTD without namespace:
+        <root>/<congress>/bills/<type>/<type><number>/text-versions/<version>/document.xml
+    - flat folder with USLM bills (as samples used by vectorize.py):
+        <root>/<congress>/uslm/BILLS-<congress><type><number><version>.xml
+
+Part of the sections is taken from the shared pool of boilerplate sections
+(with small random mutations) so that similarity search has something to find.
+"""
+import os
+import random
+import shutil
+import tempfile
+from xml.sax.saxutils import escape
+
+DEFAULT_ROOT = os.path.join(tempfile.gettempdir(), 'synthetic_congress')
+# written to the root of every generated corpus, only folders with it are removed on overwrite
+MARKER_FILE = '.synthetic_corpus'
+USLM_NAMESPACE = 'https://xml.house.gov/schemas/uslm/1.0'
+
+BILL_TYPES = ('hr', 's', 'hres', 'sres', 'hjres', 'hconres')
+RESOLUTION_TYPES = ('hres', 'sres', 'hjres', 'hconres')
+TEXT_VERSIONS = ('ih', 'rh', 'eh', 'eas', 'enr')
+
+WORDS = ('the', 'secretary', 'shall', 'of', 'and', 'to', 'in', 'for', 'section', 'act', 'state', 'federal',
+         'program', 'amended', 'by', 'striking', 'inserting', 'subsection', 'paragraph', 'fiscal', 'year',
+         'appropriated', 'such', 'sums', 'as', 'may', 'be', 'necessary', 'carry', 'out', 'this', 'title',
+         'united', 'states', 'code', 'grant', 'entity', 'eligible', 'report', 'congress', 'not', 'later',
+         'than', 'days', 'after', 'date', 'enactment', 'agency', 'health', 'veterans', 'affairs', 'energy',
+         'department', 'public', 'law', 'funds', 'authorized', 'described', 'under', 'with', 'respect',
+         'each', 'any', 'other', 'purposes', 'including', 'provide', 'assistance', 'national', 'defense')
+
+BOILERPLATE_HEADERS = ('Short title', 'Definitions', 'Authorization of appropriations', 'Sense of Congress',
+                       'Findings', 'Severability', 'Effective date', 'Rule of construction')
+
+
+def _sentence(rng, min_words=8, max_words=30):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _paragraph(rng, words):
+    text = []
+    total = 0
+    while total < words:
+        sentence = _sentence(rng)
+        total += sentence.count(' ') + 1
+        text.append(sentence)
+    return ' '.join(text)
+
+
+def _mutate(rng, text, rate=0.02):
+    """
+    Replace small part of words to get near duplicate of the text
+    """
+    words = text.split(' ')
+    for i in range(len(words)):
+        if rng.random() < rate:
+            words[i] = rng.choice(WORDS)
+    return ' '.join(words)
+
+
+def _xml_id(rng, prefix='H'):
+    return prefix + ''.join(rng.choice('0123456789ABCDEF') for _ in range(32))
+
+
+def generate_section(rng, number, subsections=3, words=120, pool=None, boilerplate_rate=0.3):
+    """
+    Generate a section as dict with keys: id, enum, header, text, nested
+    :param rng: random.Random instance
+    :param number: number of section in the bill
+    :param subsections: maximum number of subsections
+    :param words: approximate length of the paragraph in words
+    :param pool: list of shared boilerplate sections to take from
+    :param boilerplate_rate: probability to take section from the pool
+    :return: dict
+    """
+    if pool and rng.random() < boilerplate_rate:
+        template = rng.choice(pool)
+        return dict(template,
+                    id=_xml_id(rng),
+                    enum='{}.'.format(number),
+                    text=_mutate(rng, template['text']),
+                    nested=[dict(sub, id=_xml_id(rng), text=_mutate(rng, sub['text']))
+                            for sub in template['nested']])
+    nested = [{'id': _xml_id(rng),
+               'enum': '({})'.format(chr(ord('a') + i)),
+               'header': _sentence(rng, 2, 5)[:-1],
+               'text': _paragraph(rng, words // 2)} for i in range(rng.randint(0, subsections))]
+    return {'id': _xml_id(rng),
+            'enum': '{}.'.format(number),
+            'header': _sentence(rng, 2, 6)[:-1],
+            'text': _paragraph(rng, words),
+            'nested': nested}
+
+
+def create_boilerplate_pool(rng, size=20, words=60):
+    pool = list()
+    for i in range(size):
+        section = generate_section(rng, 1, subsections=2, words=words)
+        section['header'] = BOILERPLATE_HEADERS[i % len(BOILERPLATE_HEADERS)]
+        pool.append(section)
+    return pool
+
+
+def _section_to_bill_dtd(section, tag='section'):
+    parts = ['<{} id="{}">'.format(tag, section['id']),
+             '<enum>{}</enum>'.format(escape(section['enum'])),
+             '<header>{}</header>'.format(escape(section['header'])),
+             '<text>{}</text>'.format(escape(section['text']))]
+    parts += [_section_to_bill_dtd(sub, tag='subsection') for sub in section.get('nested', [])]
+    parts.append('</{}>'.format(tag))
+    return ''.join(parts)
+
+
+def _section_to_uslm(section, tag='section'):
+    parts = ['<{} id="{}" identifier="/us/bill/{}">'.format(tag, section['id'], section['id'][:8]),
+             '<num>{}</num>'.format(escape(section['enum'])),
+             '<heading>{}</heading>'.format(escape(section['header'])),
+             '<content>{}</content>'.format(escape(section['text']))]
+    parts += [_section_to_uslm(sub, tag='subsection') for sub in section.get('nested', [])]
+    parts.append('</{}>'.format(tag))
+    return ''.join(parts)
+
+
+def bill_to_xml(bill, uslm=False):
+    """
+    Serialize bill dict (see `generate_bill`) to xml string
+    """
+    title = escape(bill['title'])
+    if uslm:
+        body = ''.join(_section_to_uslm(section) for section in bill['sections'])
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<bill xmlns="{ns}" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                '<meta><dc:title>{title}</dc:title><dc:date>{date}</dc:date></meta>'
+                '<main><longTitle><docTitle>{title}</docTitle></longTitle>{body}</main>'
+                '</bill>').format(ns=USLM_NAMESPACE, title=title, date=bill['date'], body=body)
+    tag = 'resolution' if bill['type'] in RESOLUTION_TYPES else 'bill'
+    body = ''.join(_section_to_bill_dtd(section) for section in bill['sections'])
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<{tag} {tag}-stage="Introduced-in-House" dms-id="{dms_id}" public-private="public" key="H">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dublinCore>'
+            '<dc:title>{title}</dc:title><dc:date>{date}</dc:date>'
+            '</dublinCore></metadata>'
+            '<form><official-title>{title}</official-title></form>'
+            '<legis-body>{body}</legis-body>'
+            '</{tag}>').format(tag=tag, dms_id=bill['dms_id'], title=title, date=bill['date'], body=body)
+
+
+def generate_bill(rng, congress, bill_type, number, sections=(3, 20), subsections=3, words=120,
+                  pool=None, boilerplate_rate=0.3):
+    """
+    Generate a bill as dict.
+    :param sections: (min, max) number of sections
+    :return: dict with keys: type, number, title, date, dms_id, sections
+    """
+    n_sections = rng.randint(*sections)
+    return {'type': bill_type,
+            'number': number,
+            'congress': congress,
+            'title': '{} {} {}: {}'.format(congress, bill_type.upper(), number, _sentence(rng, 6, 20)),
+            'date': '2021-{:02d}-{:02d}'.format(rng.randint(1, 12), rng.randint(1, 28)),
+            'dms_id': _xml_id(rng),
+            'sections': [generate_section(rng, num + 1, subsections=subsections, words=words,
+                                          pool=pool, boilerplate_rate=boilerplate_rate)
+                         for num in range(n_sections)]}
+
+
+def next_version(rng, bill, change_rate=0.2):
+    """
+    Create next text version of the bill: part of sections is amended, some added or removed
+    """
+    sections = list()
+    for section in bill['sections']:
+        if rng.random() < change_rate / 4:
+            continue
+        if rng.random() < change_rate:
+            section = dict(section, text=_mutate(rng, section['text'], rate=0.1))
+        sections.append(section)
+    if rng.random() < change_rate:
+        sections.append(generate_section(rng, len(sections) + 1))
+    return dict(bill, sections=sections)
+
+
+def generate_corpus(root=DEFAULT_ROOT, bills=100, congress=117, sections=(3, 20), subsections=3, words=120,
+                    versions=1, uslm=False, boilerplate_rate=0.3, seed=42, overwrite=True):
+    """
+    Write synthetic bills to disk.
+
+    :param root: root folder, acts as CONGRESS_ROOT_FOLDER
+    :param bills: number of bills
+    :param congress: congress number
+    :param sections: (min, max) number of sections per bill
+    :param subsections: maximum number of subsections per section
+    :param words: approximate number of words in a section paragraph
+    :param versions: number of text versions per bill (ih, rh, eh ...), congress tree layout only
+    :param uslm: write USLM bills to a flat folder instead of congress tree
+    :param boilerplate_rate: probability of a section to be taken from the shared boilerplate pool
+    :param seed: random seed, the same seed gives the same corpus
+    :param overwrite: remove existing corpus in `root`
+    :return: list of paths of created files
+    :raises ValueError: `root` is a non-empty folder not created by the generator
+    """
+    rng = random.Random(seed)
+    if os.path.isdir(root) and os.listdir(root):
+        if not os.path.isfile(os.path.join(root, MARKER_FILE)):
+            raise ValueError('{} is not empty and is not a synthetic corpus, choose another folder'.format(root))
+        if overwrite:
+            shutil.rmtree(root)
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, MARKER_FILE), 'w') as marker:
+        marker.write('seed={}\n'.format(seed))
+    pool = create_boilerplate_pool(rng)
+    paths = list()
+    for num in range(1, bills + 1):
+        bill_type = BILL_TYPES[num % len(BILL_TYPES)]
+        bill = generate_bill(rng, congress, bill_type, num, sections=sections, subsections=subsections,
+                             words=words, pool=pool, boilerplate_rate=boilerplate_rate)
+        for version in TEXT_VERSIONS[:max(versions, 1)]:
+            if uslm:
+                folder = os.path.join(root, str(congress), 'uslm')
+                filename = 'BILLS-{}{}{}{}.xml'.format(congress, bill_type, num, version)
+            else:
+                folder = os.path.join(root, str(congress), 'bills', bill_type, '{}{}'.format(bill_type, num),
+                                      'text-versions', version)
+                filename = 'document.xml'
+            os.makedirs(folder, exist_ok=True)
+            xml_path = os.path.join(folder, filename)
+            with open(xml_path, 'w') as xml:
+                xml.write(bill_to_xml(bill, uslm=uslm))
+            paths.append(xml_path)
+            if uslm:
+                break
+            bill = next_version(rng, bill)
+    return paths
+
+
+if __name__ == '__main__':
+    created = generate_corpus()
+    print('Created {} synthetic bills in {}'.format(len(created), DEFAULT_ROOT))
@@ -1,33 +1,147 @@
 import os
 import re
+import json
+
+import numpy as np
 
 from config import CONFIG
 from bs4 import BeautifulSoup
 from lxml import etree
 
 from bill import Bill
+from bill import SIMHASH_BANDS
+from bill import Section
+from sqlalchemy import inspect
+from sqlalchemy import select
 from sqlalchemy import text as text_to_query
+from sqlalchemy.orm.attributes import set_committed_value
 
 # import required utils
 from utils import create_session
-from utils import build_sim_hash
 from utils import build_128_simhash
+from utils import build_sim_hash
+from utils import simhash_to_int
+from utils import unique_word_ngrams
+from utils import ngram_containment
 from utils import text_cleaning
 from utils import timer_wrapper
 from utils import parse_xml_section
 from utils import clean_bill_text
+from utils import hamming_condition
+from utils import split_simhash
+from utils import get_xml_sections
+from utils import create_bill_name
+from clusters import apply_boilerplate
+from clusters import boilerplate_condition
+from fingerprint_index import FingerprintIndex
+from metrics import span, increment
+import search_hits
+from search_hits import TOP_K_RADII, SearchHit, progressive_radii, row_kind
 
 NAMESPACES = {'uslm': 'https://xml.house.gov/schemas/uslm/1.0'}
 
 
+def selected_columns(model, alias=''):
+    """
+    SQL list of columns of the model which are not deferred (large texts, n-grams and json are not selected)
+    """
+    prefix = '{}.'.format(alias) if alias else ''
+    return ', '.join(prefix + prop.columns[0].name for prop in inspect(model).column_attrs if not prop.deferred)
+
+
+# columns of lightweight results (`SearchHit`) of every model: id, origin, title
+HIT_COLUMNS = {model: search_hits.HIT_COLUMNS[row_kind(model)] for model in (Bill, Section)}
+
+
+def text_source(model):
+    """
+    FROM clause (rows of the model as `s`) and expression of their texts.
+    Sections stored without text in versions mode (see `main_tests.link_unchanged_sections`)
+    take the text of their `linked_section_id`.
+    :return: tuple (from clause, text expression)
+    """
+    if not hasattr(model, 'linked_section_id'):
+        return '{} s'.format(model.__tablename__), 's.text'
+    return '{0} s LEFT JOIN {0} l ON l.id = s.linked_section_id'.format(model.__tablename__), 'COALESCE(s.text, l.text)'
+
+
+class TextLoader:
+    """
+    Texts of all rows of one search result, loaded with one query on the first access to any of them
+    (or given as `texts` - dict id -> text, if they are selected already)
+    """
+    def __init__(self, session, model, ids, texts=None):
+        self.session = session
+        self.model = model
+        self.ids = list(ids)
+        self._texts = texts
+
+    def text(self, row_id):
+        if self._texts is None:
+            source, text = text_source(self.model)
+            query = 'SELECT s.id, {} FROM {} WHERE s.id = ANY(:ids)'.format(text, source)
+            with span('search.load_texts', rows=len(self.ids)):
+                self._texts = dict(self.session.execute(text_to_query(query), {'ids': self.ids}).all())
+        return self._texts.get(row_id)
+
+
+def _fetch_hits(session, query, model, search_name, params=None):
+    """
+    Execute sql query selecting `HIT_COLUMNS` of the model and distance, create SearchHit of every row
+    :return: list of SearchHit
+    """
+    with span('search.sql', search=search_name):
+        rows = session.execute(query, params or dict()).all()
+    loader = TextLoader(session, model, [row[0] for row in rows])
+    hits = list()
+    for row in rows:
+        hit = SearchHit(*row)
+        hit.loader = loader
+        hits.append(hit)
+    increment('search.rows', len(hits))
+    return hits
+
+
+def _fetch_bills(session, query, search_name):
+    """
+    Execute sql query and create Bill objects from the rows.
+    Time of the query and of the creating orm objects are measured separately.
+    :param session: db_session
+    :param query: sql query selecting columns of bills table, deferred columns are loaded on access
+    :param search_name: name of the search to label metrics
+    :return: list of bills
+    """
+    with span('search.sql', search=search_name):
+        result = session.execute(select(Bill).from_statement(query))
+    with span('search.hydrate', search=search_name):
+        bills = result.scalars().all()
+    increment('search.rows', len(bills))
+    return bills
+
+
+def load_texts(session, rows):
+    """
+    Load deferred texts of Bill or Section objects with one query instead of a query per object
+    :param rows: list of Bill or Section objects
+    :return: rows
+    """
+    for model, attribute in ((Bill, 'bill_text'), (Section, 'text')):
+        objects = [row for row in rows if isinstance(row, model) and attribute in inspect(row).unloaded]
+        if not objects:
+            continue
+        texts = TextLoader(session, model, [row.id for row in objects])
+        for row in objects:
+            set_committed_value(row, attribute, texts.text(row.id))
+    return rows
+
+
 def find_similar_sections(section, session, n=3, ):
     section_text = etree.tostring(section, method="text", encoding="unicode")
     cleaned = text_cleaning(section_text)
     found_similar = []
     simhash_value = None
     if cleaned and len(cleaned) > 55:
-        sim_hash = build_sim_hash(cleaned)
-        simhash_value = sim_hash.value
+        simhash_value = build_128_simhash(cleaned)
         found_similar = search_similar(hsh=simhash_value, session=session, n=n)
     result = {num: {'origin': found.origin,
                     'text': found.bill_text,
@@ -39,7 +153,8 @@ def find_similar_sections(section, session, n=3, ):
 
 
 @timer_wrapper
-def search_similar_by_text(session, text=None, text_hash=None, bill_id=None, n=6, verbose=False):
+def search_similar_by_text(session, text=None, text_hash=None, bill_id=None, n=6, verbose=False, use_bands=True,
+                           boilerplate='include', full=False):
     """
         Search similar entities in db by text.
     PostgreSQL syntax used here.
@@ -47,6 +162,7 @@ def search_similar_by_text(session, text=None, text_hash=None, bill_id=None, n=6
     Hamming distance counted between `simhash_value` - integers stored in every row,
     it counted by MYSQL internal function BIT_COUNT of the XOR operation between values stored in db
     and the hash provided (`text_hash` argument).
+    If n <= SIMHASH_BANDS candidates are found by indexed band columns, see `utils.hamming_condition`.
     If hsh not provided, we try to count it from `text` provided.
     At least `hsh`, `text` or `bill_id` should be specified
     :param session: db_session
@@ -56,7 +172,11 @@ def search_similar_by_text(session, text=None, text_hash=None, bill_id=None, n=6
     :param bill_id: (optional) if provided, then search all bills, that has similar texts to Bill with this bill_id
     :param n: distance between similar entities
     :param verbose: to print results or not. set to True - for debug
-    :return: list of matching bills
+    :param use_bands: use band columns to find candidates
+    :param boilerplate: 'include', 'exclude' or 'collapse' (one closest bill per cluster) boilerplate clusters,
+        see `clusters.py`
+    :param full: return Bill objects instead of SearchHit
+    :return: list of matching bills: SearchHit ordered by distance or Bill objects
     """
     db_table_name = CONFIG['DB_connection']['bills_table_name']
     if bill_id is None:
@@ -65,32 +185,31 @@ def search_similar_by_text(session, text=None, text_hash=None, bill_id=None, n=6
                 if verbose:
                     print('ERROR, neither hsh, nor text specified')
                 return []
-            cleaned = text_cleaning(text)
-            hash_to_find = build_128_simhash(cleaned)
+            with span('search.hash'):
+                cleaned = text_cleaning(text)
+                hash_to_find = build_128_simhash(cleaned)
         else:
             hash_to_find = text_hash
-        if verbose:
-            print(f' hash to find: {hash_to_find}')
-        sql_template = "SELECT * FROM {db_table} " \
-                       "WHERE bit_count(simhash_text # b'{hash_to_find}') < {n}"
-        query = text_to_query(sql_template.format(db_table=db_table_name,
-                                                  hash_to_find=hash_to_find,
-                                                  n=n))
     else:
-        sql_template = "WITH found_bill AS (" \
-                       " SELECT simhash_title from {db_table}" \
-                       " WHERE id={bill_id}" \
-                       ")" \
-                       " SELECT * FROM {db_table} " \
-                       " WHERE bit_count(simhash_text # (SELECT simhash_text from found_bill)) < {n}"
-        query = text_to_query(sql_template.format(db_table=db_table_name,
-                                                  bill_id=bill_id,
-                                                  n=n))
-    return session.query(Bill).from_statement(query).all()
+        found_bill = session.execute(text_to_query(f"SELECT simhash_text FROM {db_table_name} WHERE id = :bill_id"),
+                                     {'bill_id': bill_id}).first()
+        if not found_bill or not found_bill.simhash_text:
+            return []
+        hash_to_find = found_bill.simhash_text
+    if verbose:
+        print(f' hash to find: {hash_to_find}')
+    condition = hamming_condition('simhash_text', hash_to_find, n, bands=SIMHASH_BANDS, use_bands=use_bands)
+    distance = f"bit_count(simhash_text # b'{hash_to_find}')"
+    source = apply_boilerplate(db_table_name, condition, boilerplate, order_by=distance)
+    if full:
+        return _fetch_bills(session, text_to_query(f"SELECT {selected_columns(Bill)} FROM {source}"), 'by_text')
+    query = text_to_query(f"SELECT {', '.join(HIT_COLUMNS[Bill])}, {distance} AS distance FROM {source} "
+                          f"ORDER BY distance, id")
+    return _fetch_hits(session, query, Bill, 'by_text')
 
 
 @timer_wrapper
-def search_similar_by_title(session, title=None, title_hash=None, n=4, verbose=False):
+def search_similar_by_title(session, title=None, title_hash=None, n=4, verbose=False, use_bands=True, full=False):
     """
     Search similar entities in db by title.
     PostgreSQL syntax used here.
@@ -104,7 +223,9 @@ def search_similar_by_title(session, title=None, title_hash=None, n=4, verbose=F
     :param title: (optional) text to search
     :param title_hash: (optional) bit string to count Hamming distance
     :param n: distance between similar entities
-    :return: list of all entities found
+    :param use_bands: use band columns to find candidates, see `utils.hamming_condition`
+    :param full: return Bill objects instead of SearchHit
+    :return: list of all entities found: SearchHit ordered by distance or Bill objects
     """
     db_table_name = CONFIG['DB_connection']['bills_table_name']
     if not title_hash:
@@ -112,51 +233,386 @@ def search_similar_by_title(session, title=None, title_hash=None, n=4, verbose=F
             if verbose:
                 print('ERROR, neither hash, nor title specified')
             return []
-        hash_to_find = build_128_simhash(title)
+        with span('search.hash'):
+            hash_to_find = build_128_simhash(title)
     else:
         hash_to_find = title_hash
     if verbose:
         print(f' hash to find: {hash_to_find}')
     sql_template = """
-    SELECT * FROM {db_table} 
-    WHERE bit_count(simhash_title # b'{hash_to_find}') < {n}"""
-    query = text_to_query(sql_template.format(db_table=db_table_name,
-                                              hash_to_find=hash_to_find,
-                                              n=n))
-    return session.query(Bill).from_statement(query).all()
+    SELECT {columns} FROM {db_table} 
+    WHERE {condition}"""
+    condition = hamming_condition('simhash_title', hash_to_find, n, bands=SIMHASH_BANDS, use_bands=use_bands)
+    if full:
+        query = sql_template.format(columns=selected_columns(Bill), db_table=db_table_name, condition=condition)
+        return _fetch_bills(session, text_to_query(query), 'by_title')
+    columns = f"{', '.join(HIT_COLUMNS[Bill])}, bit_count(simhash_title # b'{hash_to_find}') AS distance"
+    query = sql_template.format(columns=columns, db_table=db_table_name, condition=condition)
+    return _fetch_hits(session, text_to_query(query + ' ORDER BY distance, id'), Bill, 'by_title')
+
+
+@timer_wrapper
+def search_top_k(session, k=10, text=None, text_hash=None, model=Bill, column='simhash_text', max_distance=None,
+                 radii=TOP_K_RADII, use_bands=True, boilerplate='include', full=False):
+    """
+    k closest rows by Hamming distance without guessing `n`: search starts with a tight radius
+    and widens it (`radii`) until k rows are found or `max_distance` is reached.
+    Only radii found by band indexes (not larger than SIMHASH_BANDS) are tried one by one,
+    beyond them every query is a full scan, so it's done once with `max_distance`.
+    Rows found within a radius are exactly the closest ones, so the result is the true top k.
+    Only lightweight columns are selected while widening, full rows are loaded once for the result if `full`.
+    (In-memory indexes count all distances anyway, their top k is `FingerprintIndex.search(bits, n, limit=k)`.)
+    At least `text_hash` or `text` should be specified
+    :param session: db_session
+    :param k: number of rows to return
+    :param text: (optional) text to search, hashed as in `search_similar_by_text`
+    :param text_hash: (optional) bit string of 128 bit fingerprint
+    :param model: Bill or Section
+    :param column: fingerprint column, e.g. 'simhash_title' of bills
+    :param max_distance: the largest radius (exclusive), by default the last of `radii`
+    :param radii: increasing Hamming distance thresholds to try
+    :param use_bands: use band columns to find candidates, see `utils.hamming_condition`
+    :param boilerplate: 'include', 'exclude' or 'collapse' boilerplate clusters, see `clusters.py`
+    :param full: return tuples (row, distance) with Bill or Section objects instead of SearchHit
+    :return: list of SearchHit (or tuples) ordered by distance, at most k
+    """
+    if not text_hash:
+        if not text:
+            print('ERROR, neither hash, nor text specified')
+            return []
+        with span('search.hash'):
+            text_hash = build_128_simhash(text_cleaning(text))
+    max_distance = max_distance or radii[-1]
+    radii = progressive_radii(radii, max_distance, SIMHASH_BANDS if use_bands else 0)
+    table = model.__tablename__
+    distance = f"bit_count({column} # b'{text_hash}')"
+    found = list()
+    for radius in radii:
+        condition = hamming_condition(column, text_hash, radius, bands=SIMHASH_BANDS, use_bands=use_bands)
+        source = apply_boilerplate(table, condition, boilerplate, order_by=distance)
+        query = (f"SELECT {', '.join(HIT_COLUMNS[model])}, {distance} AS distance FROM {source} "
+                 f"ORDER BY distance, id LIMIT :k")
+        found = _fetch_hits(session, text_to_query(query), model, 'top_k', {'k': k})
+        increment('search.radii')
+        if len(found) >= k:
+            break
+    if not full or not found:
+        return found
+    distances = {hit.id: hit.distance for hit in found}
+    query = text_to_query(f"SELECT {selected_columns(model)} FROM {table} WHERE id = ANY(:ids)").bindparams(
+        ids=list(distances))
+    with span('search.hydrate', search='top_k'):
+        rows = session.execute(select(model).from_statement(query)).scalars().all()
+    increment('search.rows', len(rows))
+    return sorted(((row, distances[row.id]) for row in rows), key=lambda pair: (pair[1], pair[0].id))
+
+
+@timer_wrapper
+def search_similar_contents(session, text=None, text_hash=None, n=6, use_bands=True):
+    """
+    Search similar unique section texts (see `bill.SectionContent`).
+    Every text is found once, with the list of bill sections it is used in.
+    At least `text_hash` or `text` should be specified
+    :param session: db_session
+    :param text: (optional) text to search
+    :param text_hash: (optional) bit string to count Hamming distance
+    :param n: distance between similar entities
+    :param use_bands: use band columns to find candidates, see `utils.hamming_condition`
+    :return: list of rows (id, text, distance, refs), refs are strings '<bill origin>:<section id>'
+    """
+    db_config = CONFIG['DB_connection']
+    contents_table = db_config.get('section_contents_table_name', 'section_contents')
+    refs_table = db_config.get('section_refs_table_name', 'section_refs')
+    if not text_hash:
+        if not text:
+            print('ERROR, neither hash, nor text specified')
+            return []
+        with span('search.hash'):
+            text_hash = build_128_simhash(text_cleaning(text))
+    condition = hamming_condition('simhash_text', text_hash, n, bands=SIMHASH_BANDS, use_bands=use_bands,
+                                  alias='c')
+    sql_template = """
+    SELECT c.id, c.text, bit_count(c.simhash_text # b'{hsh}') AS distance,
+           array_agg(r.bill_origin || ':' || coalesce(r.section_id, '') ORDER BY r.id) AS refs
+    FROM {contents_table} c JOIN {refs_table} r ON r.content_id = c.id
+    WHERE {condition}
+    GROUP BY c.id
+    ORDER BY distance"""
+    query = sql_template.format(hsh=text_hash, contents_table=contents_table, refs_table=refs_table,
+                                condition=condition)
+    with span('search.sql', search='contents'):
+        rows = session.execute(text_to_query(query)).all()
+    increment('search.rows', len(rows))
+    return rows
+
+
+@timer_wrapper
+def search_similar_sharded(session, coordinator, model=Bill, text=None, text_hash=None, n=6, limit=None):
+    """
+    Search similar entities in the sharded in-memory index of `simhash_text` fingerprints
+    (see `fingerprint_index.Coordinator`) and load found rows from db.
+    At least `text_hash` or `text` should be specified
+    :param session: db_session
+    :param coordinator: Coordinator of shards with fingerprints of `model` table
+    :param model: Bill or Section
+    :param text: (optional) text to search
+    :param text_hash: (optional) bit string to count Hamming distance
+    :param n: distance between similar entities
+    :param limit: return only `limit` closest entities
+    :return: tuple (list of tuples (entity, distance) ordered by distance, True if some shards didn't answer)
+    """
+    if not text_hash:
+        if not text:
+            print('ERROR, neither hash, nor text specified')
+            return [], False
+        with span('search.hash'):
+            text_hash = build_128_simhash(text_cleaning(text))
+    with span('search.shards', search='sharded'):
+        result = coordinator.search(text_hash, n, limit=limit)
+    if result['partial']:
+        print('WARNING, partial result, shards failed: {}'.format(result['errors']))
+    distances = dict(result['hits'])
+    with span('search.sql', search='sharded'):
+        rows = session.execute(select(model).where(model.id.in_(list(distances)))).scalars().all()
+    increment('search.rows', len(rows))
+    return sorted(((row, distances[row.id]) for row in rows), key=lambda found: found[1]), result['partial']
+
+
+@timer_wrapper
+def search_cascade(session, index, text, model=Section, n=8, n64=None, min_score=0.0, limit=None):
+    """
+    Three-stage search of the text: 64 bit fingerprints of `fingerprint_index.CascadeIndex` filter candidates,
+    their 128 bit fingerprints are checked with threshold `n`, texts of the rest are loaded (one query)
+    and scored by exact containment of word 4-grams of the query (see `utils.ngram_containment`).
+    :param session: db_session
+    :param index: CascadeIndex of `model` table
+    :param text: text to search
+    :param model: Bill or Section
+    :param n: Hamming distance threshold of 128 bit fingerprints
+    :param n64: threshold of 64 bit fingerprints, see `CascadeIndex.search`
+    :param min_score: skip rows with lower score
+    :param limit: return only `limit` best rows
+    :return: list of tuples (SearchHit, score) ordered by score (descending), distance and id
+    """
+    cleaned = text_cleaning(text)
+    with span('search.hash'):
+        bits = build_128_simhash(cleaned)
+        fp64 = simhash_to_int(build_sim_hash(cleaned))
+    with span('search.index', search='cascade'):
+        found = index.search(bits, n, fp64=fp64, n64=n64)
+    if not found:
+        return []
+    columns = ', '.join('s.' + column for column in HIT_COLUMNS[model])
+    source, text_column = text_source(model)
+    query = text_to_query(f"SELECT {columns}, {text_column} FROM {source} WHERE s.id = ANY(:ids)")
+    with span('search.sql', search='cascade'):
+        rows = {row[0]: row for row in session.execute(query, {'ids': [row_id for row_id, _ in found]}).all()}
+    loader = TextLoader(session, model, rows, texts={row_id: row[-1] for row_id, row in rows.items()})
+    query_ngrams = set(unique_word_ngrams(text))
+    scored = list()
+    with span('search.score', search='cascade'):
+        for row_id, distance in found:
+            if row_id not in rows:
+                continue
+            score = ngram_containment(query_ngrams, unique_word_ngrams(rows[row_id][-1]))
+            if score < min_score:
+                continue
+            hit = SearchHit(*rows[row_id][:-1], distance)
+            hit.loader = loader
+            scored.append((hit, score))
+    scored.sort(key=lambda pair: (-pair[1], pair[0].distance, pair[0].id))
+    increment('search.rows', len(scored))
+    return scored[:limit] if limit is not None else scored
+
+
+def fingerprint_sections(xml_path=None, sections=None, min_length=55):
+    """
+    Fingerprints of all sections of the bill in one batch
+    :param xml_path: (optional) path to bill in xml format
+    :param sections: (optional) list of section texts or dicts with 'text' and optional 'header'
+    :param min_length: skip sections with shorter cleaned text
+    :return: list of dicts with number of the section in the bill, header and 128 bit simhash
+    """
+    if xml_path:
+        sections = list()
+        for element in get_xml_sections(xml_path):
+            header = element.find('{*}header')
+            sections.append(dict(text=etree.tostring(element, method='text', encoding='unicode'),
+                                 header=etree.tostring(header, method='text', encoding='unicode').strip()
+                                 if header is not None else None))
+    fingerprints = list()
+    with span('search.hash', sections=len(sections or [])):
+        for number, section in enumerate(sections or []):
+            if isinstance(section, str):
+                section = dict(text=section)
+            cleaned = text_cleaning(section['text'])
+            if len(cleaned) <= min_length:
+                continue
+            fingerprints.append(dict(section=number, header=section.get('header'), hash=build_128_simhash(cleaned)))
+    return fingerprints
+
+
+def _ranking_result(origin, matched, score, evidence, total):
+    return dict(origin=origin, matched_sections=matched, coverage=round(matched / total, 4) if total else 0,
+                score=score, evidence=evidence)
+
+
+@timer_wrapper
+def rank_related_bills(session, xml_path=None, sections=None, n=4, top_k=10, exclude_origins=None,
+                       boilerplate='include', use_bands=True):
+    """
+    Rank bills related to the given one by all its sections in a single SQL statement.
+    Every section of the bill is matched to stored sections with Hamming distance lower than n
+    (unchanged sections of later text versions have fingerprints of their `linked_section_id`, so they match too),
+    for every (bill, section of the query) only the closest match counts.
+    Bills are ranked by score = sum of (n - distance) of the matches, so both the number of matched sections
+    and their closeness matter.
+    At least `xml_path` or `sections` should be specified
+    :param session: db_session
+    :param xml_path: (optional) path to bill in xml format, the bill itself is excluded from results
+    :param sections: (optional) list of section texts or dicts, see `fingerprint_sections`
+    :param n: distance between similar sections
+    :param top_k: number of bills to return
+    :param exclude_origins: origins to skip
+    :param boilerplate: 'include' or 'exclude' sections of boilerplate clusters, see `clusters.py`
+    :param use_bands: use band columns to find candidates, see `utils.hamming_condition`
+    :return: list of dicts with keys origin, matched_sections, coverage (share of matched sections of the query),
+        score and evidence - list of dicts (section - number of the section in the query, id - id of matched
+        section, distance)
+    """
+    if boilerplate not in ('include', 'exclude'):
+        raise ValueError('boilerplate should be "include" or "exclude" for ranking, got {}'.format(boilerplate))
+    queries = fingerprint_sections(xml_path=xml_path, sections=sections)
+    if not queries:
+        return []
+    exclude_origins = set(exclude_origins or [])
+    if xml_path:
+        exclude_origins.add(create_bill_name(xml_path))
+    table = CONFIG['DB_connection']['sections_table_name']
+    values = list()
+    for query in queries:
+        _, _, band_values = split_simhash(query['hash'], SIMHASH_BANDS)
+        values.append("({}, b'{}'::bit(128), {})".format(query['section'], query['hash'],
+                                                        ', '.join(str(v) for v in band_values)))
+    band_names = ', '.join('b{}'.format(i) for i in range(SIMHASH_BANDS))
+    conditions = ["bit_count(s.simhash_text # q.hsh) < {}".format(int(n))]
+    if use_bands and n <= SIMHASH_BANDS:
+        conditions.insert(0, '({})'.format(' OR '.join('s.simhash_text_b{i} = q.b{i}'.format(i=i)
+                                                        for i in range(SIMHASH_BANDS))))
+    if boilerplate == 'exclude':
+        conditions.append(boilerplate_condition(alias='s'))
+    origin_filter = ''
+    if exclude_origins:
+        origin_filter = 'WHERE origin NOT IN ({})'.format(', '.join(':origin{}'.format(i)
+                                                                    for i in range(len(exclude_origins))))
+    query = """
+    WITH q(section_no, hsh, {band_names}) AS (VALUES {values}),
+    hits AS (
+        SELECT s.id, s.bill_origin AS origin, q.section_no, bit_count(s.simhash_text # q.hsh) AS distance
+        FROM q JOIN {table} s ON {conditions}
+    ),
+    best AS (
+        SELECT DISTINCT ON (origin, section_no) origin, section_no, id, distance
+        FROM hits {origin_filter}
+        ORDER BY origin, section_no, distance, id
+    )
+    SELECT origin, count(*) AS matched, sum({n} - distance) AS score,
+           json_agg(json_build_object('section', section_no, 'id', id, 'distance', distance)
+                    ORDER BY section_no) AS evidence
+    FROM best
+    GROUP BY origin
+    ORDER BY score DESC, matched DESC, origin
+    LIMIT {top_k}""".format(band_names=band_names, values=', '.join(values), table=table,
+                            conditions=' AND '.join(conditions), origin_filter=origin_filter, n=int(n),
+                            top_k=int(top_k))
+    params = {'origin{}'.format(i): origin for i, origin in enumerate(sorted(exclude_origins))}
+    with span('search.sql', search='rank'):
+        rows = session.execute(text_to_query(query), params).all()
+    increment('search.rows', len(rows))
+    return [_ranking_result(row.origin, row.matched, int(row.score),
+                            row.evidence if isinstance(row.evidence, list) else json.loads(row.evidence),
+                            len(queries))
+            for row in rows]
+
+
+def load_sections_index(session):
+    """
+    Fingerprints of all sections in memory for `rank_related_bills_in_index`.
+    Sections linked to unchanged sections of previous versions get fingerprints of those sections.
+    :return: tuple (FingerprintIndex, array of bill origins of its rows)
+    """
+    table = CONFIG['DB_connection']['sections_table_name']
+    query = """
+    SELECT l.id, s.simhash_text_hi, s.simhash_text_lo, l.bill_origin
+    FROM {table} l JOIN {table} s ON s.id = coalesce(l.linked_section_id, l.id)
+    WHERE s.simhash_text_hi IS NOT NULL""".format(table=table)
+    rows = session.execute(text_to_query(query)).all()
+    index = FingerprintIndex([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])
+    return index, np.array([r[3] or '' for r in rows], dtype=object)
+
+
+def rank_related_bills_in_index(index, origins, xml_path=None, sections=None, n=4, top_k=10, exclude_origins=None):
+    """
+    The same ranking as `rank_related_bills` over in-memory index, see `load_sections_index`
+    :param index: FingerprintIndex of sections
+    :param origins: bill origins of rows of the index
+    :return: list of dicts, see `rank_related_bills`
+    """
+    queries = fingerprint_sections(xml_path=xml_path, sections=sections)
+    if not queries or not len(index):
+        return []
+    exclude_origins = set(exclude_origins or [])
+    if xml_path:
+        exclude_origins.add(create_bill_name(xml_path))
+    origin_names, origin_codes = np.unique(origins, return_inverse=True)
+    origin_codes = origin_codes.reshape(-1)
+    hit_rows, hit_sections, hit_distances = list(), list(), list()
+    with span('search.index', search='rank'):
+        for number, query in enumerate(queries):
+            distances = index.distances(query['hash'])
+            rows = np.flatnonzero(distances < n)
+            hit_rows.append(rows)
+            hit_sections.append(np.full(len(rows), number))
+            hit_distances.append(distances[rows].astype(np.int64))
+        rows = np.concatenate(hit_rows)
+        section_numbers = np.concatenate(hit_sections)
+        distances = np.concatenate(hit_distances)
+        codes = origin_codes[rows]
+        # the closest match of every (bill, section of the query)
+        order = np.lexsort((index.ids[rows], distances, section_numbers, codes))
+        pairs = codes[order] * len(queries) + section_numbers[order]
+        best = order[np.r_[True, pairs[1:] != pairs[:-1]]] if len(order) else order
+        matched = np.bincount(codes[best], minlength=len(origin_names))
+        scores = np.bincount(codes[best], weights=n - distances[best], minlength=len(origin_names))
+    excluded = np.isin(origin_names, list(exclude_origins))
+    candidates = np.flatnonzero((matched > 0) & ~excluded)
+    # ordered as in sql: score desc, matched desc, origin
+    ranked = sorted(candidates.tolist(), key=lambda code: (-scores[code], -matched[code], origin_names[code]))[:top_k]
+    results = list()
+    for code in ranked:
+        evidence = sorted((dict(section=queries[section_numbers[i]]['section'], id=int(index.ids[rows[i]]),
+                                distance=int(distances[i])) for i in best[codes[best] == code]),
+                          key=lambda e: e['section'])
+        results.append(_ranking_result(origin_names[code], int(matched[code]), int(scores[code]), evidence,
+                                       len(queries)))
+    return results
 
 
 @timer_wrapper
 def search_similar(session, text=None, hsh=None, n=4):
     """
-    ! this is a test function to search within Mysql database
-    @TODO deprecate and delete
+    @TODO deprecate and delete, use `search_similar_by_text` (or `search_backend` for search without DB server)
     Search similar entities in db.
     Entities supposed to be similar if they have Hamming distance lower than n (by default 4).
-    Hamming distance counted between `simhash_value` - integers stored in every row,
-    it counted by MYSQL internal function BIT_COUNT of the XOR operation between values stored in db
-    and the hash provided (`hsh` argument).
     If hsh not provided, we try to count it from `text` provided.
     At least `hsh` or `text` should be specified
     :param session: db_session
     :param text: (optional) text to search
-    :param hsh: (optional) hash value to count Hamming distance
+    :param hsh: (optional) bit string of 128 bit simhash to count Hamming distance
     :param n: distance between similar entities
-    :return: list of all entities found
+    :return: list of Bill objects found
     """
-    db_table_name = CONFIG['DB_connection']['bills_table_name']
-    if not hsh:
-        if not text:
-            print('ERROR, neither hsh, nor text specified')
-            return []
-        cleaned = text_cleaning(text)
-        hash_to_find = build_sim_hash(cleaned)
-    else:
-        hash_to_find = hsh
-    print(f' hash to find: {hash_to_find}')
-    sql_template = """SELECT * from {} WHERE BIT_COUNT({} ^ simhash_text) < {}"""
-    query = text_to_query(sql_template.format(db_table_name, hash_to_find, n))
-    return session.query(Bill).from_statement(query).all()
+    return search_similar_by_text(session, text=text, text_hash=hsh, n=n, full=True)
 
 
 def test_search_old():
@@ -174,8 +630,7 @@ def test_search_old():
     for element in paragraphs:
         paragraph_text = element.get('text')
         cleaned = text_cleaning(paragraph_text)
-        sim_hash = build_sim_hash(cleaned)
-        simhash_value = sim_hash.value
+        simhash_value = build_128_simhash(cleaned)
         found_similar_paragraphs = search_similar(hsh=simhash_value, session=session, n=3)
         if found_similar_paragraphs:
             print('\n--- found similar paragraphs: ----')
@@ -231,19 +686,6 @@ def test_search():
         print('-'*50)
 
 
-@timer_wrapper
-def update_hashes_script():
-    db_config = CONFIG['DB_connection']
-    session = create_session(db_config)
-    for num, bill in enumerate(session.query(Bill).all()):
-        simhash_title = build_sim_hash(bill.title)
-        bill.hash_title64 = simhash_title
-        session.add(bill)
-        if num % 100 == 0:
-            session.commit()
-            print(num)
-
-
 if __name__ == '__main__':
     test_search()
-    # update_hashes_script()
+    # to recompute fingerprint columns use backfill.py
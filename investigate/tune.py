@@ -0,0 +1,316 @@
+"""
+Recall and latency of simhash search for thresholds, shingle widths and kinds of fingerprints.
+
+Queries are sampled from the corpus (sections from DB, or parsed from xml files without DB).
+Ground truth of a query are the other texts which contain at least `min_score` of its word 4-grams
+(`utils.ngram_containment`, the exact score of `test_search.search_cascade`), found by an inverted index of n-grams.
+For every fingerprint (characters or words, shingle width, 64 or 128 bits) all texts are hashed
+(`shingling.fingerprint`) and every radius is measured:
+    recall - share of relevant texts of the query found within the radius (mean over queries with relevant texts)
+    candidates - mean number of texts found within the radius (rows to load and score)
+    latency - scoring cost only: time of the in-memory scan (`FingerprintIndex`) plus exact scores
+        of the candidates, per query; it doesn't depend on the radius the way DB queries do
+With `--sql` 128 bit fingerprints are also loaded to in-memory `search_backend.SqliteBackend`, which searches
+as DB does (band indexes for radii up to the number of bands, a full scan beyond), and every radius gets:
+    scanned - mean number of rows read by the query: rows sharing a band with the query, or all rows
+    sql - time of the query, per query
+Number of distinct values of every band of 128 bit fingerprints is printed too: a band with few values
+matches most rows, its index doesn't narrow searches.
+
+    python tune.py --queries 200 --target 0.95
+    python tune.py --folder /tmp/synthetic_congress --kinds chars:6 --bits 128 --sql
+    python tune.py --folder path/to/congress/data --kinds chars:6 words:4 --bits 128 --out tune.json
+The cheapest setting (fewest candidates, then time of the query and scoring) with recall >= target is printed at the end.
+
+`--cascade` measures the first stage of `fingerprint_index.CascadeIndex` instead: rows found by the full scan
+of 128 bit fingerprints within `n` are the ground truth, recall is the share of them kept by 64 bit candidates
+within `n64 = n + offset`:
+    python tune.py --folder /tmp/synthetic_congress --cascade
+"""
+import argparse
+import json
+import random
+from collections import defaultdict
+from time import perf_counter
+
+import numpy as np
+
+from fingerprint_index import CascadeIndex, FingerprintIndex
+from shingling import fingerprint
+from utils import build_128_simhash, build_sim_hash, ngram_containment, simhash_to_int, split_simhash, text_cleaning
+from utils import unique_word_ngrams
+
+RADII = (2, 4, 6, 8, 10, 12, 16, 20, 24, 32)
+# kind:width of shingles, widths of `utils.build_sim_hash` (chars:4), `utils.build_128_simhash` (chars:6,
+# words:6 of `hash_ngrams`, words:1 of `hash_words`) and neighbours
+KINDS = ('chars:4', 'chars:6', 'chars:8', 'words:1', 'words:2', 'words:4', 'words:6')
+BITS = (64, 128)
+# thresholds of 128 bit fingerprints and offsets of `n64 = n + offset` of `--cascade`
+CASCADE_N = (4, 8, 12)
+CASCADE_OFFSETS = (0, 2, 4, 6, 8)
+
+
+def load_db_corpus(table='sections', limit=None, min_words=8):
+    """
+    :return: tuple (list of ids, list of texts) of rows with text
+    """
+    from sqlalchemy import text as text_to_query
+    from config import CONFIG
+    from utils import create_session
+    session = create_session(CONFIG['DB_connection'])
+    query = 'SELECT id, text FROM {} WHERE text IS NOT NULL ORDER BY id'.format(table)
+    if limit:
+        query += ' LIMIT {}'.format(int(limit))
+    rows = [row for row in session.execute(text_to_query(query)).all() if len(row[1].split()) >= min_words]
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def load_files_corpus(folder, min_words=8):
+    """
+    Sections of xml bills in the folder, parsed as ingestion does (ids are numbers of sections)
+    """
+    import main_tests
+    from utils import get_all_file_paths
+    texts = list()
+    for xml_path in get_all_file_paths(folder, ext='xml'):
+        parsed = main_tests.parse_sections_file(xml_path)
+        texts += [row['text'] for row in (parsed or dict()).get('rows', []) if row['text']]
+    texts = [text for text in texts if len(text.split()) >= min_words]
+    return list(range(len(texts))), texts
+
+
+class GroundTruth:
+    """
+    Exact containment scores of word n-grams with an inverted index
+    """
+    def __init__(self, texts, n=4):
+        self.ngrams = [set(unique_word_ngrams(text, n)) for text in texts]
+        self.postings = defaultdict(list)
+        for position, ngrams in enumerate(self.ngrams):
+            for ngram in ngrams:
+                self.postings[ngram].append(position)
+
+    def relevant(self, query, min_score=0.5):
+        """
+        :param query: position of the query text
+        :return: set of positions of other texts which contain at least `min_score` of n-grams of the query
+        """
+        counts = defaultdict(int)
+        for ngram in self.ngrams[query]:
+            for position in self.postings[ngram]:
+                counts[position] += 1
+        total = len(self.ngrams[query])
+        return {position for position, count in counts.items() if position != query and count >= min_score * total}
+
+
+def parse_kind(kind):
+    """
+    'chars:6' --> (False, 6), 'words:4' --> (True, 4)
+    """
+    name, width = kind.split(':')
+    if name not in ('chars', 'words'):
+        raise ValueError('kind should be chars:<width> or words:<width>, got {}'.format(kind))
+    return name == 'words', int(width)
+
+
+def build_index(texts, bits, width, words):
+    """
+    Fingerprints of all texts in FingerprintIndex, 64 bit fingerprints are the high halves (low ones are 0)
+    :return: tuple (index, list of bit strings as the queries of the index, seconds per text)
+    """
+    t0 = perf_counter()
+    fingerprints = [fingerprint(text_cleaning(text), bits=bits, n=width, words=words) for text in texts]
+    seconds = (perf_counter() - t0) / max(len(texts), 1)
+    fingerprints = [bits_ + '0' * (128 - len(bits_)) for bits_ in fingerprints]
+    return FingerprintIndex.from_bits(range(len(texts)), fingerprints), fingerprints, seconds
+
+
+def band_spread(fingerprints, bands=8):
+    """
+    Number of distinct values of every band of 128 bit fingerprints (see `utils.split_simhash`)
+    """
+    values = [split_simhash(bits, bands)[2] for bits in fingerprints]
+    return [len({row[i] for row in values}) for i in range(bands)]
+
+
+def sql_backend(fingerprints):
+    """
+    In-memory SqliteBackend with 128 bit fingerprints as `simhash_text` of sections (ids are positions)
+    """
+    from search_backend import SqliteBackend
+    backend = SqliteBackend()
+    backend.add('sections', [dict(id=position, simhash_text=bits) for position, bits in enumerate(fingerprints)])
+    return backend
+
+
+def evaluate(texts, kinds=KINDS, bits_options=BITS, radii=RADII, queries=200, min_score=0.5, seed=0, sql=False):
+    """
+    Sweep of fingerprint kinds and radii, see module docs
+    :param texts: corpus
+    :param kinds: 'chars:<width>' or 'words:<width>'
+    :param bits_options: 64 and (or) 128
+    :param radii: Hamming distance thresholds (exclusive)
+    :param queries: number of queries sampled from the corpus
+    :param min_score: containment of word 4-grams of relevant texts
+    :param sql: measure rows read by band indexes and time of queries of SqliteBackend (128 bit fingerprints only,
+        64 bit ones are padded with zeros, so their bands are not comparable)
+    :return: list of dicts, one per (kind, bits, radius)
+    """
+    truth = GroundTruth(texts)
+    sample = random.Random(seed).sample(range(len(texts)), min(queries, len(texts)))
+    relevant = {query: truth.relevant(query, min_score) for query in sample}
+    sample = [query for query in sample if relevant[query]]
+    print('{} texts, {} queries with relevant texts, {:.1f} relevant per query'.format(
+        len(texts), len(sample), np.mean([len(relevant[q]) for q in sample]) if sample else 0))
+    results = list()
+    for kind in kinds:
+        words, width = parse_kind(kind)
+        for bits in bits_options:
+            index, fingerprints, hash_seconds = build_index(texts, bits, width, words)
+            backend = sql_backend(fingerprints) if sql and bits == 128 else None
+            if bits == 128:
+                print('{}, {} bits: distinct values of bands {}'.format(kind, bits, band_spread(fingerprints)))
+            for radius in radii:
+                recalls, candidates, latencies = list(), list(), list()
+                for query in sample:
+                    t0 = perf_counter()
+                    found = [row_id for row_id, _ in index.search(fingerprints[query], radius) if row_id != query]
+                    for row_id in found:
+                        ngram_containment(truth.ngrams[query], truth.ngrams[row_id])
+                    latencies.append(perf_counter() - t0)
+                    recalls.append(len(relevant[query].intersection(found)) / len(relevant[query]))
+                    candidates.append(len(found))
+                results.append(dict(kind=kind, bits=bits, radius=radius,
+                                    recall=round(float(np.mean(recalls)), 4) if sample else None,
+                                    candidates=round(float(np.mean(candidates)), 2) if sample else None,
+                                    latency_ms=round(float(np.mean(latencies)) * 1000, 3) if sample else None,
+                                    p95_ms=round(float(np.percentile(latencies, 95)) * 1000, 3) if sample else None,
+                                    hash_ms=round(hash_seconds * 1000, 3), scanned=None, sql_ms=None))
+                if backend is not None and sample:
+                    results[-1].update(measure_sql(backend, [fingerprints[query] for query in sample], radius))
+            if backend is not None:
+                backend.close()
+    return results
+
+
+def measure_sql(backend, queries, radius):
+    """
+    Rows read and time of SqliteBackend queries of the radius
+    :return: dict with mean `scanned` rows and `sql_ms` per query
+    """
+    total = backend.count('sections')
+    scanned, latencies = list(), list()
+    for bits in queries:
+        scanned.append(backend.band_candidates('sections', bits) if radius <= backend.bands else total)
+        t0 = perf_counter()
+        backend.search('sections', bits, radius)
+        latencies.append(perf_counter() - t0)
+    return dict(scanned=round(float(np.mean(scanned)), 2), sql_ms=round(float(np.mean(latencies)) * 1000, 3))
+
+
+def cascade_recall(texts, ns=CASCADE_N, offsets=CASCADE_OFFSETS, queries=200, seed=0):
+    """
+    Recall of the cascade search against the full scan of 128 bit fingerprints.
+    Texts are hashed as ingestion does (`simhash_text64`, `simhash_text`), queries are sampled from the corpus.
+    :param texts: corpus
+    :param ns: thresholds of 128 bit fingerprints
+    :param offsets: `n64 - n` to measure
+    :param queries: number of sampled queries
+    :return: list of dicts, one per (n, offset): recall (mean over queries with other rows within n),
+        missed rows, candidates of the first stage (share of the corpus)
+    """
+    cleaned = [text_cleaning(text) for text in texts]
+    fp64 = [simhash_to_int(build_sim_hash(text)) for text in cleaned]
+    bits = [build_128_simhash(text) for text in cleaned]
+    full = FingerprintIndex.from_bits(range(len(texts)), bits)
+    index = CascadeIndex(full.ids, fp64, full.hi.view(np.int64), full.lo.view(np.int64))
+    sample = random.Random(seed).sample(range(len(texts)), min(queries, len(texts)))
+    results = list()
+    for n in ns:
+        truth = {query: {row_id for row_id, _ in full.search(bits[query], n) if row_id != query} for query in sample}
+        measured = [query for query in sample if truth[query]]
+        for offset in offsets:
+            recalls, candidates, missed = list(), list(), 0
+            for query in measured:
+                found = {row_id for row_id, _ in index.search(bits[query], n, fp64=fp64[query], n64=n + offset)}
+                recalls.append(len(truth[query] & found) / len(truth[query]))
+                missed += len(truth[query] - found)
+                candidates.append(len(index.candidates(fp64[query], n + offset)) / len(index))
+            results.append(dict(n=n, n64=n + offset, queries=len(measured),
+                                recall=round(float(np.mean(recalls)), 4) if measured else None, missed=missed,
+                                candidates=round(float(np.mean(candidates)), 4) if measured else None))
+    return results
+
+
+def print_cascade(results):
+    print('{:>4} {:>5} {:>8} {:>8} {:>7} {:>11}'.format('n', 'n64', 'queries', 'recall', 'missed', 'candidates'))
+    for row in results:
+        print('{n:>4} {n64:>5} {queries:>8} {recall:>8} {missed:>7} {candidates:>11}'.format(**row))
+
+
+def cheapest(results, target=0.95):
+    """
+    Setting with recall >= target and the fewest candidates (then the lowest time of the query, if measured,
+    and scoring), None if there is no such
+    """
+    passed = [row for row in results if row['recall'] is not None and row['recall'] >= target]
+    return min(passed, key=lambda row: (row['candidates'], (row.get('sql_ms') or 0) + row['latency_ms'])) \
+        if passed else None
+
+
+def print_results(results):
+    print('{:<10} {:>5} {:>7} {:>8} {:>11} {:>11} {:>9} {:>9} {:>9} {:>9}'.format(
+        'kind', 'bits', 'radius', 'recall', 'candidates', 'scoring,ms', 'p95,ms', 'hash,ms', 'scanned', 'sql,ms'))
+    for row in results:
+        print('{kind:<10} {bits:>5} {radius:>7} {recall:>8} {candidates:>11} {latency_ms:>11} {p95_ms:>9} '
+              '{hash_ms:>9} {scanned!s:>9} {sql_ms!s:>9}'.format(**row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recall, candidates and latency of simhash search settings')
+    parser.add_argument('--folder', help='parse sections of xml bills in the folder instead of loading them from DB')
+    parser.add_argument('--table', default='sections', help='table with text column')
+    parser.add_argument('--limit', type=int, help='load only this number of rows')
+    parser.add_argument('--queries', type=int, default=200, help='number of sampled queries')
+    parser.add_argument('--min-score', type=float, default=0.5, help='containment of word 4-grams of relevant texts')
+    parser.add_argument('--kinds', nargs='+', default=list(KINDS), help='chars:<width> or words:<width>')
+    parser.add_argument('--bits', type=int, nargs='+', choices=BITS, default=list(BITS))
+    parser.add_argument('--radii', type=int, nargs='+', default=list(RADII))
+    parser.add_argument('--target', type=float, default=0.95, help='recall to meet')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sql', action='store_true',
+                        help='measure rows read and time of queries of in-memory SqliteBackend (128 bits)')
+    parser.add_argument('--cascade', action='store_true',
+                        help='recall of 64 bit candidates of CascadeIndex against the full 128 bit scan')
+    parser.add_argument('--out', help='save results to json file')
+    args = parser.parse_args(argv)
+    if args.folder:
+        _, texts = load_files_corpus(args.folder)
+    else:
+        _, texts = load_db_corpus(args.table, args.limit)
+    if args.cascade:
+        results = cascade_recall(texts, queries=args.queries, seed=args.seed)
+        print_cascade(results)
+        if args.out:
+            with open(args.out, 'w') as out:
+                json.dump(dict(params=vars(args), results=results), out, indent=1)
+            print('Results saved to {}'.format(args.out))
+        return
+    results = evaluate(texts, kinds=args.kinds, bits_options=args.bits, radii=args.radii, queries=args.queries,
+                       min_score=args.min_score, seed=args.seed, sql=args.sql)
+    print_results(results)
+    best = cheapest(results, args.target)
+    if best:
+        print('cheapest setting with recall >= {}: {kind}, {bits} bits, radius {radius} '
+              '(recall {recall}, {candidates} candidates, scoring {latency_ms} ms, sql {sql_ms} ms)'.format(
+                  args.target, **best))
+    else:
+        print('no setting reaches recall {}'.format(args.target))
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(dict(params=vars(args), results=results), out, indent=1)
+        print('Results saved to {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,14 +14,18 @@ FNV1_128A_INIT = 0x6c62272e07bb014262b821756295c58d
 import os
 import re
 import string
+from functools import wraps
 from time import time
 from bs4.element import Tag
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
-from fnvhash import fnv1a_64, fnva
-from simhash import Simhash
+from fnvhash import fnva
 from lxml import etree
 
+import metrics
+import shingling
+
 
 # ==================== TEXT UTILS ====================
 def text_cleaning(text):
@@ -39,6 +43,32 @@ def text_cleaning(text):
     return text
 
 
+def word_ngrams(text, n=4):
+    """
+    Python version of the `word_ngrams` SQL function (see SQL approach in README):
+    splits lowercased text by non alphanumeric characters and joins every `n` consecutive words with space.
+    If text has not more than `n` words, the only ngram is the whole lowercased text.
+    word_ngrams('Lorem ipsum dolor sit amet', 3)
+    >>> ['lorem ipsum dolor', 'ipsum dolor sit', 'dolor sit amet']
+    :param text: input text
+    :param n: number of words in ngram
+    :return: list of ngrams
+    """
+    text = str(text or '').lower()
+    words = re.split(r'[\W_]+', text)
+    if len(words) <= n:
+        return [text]
+    return [' '.join(words[i:i + n]) for i in range(len(words) - n + 1)]
+
+
+def unique_word_ngrams(text, n=4):
+    """
+    Sorted unique word ngrams, the same as `array_unique(word_ngrams(text, n))` in SQL.
+    Used to fill `text_query_index_col` columns during ingestion.
+    """
+    return sorted(set(word_ngrams(text, n)))
+
+
 def create_title(text, max_len=250, ending='...'):
     """
         Cleaning text in title
@@ -160,6 +190,72 @@ def _create_db_connection_uri(user, pwd, db_name, host, connector):
     return db_uri
 
 
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool which keeps track of how long callers waited for a connection.
+    Used to expose pool metrics (see `pool_metrics`) for tuning pool size under load.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        t0 = time()
+        conn = super()._do_get()
+        waited = time() - t0
+        self.checkouts += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.checkouts, pool.wait_time, pool.max_wait_time = self.checkouts, self.wait_time, self.max_wait_time
+        return pool
+
+
+# process-wide engines and session factories, keyed by connection uri
+_ENGINES = dict()
+_SESSION_FACTORIES = dict()
+
+# defaults for the optional `pool` section of the DB config
+POOL_DEFAULTS = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_timeout': 30,         # seconds to wait for a free connection
+    'pool_recycle': 1800,       # seconds before a connection is replaced
+    'pool_pre_ping': True,      # test connections on checkout, drop stale ones
+    'statement_timeout': 0,     # milliseconds, 0 - no timeout
+    'query_cache_size': 500,    # compiled statements cache of SQLAlchemy
+    'prepare_threshold': None,  # `postgresql+psycopg` (psycopg 3) only: server-side prepare after N executions
+}
+
+
+def _get_pool_config(config):
+    pool_config = dict(POOL_DEFAULTS)
+    pool_config.update(config.get('pool') or dict())
+    return pool_config
+
+
+def _create_connect_args(connector, pool_config):
+    """
+    Driver specific arguments for every new connection.
+    Statement timeout is set once per connection, not per query.
+    """
+    connect_args = dict()
+    statement_timeout = int(pool_config['statement_timeout'] or 0)
+    if 'postgresql' in connector:
+        if statement_timeout:
+            connect_args['options'] = '-c statement_timeout={}'.format(statement_timeout)
+        if connector.split('+')[-1] == 'psycopg' and pool_config['prepare_threshold'] is not None:
+            # only psycopg 3 accepts it, psycopg2 (default driver of `postgresql`), pg8000 and asyncpg
+            # refuse unknown connection options
+            connect_args['prepare_threshold'] = pool_config['prepare_threshold']
+    return connect_args
+
+
 def create_session(config):
     """
 
@@ -169,13 +265,25 @@ def create_session(config):
     :return: db_session
     """
     engine = get_engine(config)
-    if engine:
-        return sessionmaker(bind=engine, autoflush=False)()
-    else:
+    if not engine:
         sys.exit()
+    factory = _SESSION_FACTORIES.get(engine.url)
+    if factory is None:
+        factory = sessionmaker(bind=engine, autoflush=False)
+        _SESSION_FACTORIES[engine.url] = factory
+    return factory()
 
 
 def get_engine(config):
+    """
+    Returns engine for the db from config.
+    Engine (and its connection pool) is created once per process and then reused,
+    so calling `create_session` many times doesn't open new connections every time.
+    Pool settings are read from optional `pool` section of the config, see POOL_DEFAULTS.
+
+    :param config: configuration for db
+    :return: sqlalchemy engine or None if config is wrong
+    """
     try:
         user = config['user']
         passw = config['password']
@@ -187,7 +295,60 @@ def get_engine(config):
         return None
     db_uri = _create_db_connection_uri(user=user, pwd=passw, db_name=db_name,
                                        host=host, connector=connector)
-    return create_engine(db_uri)
+    engine = _ENGINES.get(db_uri)
+    if engine is not None:
+        return engine
+    pool_config = _get_pool_config(config)
+    engine = create_engine(db_uri,
+                           poolclass=TimedQueuePool,
+                           pool_size=pool_config['pool_size'],
+                           max_overflow=pool_config['max_overflow'],
+                           pool_timeout=pool_config['pool_timeout'],
+                           pool_recycle=pool_config['pool_recycle'],
+                           pool_pre_ping=pool_config['pool_pre_ping'],
+                           query_cache_size=pool_config['query_cache_size'],
+                           connect_args=_create_connect_args(connector, pool_config))
+    statement_timeout = int(pool_config['statement_timeout'] or 0)
+    if statement_timeout and 'mysql' in connector:
+        @event.listens_for(engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SET SESSION max_execution_time={}'.format(statement_timeout))
+            cursor.close()
+    _ENGINES[db_uri] = engine
+    return engine
+
+
+def pool_metrics():
+    """
+    Metrics of all engines created in this process, to tune pool settings under load.
+    :return: list of dicts, one per engine
+    """
+    rows = list()
+    for engine in _ENGINES.values():
+        pool = engine.pool
+        checkouts = getattr(pool, 'checkouts', 0)
+        wait_time = getattr(pool, 'wait_time', 0.0)
+        rows.append({'url': engine.url.render_as_string(hide_password=True),
+                     'pool_size': pool.size(),
+                     'checked_out': pool.checkedout(),
+                     'checked_in': pool.checkedin(),
+                     'overflow': pool.overflow(),
+                     'checkouts': checkouts,
+                     'wait_time_total': round(wait_time, 6),
+                     'wait_time_avg': round(wait_time / checkouts, 6) if checkouts else 0.0,
+                     'wait_time_max': round(getattr(pool, 'max_wait_time', 0.0), 6)})
+    return rows
+
+
+def dispose_engines():
+    """
+    Close all pooled connections, e.g. after fork in worker processes
+    """
+    for engine in _ENGINES.values():
+        engine.dispose()
+    _ENGINES.clear()
+    _SESSION_FACTORIES.clear()
 
 
 # ==================== SIM HASH UTILS ====================
@@ -241,29 +402,122 @@ def build_sim_hash(data, n=4):
     """
     Builds a hash - a 64 bit string of the input data using SimHash algorithm
     hashfunc - fnv-1a hashing for 64 bit
+    Shingles are the same as of `_get_ngrams`, but they are hashed as arrays without creating strings,
+    see `shingling.py`
     :param data: imput data to hash
     :param n: parameter for ngram
     :return: bit string 64 characters long
     """
-    features = _get_ngrams(text=data, width=n)
-    sim_obj = Simhash(features, hashfunc=fnv1a_64)
-    return '{0:64b}'.format(sim_obj.value).replace(' ', '0')
+    return shingling.fingerprint(data, bits=64, n=n)
 
 
 def build_128_simhash(data, n=6, words=False):
     """
     Builds a hash - a 128 bit string of the input data using SimHash algorithm
     hashfunc - fnv-1a hashing for 128 bit
+    Shingles are the same as of `_get_ngrams` (or `_get_features` if `words`), see `shingling.py`
     :param data: input data to hash
     :param n: parameter for ngram
+    :param words: shingles of `n` words instead of characters
     :return: bit string 128 characters long
     """
-    if words:
-        features = _get_features(data, width=n)
-    else:
-        features = _get_ngrams(data, width=n)
-    sim_obj = Simhash(features, f=128, hashfunc=fnv1a_128)
-    return '{0:128b}'.format(sim_obj.value).replace(' ', '0')
+    return shingling.fingerprint(data, bits=128, n=n, words=words)
+
+
+def _to_signed(value, bits=64):
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+
+def simhash_to_int(bits):
+    """
+    Bit string of 64 bit simhash (see `build_sim_hash`) to signed integer, as it's stored in BigInteger
+    columns `simhash_text64`
+    """
+    return _to_signed(int(bits, 2)) if bits else None
+
+
+def ngram_containment(query_ngrams, ngrams):
+    """
+    Share of word n-grams of the query which are found in the other text: |Q & T| / |Q|.
+    Exact score of texts found by fingerprints, e.g. `test_search.search_cascade`
+    :param query_ngrams: set of word n-grams of the query, see `unique_word_ngrams`
+    :param ngrams: set (or list) of word n-grams of the other text
+    :return: float from 0 to 1
+    """
+    if not query_ngrams:
+        return 0.0
+    return len(query_ngrams.intersection(ngrams)) / len(query_ngrams)
+
+
+def band_bits(bits, bands=8):
+    """
+    Bit strings of the bands of 128 bit simhash: bits are interleaved, bit j goes to band j % bands.
+    Contiguous slices would not do: some ranges of bits of FNV-1a-128 simhash of short shingles hardly change,
+    so such a band is nearly the same for all rows and its index matches every row.
+    Pigeonhole principle holds for any partition of bits.
+    """
+    return [bits[i::bands] for i in range(bands)]
+
+
+def split_simhash(bits, bands=8):
+    """
+    Split bit string of 128 bit simhash to integers that can be stored in B-tree indexed columns:
+    two 64 bit halves and `bands` bands of equal width (interleaved bits, see `band_bits`).
+    Values are the same as postgres gives casting bit strings to integer types (see `main_tests._band_columns_sql`):
+    bit(64)::bigint is signed, narrower bands are non-negative.
+    :param bits: bit string 128 characters long
+    :param bands: number of bands, 128 should be divisible by it
+    :return: tuple (hi, lo, list of band values)
+    """
+    if len(bits) != 128:
+        raise ValueError('128 bit fingerprint expected, got {} bits'.format(len(bits)))
+    hi = _to_signed(int(bits[:64], 2))
+    lo = _to_signed(int(bits[64:], 2))
+    band_values = [int(band, 2) for band in band_bits(bits, bands)]
+    if 128 // bands == 64:
+        band_values = [_to_signed(v) for v in band_values]
+    return hi, lo, band_values
+
+
+def fingerprint_columns(name, bits, bands=8):
+    """
+    Values of additional columns of the fingerprint `name`, see `bill.add_band_columns`
+    :param name: name of bit(128) column, e.g. 'simhash_text'
+    :param bits: bit string of the hash or None
+    :param bands: number of bands
+    :return: dict column name -> value
+    """
+    if not bits:
+        columns = {'{}_hi'.format(name): None, '{}_lo'.format(name): None}
+        columns.update({'{}_b{}'.format(name, i): None for i in range(bands)})
+        return columns
+    hi, lo, band_values = split_simhash(bits, bands)
+    columns = {'{}_hi'.format(name): hi, '{}_lo'.format(name): lo}
+    columns.update({'{}_b{}'.format(name, i): v for i, v in enumerate(band_values)})
+    return columns
+
+
+def hamming_condition(column, bits, n, bands=8, use_bands=True, alias=''):
+    """
+    SQL condition to find rows which fingerprint `column` has Hamming distance lower than `n` to `bits`.
+    If n <= bands, by pigeonhole principle at least one band of similar fingerprints is equal,
+    so candidates are selected by equality of indexed band columns (index scan instead of full scan)
+    and only they are checked with exact bit_count.
+    :param column: name of bit(128) column
+    :param bits: bit string of the hash to find
+    :param n: Hamming distance threshold
+    :param bands: number of band columns
+    :param use_bands: set False for tables without band columns
+    :param alias: table alias to prefix columns with
+    :return: string with sql condition
+    """
+    prefix = '{}.'.format(alias) if alias else ''
+    exact = "bit_count({}{} # b'{}') < {}".format(prefix, column, bits, int(n))
+    if not use_bands or n > bands:
+        return exact
+    _, _, band_values = split_simhash(bits, bands)
+    candidates = ' OR '.join('{}{}_b{} = {}'.format(prefix, column, i, v) for i, v in enumerate(band_values))
+    return '({}) AND {}'.format(candidates, exact)
 
 
 # ==================== READING FILES UTILS ====================
@@ -338,10 +592,15 @@ def get_xml_sections(xml_path):
 def timer_wrapper(func):
     """
     simple decorator to track time of running func
+    if metrics are enabled time is recorded as a span with function name instead of printing
     :param func:
     :return:
     """
+    @wraps(func)
     def inner_wrapper(*args, **kwargs):
+        if metrics.is_enabled():
+            with metrics.span(func.__name__):
+                return func(*args, **kwargs)
         t0 = time()
         res = func(*args, **kwargs)
         print('{} TOTAL TIME:\t {} sec\n'.format(func.__name__, round(time() - t0, 3)))
@@ -1,38 +1,60 @@
 # python
+import hashlib
 import json
 import os
 import pickle
 import subprocess
 import random
+from concurrent.futures import ThreadPoolExecutor
 from time import time
+from itertools import islice
 from os import path, listdir
 from os.path import isfile, join
+import numpy as np
 from lxml import etree
 from nltk.tokenize import RegexpTokenizer
+from scipy.sparse import csr_matrix, vstack
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from sqlalchemy.orm import undefer
 from config import CONFIG
-from bill import Bill
+from bill import Bill, Section
+from vocabulary import NgramVocabulary
 
 from utils import text_cleaning
 from utils import get_all_file_paths
 from utils import create_session
 from utils import timer_wrapper
+from metrics import span, increment
 
 
 # Among the larger bills is samples/congress/116/BILLS-116s1790enr.xml (~ 10MB)
-PATH_116_USLM = '/Users/dmytroustynov/programm/BillMap/xc-nlp-test/samples/congress/116/uslm'
-PATH_117_USLM = '/Users/dmytroustynov/programm/BillMap/xc-nlp-test/samples/congress/116/uslm'
-PATH_116_USLM_TRAIN = '/Users/dmytroustynov/programm/BillMap/xc-nlp-test/samples/congress/116/train'
-PATH_116_TEXT = '/Users/dmytroustynov/programm/BillMap/xc-nlp-test/samples/congress/116/txt'
+# specify your samples folder in config.yaml, synthetic.py can generate fake samples
+SAMPLES_FOLDER = CONFIG.get('SAMPLES_FOLDER', 'samples')
+PATH_116_USLM = path.join(SAMPLES_FOLDER, 'congress/116/uslm')
+PATH_117_USLM = path.join(SAMPLES_FOLDER, 'congress/116/uslm')
+PATH_116_USLM_TRAIN = path.join(SAMPLES_FOLDER, 'congress/116/train')
+PATH_116_TEXT = path.join(SAMPLES_FOLDER, 'congress/116/txt')
+
+# persistent vocabularies of word 4-grams, see `update_vocabularies`
+VOCABULARY_FOLDER = CONFIG.get('VOCABULARY_FOLDER', 'vocabulary')
+# vectorized bills of DB, see `build_corpus_matrices`
+MATRICES_FOLDER = CONFIG.get('MATRICES_FOLDER', 'matrices')
 
 BILLS_SAMPLE = [f'BILLS-116hr{number}ih.xml' for number in range(100, 300)]
 BIG_BILLS = ['BILLS-116s1790enr.xml', 'BILLS-116hjres31enr.xml']
 BIG_BILLS_PATHS = [path.join(PATH_116_USLM, bill) for bill in (BIG_BILLS + BILLS_SAMPLE)]
 
-SAMPLE_BILL_PATHS_TRAIN = [join(PATH_116_USLM_TRAIN, f) for f in listdir(PATH_116_USLM) if
-                           isfile(join(PATH_116_USLM_TRAIN, f))]
-SAMPLE_BILL_PATHS = [join(PATH_117_USLM, f) for f in listdir(PATH_117_USLM) if isfile(join(PATH_117_USLM, f))]
+
+def _list_files(folder):
+    if not path.isdir(folder):
+        return []
+    return [join(folder, f) for f in listdir(folder) if isfile(join(folder, f))]
+
+
+SAMPLE_BILL_PATHS_TRAIN = _list_files(PATH_116_USLM_TRAIN)
+SAMPLE_BILL_PATHS = _list_files(PATH_117_USLM)
 
 NAMESPACES = {'uslm': 'https://xml.house.gov/schemas/uslm/1.0'}
 
@@ -51,28 +73,65 @@ def get_header(section) -> str:
     return ''
 
 
+# fields of `sec_to_dict`, computed only when asked in `iter_sections`
+SECTION_FIELDS = {
+    'section_text': lambda section: etree.tostring(section, method="text", encoding="unicode"),
+    'section_xml': lambda section: etree.tostring(section, method="xml", encoding="unicode"),
+    'section_number': lambda section: get_enum(section) if section.xpath('header') and section.xpath('enum') else '',
+    'section_header': lambda section: get_header(section) if section.xpath('header') and section.xpath('enum') else '',
+}
+
+
 def sec_to_dict(section):
-    data = {'section_text': etree.tostring(section, method="text", encoding="unicode"),
-            'section_xml': etree.tostring(section, method="xml", encoding="unicode"),
-            'section_number': '',
-            'section_header': ''}
-    if (section.xpath('header') and len(section.xpath('header')) > 0
-            and section.xpath('enum') and len(section.xpath('enum')) > 0):
-        data['section_number'] = get_enum(section)
-        data['section_header'] = get_header(section)
-    return data
+    return {field: getter(section) for field, getter in SECTION_FIELDS.items()}
+
+
+def iter_sections(xml_path: str, fields=('section_text',)):
+    """
+    Parses the xml file incrementally and yields sections one by one, in the same order as `xml_to_sections`.
+    Only the requested fields are computed, parsed elements are freed after the section is yielded,
+    so memory doesn't grow with the size of the bill.
+    :param xml_path: path to bill in uslm xml format
+    :param fields: keys of SECTION_FIELDS
+    :return: generator of dicts with requested fields
+    """
+    getters = [(field, SECTION_FIELDS[field]) for field in fields]
+    tag = '{{{}}}section'.format(NAMESPACES['uslm'])
+
+    def process(element):
+        for section in element.iter(tag):
+            yield {field: getter(section) for field, getter in getters}
+        element.clear(keep_tail=True)
+        # drop already processed siblings from the tree
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    depth = 0
+    # top level section is processed when the next one starts, then its tail text is surely parsed
+    pending = None
+    for event, element in etree.iterparse(xml_path, events=('start', 'end'), tag=tag, huge_tree=True):
+        if event == 'start':
+            if not depth and pending is not None:
+                yield from process(pending)
+                pending = None
+            depth += 1
+            continue
+        depth -= 1
+        if not depth:
+            # nested sections are yielded with the outer one
+            pending = element
+    if pending is not None:
+        yield from process(pending)
 
 
 def xml_to_sections(xml_path: str):
     """
     Parses the xml file into sections
     """
-    bill_tree = etree.parse(xml_path)
-    sections = bill_tree.xpath('//uslm:section', namespaces=NAMESPACES)
+    sections = list(iter_sections(xml_path, fields=tuple(SECTION_FIELDS)))
     if len(sections) == 0:
         print('No sections found in ', xml_path)
-        return []
-    return [sec_to_dict(section) for section in sections]
+    return sections
 
 
 def xml_to_text(xml_path: str, level: str = 'section', separator: str = '\n*****\n') -> str:
@@ -89,24 +148,19 @@ def xml_to_text(xml_path: str, level: str = 'section', separator: str = '\n*****
 
 # Get document and section text from xml file for testing purpose
 def get_document_and_section_from_xml_file(file_path):
-    t_secs = xml_to_sections(file_path)
-    if not t_secs:
+    # text cleaning applied on each section text, for now sentence id is sentence number in document
+    t_section_data = [text_cleaning(section['section_text']) for section in iter_sections(file_path)]
+    if not t_section_data:
         return '', []
-    t_section_data = []
-    t_doc_content = ""
-    # iterate over all parse sections text of bill doc file
-    for section in t_secs:
-        # text cleaning applied on each section text
-        sec_text = text_cleaning(section['section_text'])
-        # concatenate section text to doc content
-        t_doc_content = t_doc_content + sec_text + " "
-        # for now sentence id is sentence number in document
-        t_section_data.append(sec_text)
+    # doc content is all section texts, each followed by a space
+    t_doc_content = ' '.join(t_section_data) + ' '
     return t_doc_content, t_section_data
 
 
 def vectorized_transformation(section_doc, sec_count_vectorizer):
-    section_doc_vectorized = sec_count_vectorizer.transform(section_doc)
+    with span('vectorize.transform', docs=len(section_doc)):
+        section_doc_vectorized = sec_count_vectorizer.transform(section_doc)
+    increment('vectorize.docs', len(section_doc))
     return section_doc_vectorized
 
 
@@ -145,32 +199,23 @@ def main_test():
     path_a = os.path.join(fld, BIG_BILLS[0])
     path_b = os.path.join(fld, BIG_BILLS[1])
 
-    only_doc_data = []
-    only_section_data = []
-    root_folder = '/Users/dmytroustynov/programm/BillMap/xc-nlp-test/samples/congress'
+    # vocabularies of samples are stored, only files not added before are parsed
+    doc_count_vectorizer = NgramVocabulary(path.join(VOCABULARY_FOLDER, 'samples_docs'))
+    sec_count_vectorizer = NgramVocabulary(path.join(VOCABULARY_FOLDER, 'samples_sections'))
+    root_folder = path.join(SAMPLES_FOLDER, 'congress')
     xml_files = get_all_file_paths(root_folder, ext='xml')
-    print('FOUND {} files'.format(len(xml_files)))
-    for path in xml_files:
-        sections = xml_to_sections(path)
-        doc_content = ""
-        for section in sections:
-            sec_text = text_cleaning(section['section_text'])
-            doc_content = doc_content + sec_text + " "
-            only_section_data.append(sec_text)
-        only_doc_data.append(doc_content)
-
-    doc_count_vectorizer = CountVectorizer(ngram_range=(4, 4),
-                                           tokenizer=RegexpTokenizer(r"\w+").tokenize,
-                                           lowercase=True)
-
-    doc_count_vectorizer.fit_transform(only_doc_data)
-    print('fit 1 OK')
-
-    sec_count_vectorizer = CountVectorizer(ngram_range=(4, 4),
-                                           tokenizer=RegexpTokenizer(r"\w+").tokenize,
-                                           lowercase=True)
-    sec_count_vectorizer.fit_transform(only_section_data)
-    print('fit 2 OK')
+    new_files = [f for f in xml_files if f not in doc_count_vectorizer.documents]
+    print('FOUND {} files, {} new'.format(len(xml_files), len(new_files)))
+    with span('vectorize.fit', corpus='samples'):
+        for xml_path in new_files:
+            doc_content, section_data = get_document_and_section_from_xml_file(xml_path)
+            doc_count_vectorizer.add_documents([doc_content], keys=[xml_path])
+            sec_count_vectorizer.add_documents(section_data)
+    if new_files:
+        doc_count_vectorizer.save()
+        sec_count_vectorizer.save()
+    print('vocabularies: {} doc n-grams, {} section n-grams'.format(len(doc_count_vectorizer),
+                                                                    len(sec_count_vectorizer)))
 
     A_doc, A_section_doc = get_document_and_section_from_xml_file(path_a)
     B_doc, B_section_doc = get_document_and_section_from_xml_file(path_b)
@@ -186,8 +231,9 @@ def main_test():
     print('Vector A_section_doc_vectorized: ', A_section_doc_vectorized.shape)
     print('Vector B_section_doc_vectorized: ', B_section_doc_vectorized.shape)
 
-    doc_sim_score = cosine_similarity(A_doc_vectorized, B_doc_vectorized)
-    sec_doc_sim_score = cosine_similarity(A_section_doc_vectorized, B_section_doc_vectorized)
+    with span('vectorize.similarity'):
+        doc_sim_score = cosine_similarity(A_doc_vectorized, B_doc_vectorized)
+        sec_doc_sim_score = cosine_similarity(A_section_doc_vectorized, B_section_doc_vectorized)
     print('DOC SIM:')
     print(doc_sim_score)
     print('SECTION SIM:', sec_doc_sim_score.shape)
@@ -199,6 +245,369 @@ def main_test():
     print(response)
 
 
+def load_models(model_filename='CV_model.pkl', sections_model_filename='CV_sections_model.pkl',
+                vocabulary_folder=VOCABULARY_FOLDER):
+    """
+    Load vocabularies created by `update_vocabularies` if they exist,
+    otherwise deserialize count-vectorizer models created by `create_models`
+    :return: tuple (doc model, sections model)
+    """
+    if vocabulary_folder and path.isfile(path.join(vocabulary_folder, 'docs', 'meta.json')):
+        return (NgramVocabulary(path.join(vocabulary_folder, 'docs')),
+                NgramVocabulary(path.join(vocabulary_folder, 'sections')))
+    with open(model_filename, 'rb') as pkl:
+        doc_count_vectorizer = pickle.load(pkl)
+    with open(sections_model_filename, 'rb') as pkl:
+        sec_count_vectorizer = pickle.load(pkl)
+    return doc_count_vectorizer, sec_count_vectorizer
+
+
+def compare_files(path_a, path_b, doc_count_vectorizer, sec_count_vectorizer):
+    """
+    Compare two bills in xml files: similarity of whole documents and of every pair of their sections
+    :param path_a: xml file of the original bill
+    :param path_b: xml file of the matched bill
+    :param doc_count_vectorizer: DOC model, see `load_models`
+    :param sec_count_vectorizer: SECTIONS model
+    :return: json string, see `create_json_response`
+    """
+    A_doc, A_section_doc = get_document_and_section_from_xml_file(path_a)
+    B_doc, B_section_doc = get_document_and_section_from_xml_file(path_b)
+    if not A_section_doc or not B_section_doc:
+        print('ERROR, no sections found in {}'.format(path_b if A_section_doc else path_a))
+        return None
+    if not doc_count_vectorizer.vocabulary_ or not sec_count_vectorizer.vocabulary_:
+        print('ERROR, models are empty, run `python cli.py build-models` after loading bills')
+        return None
+    A_doc_vectorized = vectorized_transformation([A_doc], doc_count_vectorizer)
+    B_doc_vectorized = vectorized_transformation([B_doc], doc_count_vectorizer)
+    A_section_doc_vectorized = vectorized_transformation(A_section_doc, sec_count_vectorizer)
+    B_section_doc_vectorized = vectorized_transformation(B_section_doc, sec_count_vectorizer)
+    with span('vectorize.similarity'):
+        doc_sim_score = cosine_similarity(A_doc_vectorized, B_doc_vectorized)
+        sec_doc_sim_score = cosine_similarity(A_section_doc_vectorized, B_section_doc_vectorized)
+    return create_json_response(path.basename(path_a), path.basename(path_b), doc_sim_score, sec_doc_sim_score)
+
+
+def vocabulary_digest(model, size=None):
+    """
+    Digest of n-grams of the first `size` columns of the model (all columns by default).
+    `NgramVocabulary` is only appended to, so the digest of its first columns doesn't change;
+    refitted CountVectorizer orders columns differently and gets another digest.
+    """
+    if isinstance(model, NgramVocabulary):
+        ngrams = model.get_feature_names()
+    else:
+        ngrams = sorted(model.vocabulary_, key=model.vocabulary_.get)
+    digest = hashlib.sha1()
+    for ngram in ngrams[:size]:
+        digest.update(ngram.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+class CandidateMatrices:
+    """
+    Vectorized candidate bills for `compare_many`: L2-normalized count vectors (CSR) of whole documents
+    and of all sections of all documents stacked in one matrix,
+    so cosine similarity of a query with every candidate is a single sparse product.
+    Sections of the document i are rows section_indptr[i]:section_indptr[i + 1] of `sections`.
+    Saved as .npy files of CSR components, loaded memory-mapped (see `save`, `load`, `build_corpus_matrices`).
+    """
+    # arrays stored in .npy files of the folder
+    ARRAYS = ('docs_data', 'docs_indices', 'docs_indptr', 'sections_data', 'sections_indices', 'sections_indptr',
+              'section_indptr', 'keys', 'origins', 'section_ids', 'section_sources')
+
+    def __init__(self, keys, docs, sections, section_indptr, origins=None, section_ids=None, section_sources=None,
+                 vocabularies=None):
+        """
+        :param keys: names of documents (file names, bill ids...), one per row of `docs`
+        :param docs: CSR matrix documents x DOC model vocabulary, rows normalized
+        :param sections: CSR matrix sections x SECTIONS model vocabulary, rows normalized
+        :param section_indptr: array of len(keys) + 1 offsets of document sections in `sections`
+        :param origins: (optional) origin of every document
+        :param section_ids: (optional) id of every section row
+        :param section_sources: (optional) table of every section row, index in SECTION_SOURCES
+        :param vocabularies: (optional) dict with `vocabulary_digest` of DOC ('docs') and SECTIONS ('sections') models
+            the matrices are vectorized with
+        """
+        self.keys = keys if isinstance(keys, np.ndarray) else list(keys)
+        self.docs = docs
+        self.sections = sections
+        self.section_indptr = np.asarray(section_indptr, dtype=np.int64)
+        self.origins = origins
+        self.section_ids = section_ids
+        self.section_sources = section_sources
+        self.vocabularies = vocabularies
+        self._checked_models = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def check_models(self, doc_count_vectorizer, sec_count_vectorizer):
+        """
+        Columns of matrices should be the first columns of the models (models may only have grown since)
+        :raises ValueError: matrices are vectorized with other models, e.g. refitted by `create_models`
+        """
+        models = (doc_count_vectorizer, sec_count_vectorizer)
+        if self._checked_models == tuple(id(model) for model in models):
+            return
+        if len(doc_count_vectorizer.vocabulary_) < self.docs.shape[1] or \
+                len(sec_count_vectorizer.vocabulary_) < self.sections.shape[1]:
+            raise ValueError('candidates are vectorized with larger models, rebuild them')
+        if self.vocabularies:
+            for name, model, width in (('docs', doc_count_vectorizer, self.docs.shape[1]),
+                                       ('sections', sec_count_vectorizer, self.sections.shape[1])):
+                if vocabulary_digest(model, width) != self.vocabularies.get(name):
+                    raise ValueError('candidates are vectorized with another {} vocabulary, rebuild them with '
+                                     '`cli.py build-models --matrices`'.format(name))
+        self._checked_models = tuple(id(model) for model in models)
+
+    @classmethod
+    def from_texts(cls, keys, docs, sections, doc_count_vectorizer, sec_count_vectorizer):
+        """
+        :param keys: names of documents
+        :param docs: cleaned text of every document
+        :param sections: list of cleaned section texts of every document
+        """
+        section_indptr = np.cumsum([0] + [len(doc_sections) for doc_sections in sections])
+        all_sections = [text for doc_sections in sections for text in doc_sections]
+        return cls(keys,
+                   normalize(vectorized_transformation(docs, doc_count_vectorizer)),
+                   normalize(vectorized_transformation(all_sections, sec_count_vectorizer)),
+                   section_indptr)
+
+    @classmethod
+    def from_files(cls, paths, doc_count_vectorizer, sec_count_vectorizer):
+        """
+        Candidates from xml files, named by file names
+        """
+        parsed = [get_document_and_section_from_xml_file(file_path) for file_path in paths]
+        return cls.from_texts([path.basename(file_path) for file_path in paths],
+                              [doc for doc, _ in parsed], [sections for _, sections in parsed],
+                              doc_count_vectorizer, sec_count_vectorizer)
+
+    def document_sections(self, i):
+        return self.sections[self.section_indptr[i]:self.section_indptr[i + 1]]
+
+    def save(self, folder):
+        """
+        Write CSR components and id maps to .npy files of the folder, shapes to meta.json
+        """
+        os.makedirs(folder, exist_ok=True)
+        arrays = dict(docs_data=self.docs.data, docs_indices=self.docs.indices, docs_indptr=self.docs.indptr,
+                      sections_data=self.sections.data, sections_indices=self.sections.indices,
+                      sections_indptr=self.sections.indptr, section_indptr=self.section_indptr,
+                      keys=np.asarray(self.keys), origins=self.origins, section_ids=self.section_ids,
+                      section_sources=self.section_sources)
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(path.join(folder, name + '.npy'), np.asarray(array))
+        with open(path.join(folder, 'meta.json'), 'w') as meta:
+            json.dump(dict(docs_shape=self.docs.shape, sections_shape=self.sections.shape,
+                           section_sources=SECTION_SOURCES, vocabularies=self.vocabularies), meta)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Load matrices saved by `save`, with mmap arrays are paged in by OS when the product touches them
+        """
+        with open(path.join(folder, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        arrays = {name: np.load(path.join(folder, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in cls.ARRAYS if isfile(path.join(folder, name + '.npy'))}
+        # csr_matrix keeps given arrays (no copy) when their dtypes are right
+        docs = csr_matrix((arrays['docs_data'], arrays['docs_indices'], arrays['docs_indptr']),
+                          shape=tuple(meta['docs_shape']), copy=False)
+        sections = csr_matrix((arrays['sections_data'], arrays['sections_indices'], arrays['sections_indptr']),
+                              shape=tuple(meta['sections_shape']), copy=False)
+        return cls(arrays['keys'], docs, sections, arrays['section_indptr'], origins=arrays.get('origins'),
+                   section_ids=arrays.get('section_ids'), section_sources=arrays.get('section_sources'),
+                   vocabularies=meta.get('vocabularies'))
+
+
+def compare_many(path_a, candidates, doc_count_vectorizer, sec_count_vectorizer, top_k=10, block_size=4096,
+                 workers=4):
+    """
+    Compare the bill with all candidates at once: the bill is vectorized once,
+    document similarities are sparse products of blocks of candidate rows with the bill vector,
+    computed in a thread pool (scipy sparse products release the GIL).
+    Section similarities are computed only for the top documents.
+    :param path_a: xml file of the original bill
+    :param candidates: CandidateMatrices, vectorized with the same models
+    :param doc_count_vectorizer: DOC model, see `load_models`
+    :param sec_count_vectorizer: SECTIONS model
+    :param top_k: number of best matching documents
+    :param block_size: number of candidate rows in one product
+    :param workers: number of threads
+    :return: list of dicts sorted by score: key, origin, score (document cosine similarity),
+             section_scores (dense array sections of A x sections of the candidate, as in `compare_files`)
+    """
+    A_doc, A_section_doc = get_document_and_section_from_xml_file(path_a)
+    if not A_section_doc:
+        print('ERROR, no sections found in {}'.format(path_a))
+        return []
+    candidates.check_models(doc_count_vectorizer, sec_count_vectorizer)
+    A_doc_vectorized = normalize(vectorized_transformation([A_doc], doc_count_vectorizer))
+    A_section_doc_vectorized = normalize(vectorized_transformation(A_section_doc, sec_count_vectorizer))
+    # n-grams added to vocabularies after candidates were built are the last columns, no candidate has them
+    A_doc_column = A_doc_vectorized[:, :candidates.docs.shape[1]].T.tocsc()
+    A_section_columns = A_section_doc_vectorized[:, :candidates.sections.shape[1]].T.tocsc()
+
+    def score_block(start):
+        return (candidates.docs[start:start + block_size] @ A_doc_column).toarray().ravel()
+
+    def score_sections(i):
+        return (candidates.document_sections(i) @ A_section_columns).T.toarray()
+
+    with span('vectorize.similarity', docs=len(candidates)), ThreadPoolExecutor(max_workers=workers) as executor:
+        blocks = list(executor.map(score_block, range(0, len(candidates), block_size)))
+        scores = np.concatenate(blocks) if blocks else np.zeros(0)
+        top = np.flatnonzero(scores > 0)
+        if len(top) > top_k:
+            top = top[np.argpartition(-scores[top], top_k - 1)[:top_k]]
+        top = top[np.lexsort((top, -scores[top]))].tolist()
+        section_scores = list(executor.map(score_sections, top))
+    increment('vectorize.compared', len(candidates))
+    keys = np.asarray(candidates.keys)[top].tolist()
+    origins = candidates.origins[top].tolist() if candidates.origins is not None else [None] * len(top)
+    return [dict(key=keys[rank], origin=origins[rank], score=float(scores[i]), section_scores=section_scores[rank])
+            for rank, i in enumerate(top)]
+
+
+# tables of section rows in CandidateMatrices.section_sources
+SECTION_SOURCES = ['bills', 'sections']
+
+
+def _vectorize_rows(session, query, model, batch_size):
+    """
+    Normalized vectors of texts of query rows (key, id, text), transformed by batches
+    :return: (keys, ids, matrix)
+    """
+    keys, ids, blocks = list(), list(), list()
+    # server-side cursor, otherwise the driver fetches all texts at once
+    result = session.connection().execution_options(stream_results=True).execute(query)
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        keys += [row[0] for row in batch]
+        ids += [row[1] for row in batch]
+        blocks.append(normalize(vectorized_transformation([text_cleaning(row[2] or '') for row in batch], model))
+                      .astype(np.float32))
+    width = len(model.vocabulary_)
+    matrix = vstack(blocks, format='csr') if blocks else csr_matrix((0, width), dtype=np.float32)
+    return np.array(keys, dtype=np.int64), np.array(ids, dtype=np.int64), matrix
+
+
+@timer_wrapper
+def build_corpus_matrices(folder=MATRICES_FOLDER, batch_size=1000):
+    """
+    Vectorize all bills of DB with models of `load_models` and save them as `CandidateMatrices`:
+    whole bills (bills without parent) with DOC model, their sections with SECTIONS model -
+    bills with parent bill and rows of sections table (unchanged sections linked to other versions get their text).
+    Document keys are `Bill.id`, `origins` are `Bill.origin`,
+    `section_ids` with `section_sources` are ids of the section rows in bills or sections table.
+    :param folder: folder for .npy files
+    :param batch_size: number of rows transformed at once
+    :return: CandidateMatrices
+    """
+    from sqlalchemy import text as text_to_query
+    doc_count_vectorizer, sec_count_vectorizer = load_models()
+    session = create_session(CONFIG['DB_connection'])
+    bills_table, sections_table = Bill.__tablename__, Section.__tablename__
+    t0 = time()
+    with span('vectorize.transform', corpus='docs'):
+        doc_ids, _, docs = _vectorize_rows(session, text_to_query(
+            'SELECT id, id, text FROM {} WHERE parent_bill_id IS NULL ORDER BY id'.format(bills_table)),
+            doc_count_vectorizer, batch_size)
+        origins = dict(session.execute(text_to_query(
+            'SELECT id, origin FROM {} WHERE parent_bill_id IS NULL'.format(bills_table))).all())
+    print('{} bills vectorized in {:.3f} sec'.format(len(doc_ids), time() - t0))
+    t0 = time()
+    queries = ['SELECT parent_bill_id, id, text FROM {} WHERE parent_bill_id IS NOT NULL ORDER BY id'.format(
+                   bills_table),
+               'SELECT b.id, s.id, COALESCE(s.text, l.text) FROM {sections} s '
+               'JOIN {bills} b ON b.origin = s.bill_origin AND b.parent_bill_id IS NULL '
+               'LEFT JOIN {sections} l ON l.id = s.linked_section_id '
+               'WHERE COALESCE(s.text, l.text) IS NOT NULL ORDER BY s.id'.format(sections=sections_table,
+                                                                                bills=bills_table)]
+    section_keys, section_ids, section_sources, blocks = list(), list(), list(), list()
+    with span('vectorize.transform', corpus='sections'):
+        for source, query in enumerate(queries):
+            keys, ids, matrix = _vectorize_rows(session, text_to_query(query), sec_count_vectorizer, batch_size)
+            section_keys.append(keys)
+            section_ids.append(ids)
+            section_sources.append(np.full(len(ids), source, dtype=np.int8))
+            blocks.append(matrix)
+    # sections ordered by position of their bill, the order of rows of every bill is kept
+    section_keys = np.concatenate(section_keys)
+    position = np.searchsorted(doc_ids, section_keys)
+    known = np.isin(section_keys, doc_ids)
+    order = np.flatnonzero(known)[np.argsort(position[known], kind='stable')]
+    sections = vstack(blocks, format='csr')[order]
+    vocabularies = dict(docs=vocabulary_digest(doc_count_vectorizer, docs.shape[1]),
+                        sections=vocabulary_digest(sec_count_vectorizer, sections.shape[1]))
+    section_indptr = np.r_[0, np.cumsum(np.bincount(position[order], minlength=len(doc_ids)))]
+    print('{} sections vectorized in {:.3f} sec'.format(len(order), time() - t0))
+    matrices = CandidateMatrices(doc_ids, docs, sections, section_indptr,
+                                 origins=np.array([origins[i] or '' for i in doc_ids.tolist()], dtype=str),
+                                 section_ids=np.concatenate(section_ids)[order],
+                                 section_sources=np.concatenate(section_sources)[order],
+                                 vocabularies=vocabularies)
+    matrices.save(folder)
+    res = subprocess.check_output(['du', '-sh', folder])
+    print('Matrices saved to {}, size: {}'.format(folder, res.decode().split('\t')[0]))
+    return matrices
+
+
+def _last_document_id(vocabulary, prefix):
+    """
+    The largest id of documents with keys '<prefix>:<id>' added to the vocabulary, 0 if there are none
+    """
+    start = len(prefix) + 1
+    return max((int(key[start:]) for key in vocabulary.documents if key.startswith(prefix + ':')), default=0)
+
+
+@timer_wrapper
+def update_vocabularies(vocabulary_folder=VOCABULARY_FOLDER, batch_size=1000):
+    """
+    Add bills loaded to DB since the last run to persistent vocabularies (see `vocabulary.NgramVocabulary`),
+    the same corpora as `create_models` uses: DOC - whole bill texts, SECTIONS - sections of the bills
+    (stored in bills table with parent bill, as `create_models` expects, and in sections table).
+    Nothing is refitted, only new rows (with ids larger than the last added one) are loaded, cleaned and added.
+    :param vocabulary_folder: folder with 'docs' and 'sections' vocabularies
+    :param batch_size: number of bills added at once
+    :return: none
+    """
+    db_config = CONFIG['DB_connection']
+    session = create_session(db_config)
+    # corpus name -> (key prefix, id column, text column, condition)
+    corpora = {'docs': [('bill', Bill.id, Bill.bill_text, Bill.parent_bill_id == None)],
+               'sections': [('bill', Bill.id, Bill.bill_text, Bill.parent_bill_id != None),
+                            ('section', Section.id, Section.text, Section.text != None)]}
+    for name, sources in corpora.items():
+        vocabulary = NgramVocabulary(path.join(vocabulary_folder, name))
+        t0 = time()
+        added = 0
+        for prefix, id_column, text_column, condition in sources:
+            # rows are added in order of ids, so only rows after the last added one are new
+            last_id = _last_document_id(vocabulary, prefix)
+            rows = session.query(id_column, text_column).filter(condition, id_column > last_id)\
+                .order_by(id_column).yield_per(batch_size)
+            new_rows = (('{}:{}'.format(prefix, row_id), text) for row_id, text in rows)
+            with span('vectorize.fit', corpus=name):
+                while True:
+                    batch = list(islice(new_rows, batch_size))
+                    if not batch:
+                        break
+                    added += vocabulary.add_documents([text_cleaning(text) for _, text in batch],
+                                                      keys=[key for key, _ in batch])
+        vocabulary.save()
+        print('{}: added {} texts, {} documents and {} n-grams in vocabulary'.format(
+            name, added, vocabulary.n_docs, len(vocabulary)))
+        print(f'took {round(time() - t0, 3)} sec')
+
+
 @timer_wrapper
 def create_models():
     """
@@ -217,12 +626,13 @@ def create_models():
     session = create_session(db_config)
 
     # ------- BEGIN CREATE DOC MODEL --------
-    text_bills = session.query(Bill).filter(Bill.parent_bill_id == None)
+    text_bills = session.query(Bill).options(undefer(Bill.bill_text)).filter(Bill.parent_bill_id == None)
     doc_corpus = []
     print('Start loading bills...')
     t0 = time()
-    for bill in text_bills.all():
-        doc_corpus.append(text_cleaning(bill.bill_text))
+    with span('vectorize.load', corpus='docs'):
+        for bill in text_bills.all():
+            doc_corpus.append(text_cleaning(bill.bill_text))
     print('- corpus with {} bills from DB created - OK.'.format(len(doc_corpus)))
     print(f'took {round(time() - t0, 3)} sec')
     count_vectorizer = CountVectorizer(ngram_range=(4, 4),
@@ -230,7 +640,8 @@ def create_models():
                                        lowercase=True)
     print('- start fitting model...')
     t0 = time()
-    count_vectorizer.fit_transform(doc_corpus)
+    with span('vectorize.fit', corpus='docs'):
+        count_vectorizer.fit_transform(doc_corpus)
     print('- model fit - OK.')
     print(f'took {round(time() - t0, 3)} sec')
     model_filename = 'CV_model.pkl'
@@ -240,12 +651,13 @@ def create_models():
     print('DOC Model saved! Model size: {}'.format(res.decode().split('\t')[0]))
 
     # ------- BEGIN CREATE SECTIONS MODEL --------
-    text_sections = session.query(Bill).filter(Bill.parent_bill_id!=None)
+    text_sections = session.query(Bill).options(undefer(Bill.bill_text)).filter(Bill.parent_bill_id!=None)
     sections_corpus = []
     print('\nStart loading section texts ...')
     t0 = time()
-    for bill in text_sections.all():
-        sections_corpus.append(text_cleaning(bill.bill_text))
+    with span('vectorize.load', corpus='sections'):
+        for bill in text_sections.all():
+            sections_corpus.append(text_cleaning(bill.bill_text))
     print('- corpus with {} sections from DB created - OK.'.format(len(sections_corpus)))
     print(f'took {round(time() - t0, 3)} sec')
     count_vectorizer_sections = CountVectorizer(ngram_range=(4, 4),
@@ -253,7 +665,8 @@ def create_models():
                                                 lowercase=True)
     print(' - start fitting model...')
     t0 = time()
-    count_vectorizer_sections.fit_transform(sections_corpus)
+    with span('vectorize.fit', corpus='sections'):
+        count_vectorizer_sections.fit_transform(sections_corpus)
     print(' - model fit - OK')
     print(f'took {round(time() - t0, 3)} sec')
     sections_model_filename = 'CV_sections_model.pkl'
@@ -289,7 +702,7 @@ def test_vectorizer():
     #  ------ GET SOME BILLS FROM DB ------
     db_config = CONFIG['DB_connection']
     session = create_session(db_config)
-    bills = [b for b in session.query(Bill).limit(100).all()]
+    bills = [b for b in session.query(Bill).options(undefer(Bill.bill_text)).limit(100).all()]
 
     # ----- DESERILALIZE MODELS -----
     model_filename = 'CV_model.pkl'
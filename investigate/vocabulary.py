@@ -0,0 +1,168 @@
+"""
+Persistent word n-gram vocabulary with document frequencies, updated incrementally.
+
+Replaces refitting of `CountVectorizer` every time new bills arrive:
+new documents only append their new n-grams to the vocabulary and increment document frequencies,
+`transform` gives the same counts matrix as `CountVectorizer(ngram_range=(4, 4), tokenizer=RegexpTokenizer(r"\\w+")
+.tokenize, lowercase=True).transform` with this vocabulary (column order differs, cosine similarities don't).
+
+Stored in a folder:
+    ngrams.txt - one n-gram per line, line number is its id, only appended
+    df.npy - document frequency of every n-gram
+    documents.txt - keys of added documents, documents with known keys are skipped
+    meta.json - n-gram range and number of documents
+"""
+import json
+import os
+import re
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+class NgramVocabulary:
+    def __init__(self, folder=None, ngram_range=(4, 4)):
+        """
+        :param folder: folder to store the vocabulary, loaded from it if exists
+        :param ngram_range: (min_n, max_n) as in CountVectorizer
+        """
+        self.folder = folder
+        self.ngram_range = tuple(ngram_range)
+        self.vocabulary_ = dict()
+        self._ngrams = list()
+        self.df = np.zeros(0, dtype=np.int64)
+        self.n_docs = 0
+        self.documents = set()
+        self._saved_ngrams = 0
+        self._new_documents = list()
+        # files of the folder are written, next saves append to them
+        self._persisted = False
+        if folder and os.path.isfile(os.path.join(folder, 'meta.json')):
+            self.load()
+
+    def __len__(self):
+        return len(self._ngrams)
+
+    def analyze(self, text):
+        """
+        Word n-grams of the text, the same as CountVectorizer analyzer with \\w+ tokenizer
+        """
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        min_n, max_n = self.ngram_range
+        ngrams = list()
+        for n in range(min_n, min(max_n, len(tokens)) + 1):
+            ngrams += [' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1)]
+        return ngrams
+
+    def add_documents(self, texts, keys=None):
+        """
+        Add new n-grams of documents to vocabulary and count document frequencies
+        :param texts: iterable of texts
+        :param keys: (optional) unique keys of documents (e.g. bill id), documents added before are skipped
+        :return: number of added documents
+        """
+        added = 0
+        df_increments = dict()
+        keys = iter(keys) if keys is not None else None
+        for text in texts:
+            key = str(next(keys)) if keys is not None else None
+            if key is not None:
+                if key in self.documents:
+                    continue
+                self.documents.add(key)
+                self._new_documents.append(key)
+            for ngram in set(self.analyze(text)):
+                index = self.vocabulary_.get(ngram)
+                if index is None:
+                    index = self.vocabulary_[ngram] = len(self._ngrams)
+                    self._ngrams.append(ngram)
+                df_increments[index] = df_increments.get(index, 0) + 1
+            added += 1
+        if len(self.df) < len(self._ngrams):
+            self.df = np.concatenate([self.df, np.zeros(len(self._ngrams) - len(self.df), dtype=np.int64)])
+        if df_increments:
+            indexes = np.fromiter(df_increments.keys(), dtype=np.int64, count=len(df_increments))
+            self.df[indexes] += np.fromiter(df_increments.values(), dtype=np.int64, count=len(df_increments))
+        self.n_docs += added
+        return added
+
+    def transform(self, texts):
+        """
+        Counts of known n-grams in every text, unknown n-grams are ignored
+        :return: sparse matrix documents x vocabulary
+        """
+        indptr, indices, values = [0], list(), list()
+        for text in texts:
+            counts = dict()
+            for ngram in self.analyze(text):
+                index = self.vocabulary_.get(ngram)
+                if index is not None:
+                    counts[index] = counts.get(index, 0) + 1
+            indices += counts.keys()
+            values += counts.values()
+            indptr.append(len(indices))
+        matrix = csr_matrix((np.array(values, dtype=np.int64), np.array(indices, dtype=np.int64), indptr),
+                            shape=(len(indptr) - 1, len(self._ngrams)))
+        matrix.sort_indices()
+        return matrix
+
+    def idf(self):
+        """
+        Smoothed inverse document frequencies, as sklearn TfidfTransformer computes them
+        """
+        return np.log((1 + self.n_docs) / (1 + self.df)) + 1
+
+    def get_feature_names(self):
+        return list(self._ngrams)
+
+    def save(self, folder=None):
+        """
+        Append new n-grams and documents to files of the vocabulary, rewrite frequencies
+        """
+        folder = folder or self.folder
+        rewrite = folder != self.folder or not self._persisted
+        if rewrite:
+            # new folder: write everything
+            self._saved_ngrams = 0
+            self._new_documents = sorted(self.documents)
+            self.folder = folder
+        mode = 'w' if rewrite else 'a'
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'ngrams.txt'), mode) as ngrams_file:
+            ngrams_file.writelines(ngram + '\n' for ngram in self._ngrams[self._saved_ngrams:])
+        np.save(os.path.join(folder, 'df.npy'), self.df)
+        with open(os.path.join(folder, 'meta.json'), 'w') as meta:
+            json.dump(dict(ngram_range=self.ngram_range, n_docs=self.n_docs, n_ngrams=len(self._ngrams)), meta)
+        with open(os.path.join(folder, 'documents.txt'), mode) as documents_file:
+            documents_file.writelines(key + '\n' for key in self._new_documents)
+        self._saved_ngrams = len(self._ngrams)
+        self._new_documents = list()
+        self._persisted = True
+
+    def load(self, folder=None):
+        folder = folder or self.folder
+        with open(os.path.join(folder, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        self.ngram_range = tuple(meta['ngram_range'])
+        self.n_docs = meta['n_docs']
+        ngrams_path = os.path.join(folder, 'ngrams.txt')
+        with open(ngrams_path) as ngrams_file:
+            self._ngrams = [line.rstrip('\n') for line in ngrams_file]
+        if len(self._ngrams) > meta['n_ngrams']:
+            # n-grams appended after the last meta.json (interrupted save) are dropped
+            self._ngrams = self._ngrams[:meta['n_ngrams']]
+            with open(ngrams_path, 'w') as ngrams_file:
+                ngrams_file.writelines(ngram + '\n' for ngram in self._ngrams)
+        self.vocabulary_ = {ngram: index for index, ngram in enumerate(self._ngrams)}
+        self.df = np.load(os.path.join(folder, 'df.npy'))[:len(self._ngrams)]
+        documents_path = os.path.join(folder, 'documents.txt')
+        if os.path.isfile(documents_path):
+            with open(documents_path) as documents_file:
+                self.documents = {line.rstrip('\n') for line in documents_file}
+        self.folder = folder
+        self._saved_ngrams = len(self._ngrams)
+        self._new_documents = list()
+        self._persisted = True
+        return self
@@ -0,0 +1,288 @@
+"""
+Watch mode of ingestion: new and changed bill files in `CONGRESS_ROOT_FOLDER` are loaded to DB as they arrive.
+
+Files are detected with inotify (`pip install inotify_simple`, linux) or, where it isn't available,
+by comparing size and mtime of files found by scandir every `interval` seconds.
+A file is loaded only after its size and mtime don't change for `settle` seconds (it may still be written),
+ready files are loaded in micro-batches: when `batch_size` files are ready or the oldest ready file waits `max_delay`.
+A changed file which was loaded before replaces the rows of its bill, see `main_tests.forget_origins`.
+If a batch fails (malformed xml, DB error), its files are loaded one by one and files which still fail
+are reported and skipped, the watch goes on.
+
+    python watch.py -sections -workers 4
+    python watch.py -all -versions -settle 5 -polling
+Add `-catch_up` to load files which are already in the folder, but not in DB (by `BillPath.origin`).
+"""
+import fnmatch
+import os
+import sys
+from contextlib import ExitStack
+from time import monotonic, sleep
+
+from config import CONFIG
+from utils import create_bill_name
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def scan_files(root, pattern='*.xml'):
+    """
+    :return: dict path -> (size, mtime_ns) of all files under root matching the pattern
+    """
+    found = dict()
+    folders = [root]
+    while folders:
+        try:
+            entries = list(os.scandir(folders.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file() and fnmatch.fnmatch(entry.name, pattern):
+                    stat = entry.stat()
+                    found[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                # removed while scanning
+                continue
+    return found
+
+
+class ScandirWatcher:
+    """
+    Changed files by comparing two scans of the folder
+    """
+    def __init__(self, root, pattern='*.xml', interval=1.0):
+        self.root = root
+        self.pattern = pattern
+        self.interval = interval
+        self.state = scan_files(root, pattern)
+
+    def poll(self):
+        """
+        Wait `interval` seconds and return paths of new and changed files
+        """
+        sleep(self.interval)
+        state = scan_files(self.root, self.pattern)
+        changed = [path for path, stat in state.items() if self.state.get(path) != stat]
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Changed files by inotify events of all folders under root, new folders are watched as they appear
+    """
+    def __init__(self, root, pattern='*.xml', interval=1.0):
+        self.pattern = pattern
+        self.interval = interval
+        self.inotify = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        self.file_flags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY
+        self.folder_flags = self.file_flags | flags.ONLYDIR
+        self.folders = dict()
+        self._watch_tree(root)
+
+    def _watch_tree(self, root):
+        """
+        Watch the folder and its subfolders
+        :return: files already in them (created before the watch was added)
+        """
+        files = list()
+        for folder, subfolders, file_names in os.walk(root):
+            try:
+                self.folders[self.inotify.add_watch(folder, self.folder_flags)] = folder
+            except OSError:
+                continue
+            files += [os.path.join(folder, name) for name in file_names if fnmatch.fnmatch(name, self.pattern)]
+        return files
+
+    def poll(self):
+        changed = list()
+        for event in self.inotify.read(timeout=int(self.interval * 1000)):
+            folder = self.folders.get(event.wd)
+            if folder is None or not event.name:
+                continue
+            path = os.path.join(folder, event.name)
+            if event.mask & inotify_simple.flags.ISDIR:
+                if event.mask & (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO):
+                    changed += self._watch_tree(path)
+            elif fnmatch.fnmatch(event.name, self.pattern):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def create_watcher(root, pattern='*.xml', interval=1.0, polling=False):
+    """
+    InotifyWatcher if inotify_simple is installed and `polling` is not set, otherwise ScandirWatcher
+    """
+    if inotify_simple is not None and not polling:
+        try:
+            return InotifyWatcher(root, pattern, interval)
+        except OSError as e:
+            print('inotify is not available ({}), scanning the folder every {} sec'.format(e, interval))
+    return ScandirWatcher(root, pattern, interval)
+
+
+class Debouncer:
+    """
+    Files become ready when their size and mtime didn't change for `settle` seconds
+    """
+    def __init__(self, settle=2.0):
+        self.settle = settle
+        # path -> (stat, time when the stat was seen first)
+        self.pending = dict()
+
+    def add(self, paths):
+        for path in paths:
+            self.pending.setdefault(path, (None, monotonic()))
+
+    def ready(self):
+        """
+        :return: paths of settled files, they are removed from pending
+        """
+        now = monotonic()
+        ready = list()
+        for path, (last_stat, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed or renamed before it was loaded
+                del self.pending[path]
+                continue
+            stat = (stat.st_size, stat.st_mtime_ns)
+            if stat != last_stat:
+                self.pending[path] = (stat, now)
+            elif now - since >= self.settle and stat[0] > 0:
+                ready.append(path)
+                del self.pending[path]
+        return ready
+
+
+def load_batch(batch, session, pool, known_origins, **flags):
+    """
+    Load a micro-batch of files, replacing rows of bills loaded before.
+    If the batch fails, every file is loaded separately in this process (rows of its bill loaded before the error
+    are replaced), files which fail again are skipped. With `dedup` known contents are reloaded from DB after
+    every rollback: contents of the failed files were marked as known, but they are not stored.
+    Workers of the pool keep such digests too, the pool should be restarted after a failed batch.
+    :param flags: sections, bills, versions, dedup as in `main_tests.load_files`
+    :return: tuple (number of loaded files, number of changed files, list of failed files,
+        whether the batch failed and files were loaded one by one)
+    """
+    import main_tests
+    changed = list()
+    try:
+        origins = [create_bill_name(path) for path in batch]
+        changed = [origin for origin in origins if origin in known_origins]
+        if changed:
+            main_tests.forget_origins(changed, session)
+        loaded = main_tests.load_files(batch, session, pool=pool, **flags)
+        known_origins.update(origins)
+        return loaded, len(changed), list(), False
+    except Exception as e:
+        session.rollback()
+        print('batch of {} files failed ({}: {}), loading them one by one'.format(len(batch), type(e).__name__, e))
+    loaded, failed = 0, list()
+    rolled_back = True
+    for path in batch:
+        try:
+            if rolled_back and flags.get('dedup'):
+                main_tests.load_known_content_digests(session)
+            rolled_back = False
+            origin = create_bill_name(path)
+            main_tests.forget_origins([origin], session)
+            loaded += main_tests.load_files([path], session, **flags)
+            known_origins.add(origin)
+        except Exception as e:
+            session.rollback()
+            rolled_back = True
+            failed.append(path)
+            print('failed to load {}: {}: {}'.format(path, type(e).__name__, e))
+    return loaded, len(changed), failed, True
+
+
+def watch(root=None, pattern='*.xml', sections=False, bills=False, versions=False, dedup=False, workers=1,
+          settle=2.0, batch_size=20, max_delay=5.0, interval=1.0, polling=False, catch_up=False, max_batches=None):
+    """
+    Load new and changed files under root until interrupted, see module docs
+    :param root: folder to watch, by default `CONGRESS_ROOT_FOLDER`
+    :param pattern: file name pattern, e.g. 'document.xml'
+    :param sections, bills, versions, dedup, workers: as in `main_tests.parse_and_load`
+    :param settle: seconds without changes of the file before it's loaded
+    :param batch_size: files in one micro-batch
+    :param max_delay: seconds the first ready file waits for the batch to fill
+    :param interval: seconds between scans (timeout of inotify read)
+    :param polling: don't use inotify
+    :param catch_up: load files found at start which bills are not in DB
+    :param max_batches: stop after this number of batches (for tests)
+    """
+    import main_tests
+    from bill import Bill, BillPath
+    from utils import create_session
+    root = root or CONFIG['CONGRESS_ROOT_FOLDER']
+    session = create_session(CONFIG['DB_connection'])
+    watcher = create_watcher(root, pattern, interval, polling)
+    debouncer = Debouncer(settle)
+    print('watching {} for {} with {}'.format(root, pattern, type(watcher).__name__))
+    # bills with sections have BillPath, bills loaded as a whole only Bill
+    known_origins = {row[0] for row in session.query(BillPath.origin).distinct()}
+    known_origins.update(row[0] for row in session.query(Bill.origin).filter(Bill.parent_bill_id == None).distinct())
+    if catch_up:
+        missing = [path for path in scan_files(root, pattern) if create_bill_name(path) not in known_origins]
+        print('{} files are not loaded yet'.format(len(missing)))
+        debouncer.add(missing)
+    batch = list()
+    first_ready = None
+    batches = 0
+    try:
+        with ExitStack() as stack:
+            pool = stack.enter_context(main_tests.ingestion_pool(session, workers, dedup))
+            while max_batches is None or batches < max_batches:
+                debouncer.add(watcher.poll())
+                ready = debouncer.ready()
+                if ready and not batch:
+                    first_ready = monotonic()
+                batch += [path for path in ready if path not in batch]
+                if not batch or (len(batch) < batch_size and monotonic() - first_ready < max_delay):
+                    continue
+                t0 = monotonic()
+                loaded, changed, failed, retried = load_batch(batch, session, pool, known_origins, sections=sections,
+                                                              bills=bills, versions=versions, dedup=dedup)
+                if retried and dedup:
+                    # workers marked contents of the failed batch as known, new ones start with stored contents
+                    stack.close()
+                    pool = stack.enter_context(main_tests.ingestion_pool(session, workers, dedup))
+                batches += 1
+                print('batch {}: loaded {} files ({} changed, {} failed) in {:.3f} sec, {:.1f} sec after the first '
+                      'was ready'.format(batches, loaded, changed, len(failed), monotonic() - t0,
+                                         monotonic() - first_ready))
+                batch = list()
+    except KeyboardInterrupt:
+        print('stopped, {} files were not loaded'.format(len(batch) + len(debouncer.pending)))
+    finally:
+        watcher.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv
+
+    def option(name, default, cast=float):
+        return cast(args[args.index(name) + 1]) if name in args else default
+
+    full = '-all' in args
+    watch(root=option('-root', None, str), pattern=option('-pattern', '*.xml', str),
+          sections='-sections' in args or full, bills='-bills' in args or full, versions='-versions' in args,
+          dedup='-dedup' in args, workers=option('-workers', 1, int), settle=option('-settle', 2.0),
+          batch_size=option('-batch_size', 20, int), max_delay=option('-max_delay', 5.0),
+          interval=option('-interval', 1.0), polling='-polling' in args, catch_up='-catch_up' in args)